@@ -0,0 +1,6 @@
+"""DiffuGen benchmark suite.
+
+Measures DiffuGen's own overhead with a stub sd.cpp binary, or sweeps real
+generation settings against an installed stable-diffusion.cpp. Run it with
+``python -m benchmarks --help``.
+"""
@@ -0,0 +1,221 @@
+"""DiffuGen benchmark command line.
+
+Stub mode measures DiffuGen's own overhead by pointing sd_cpp_path at a fake
+sd binary, then drives the HTTP endpoints and the MCP tool functions at a
+configurable concurrency:
+
+    python -m benchmarks stub --targets generate,flux,mcp-flux --requests 50 --concurrency 4
+
+The jobs target submits to POST /jobs and polls until each job finishes, so it
+measures the asynchronous path end to end (queueing, broker and worker).
+
+Real mode sweeps model x resolution x steps x sampler against the installed
+stable-diffusion.cpp:
+
+    python -m benchmarks real --models flux-schnell,sdxl --resolutions 512x512,1024x1024 --steps 4,8
+
+Startup mode times importing diffugen and diffugen_openapi in fresh
+interpreters, and the MCP stdio server's initialize and tools/list round trips
+from process start:
+
+    python -m benchmarks startup --repeats 10
+
+Compare two saved result files:
+
+    python -m benchmarks compare before.json after.json
+"""
+import argparse
+import importlib
+import itertools
+import json
+import os
+import sys
+
+from benchmarks.runner import (REPO_ROOT, classify_result, http_call, import_call, job_call, make_workdir,
+                               mcp_startup_call, openapi_server, run_load, save_report, stub_environment, summarize)
+
+# HTTP targets: name -> (path, payload)
+HTTP_TARGETS = {
+    "generate": ("/generate", {"prompt": "benchmark image", "model": "flux-schnell"}),
+    "flux": ("/generate/flux", {"prompt": "benchmark image", "model": "flux-schnell"}),
+    "stable": ("/generate/stable", {"prompt": "benchmark image", "model": "sd15"}),
+    "jobs": ("/jobs", {"prompt": "benchmark image", "model": "flux-schnell"}),
+}
+
+# MCP targets: name -> (tool function name, arguments)
+MCP_TARGETS = {
+    "mcp-flux": ("generate_flux_image", {"prompt": "benchmark image", "model": "flux-schnell"}),
+    "mcp-stable": ("generate_stable_diffusion_image", {"prompt": "benchmark image", "model": "sd15"}),
+}
+
+def _split(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+def _import_diffugen(env):
+    """Import diffugen with env applied, since it reads its configuration at import time"""
+    os.environ.update(env)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    return importlib.import_module("diffugen")
+
+def _print_result(result):
+    latency = result["latency"]
+    print(f"{result['name']:<28} ok={result['succeeded']:<5} rejected={result['rejected']:<5} "
+          f"errors={result['errors']:<5} throughput={result['throughput']}/s "
+          f"p50={latency['p50']}s p95={latency['p95']}s p99={latency['p99']}s")
+
+def run_stub(args):
+    targets = _split(args.targets)
+    unknown = [t for t in targets if t not in HTTP_TARGETS and t not in MCP_TARGETS]
+    if unknown:
+        raise SystemExit(f"Unknown targets: {', '.join(unknown)}")
+
+    workdir = make_workdir(args.workdir)
+    env = stub_environment(workdir, args.delay, args.load_delay, args.fail_rate, args.output_bytes)
+    settings = {
+        "targets": targets, "requests": args.requests, "concurrency": args.concurrency,
+        "delay": args.delay, "load_delay": args.load_delay, "fail_rate": args.fail_rate,
+        "output_bytes": args.output_bytes, "workdir": workdir,
+    }
+    results = []
+
+    http_targets = [t for t in targets if t in HTTP_TARGETS]
+    if http_targets:
+        with openapi_server(env, workdir) as base_url:
+            for target in http_targets:
+                path, payload = HTTP_TARGETS[target]
+                call = job_call(base_url, payload) if target == "jobs" else http_call(base_url, path, payload)
+                samples, wall_time = run_load(call, args.requests, args.concurrency)
+                result = summarize(f"http:{target}", samples, wall_time, {"path": path})
+                _print_result(result)
+                results.append(result)
+
+    mcp_targets = [t for t in targets if t in MCP_TARGETS]
+    if mcp_targets:
+        previous_cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            diffugen = _import_diffugen(env)
+            for target in mcp_targets:
+                tool_name, arguments = MCP_TARGETS[target]
+                tool = getattr(diffugen, tool_name)
+                samples, wall_time = run_load(lambda: classify_result(tool(**arguments)), args.requests, args.concurrency)
+                result = summarize(target, samples, wall_time, {"tool": tool_name})
+                _print_result(result)
+                results.append(result)
+        finally:
+            os.chdir(previous_cwd)
+
+    report = save_report(args.output, "stub", results, settings)
+    print(f"Saved {len(report['results'])} results to {args.output}")
+
+def run_real(args):
+    diffugen = _import_diffugen({})
+    settings = {
+        "models": _split(args.models), "resolutions": _split(args.resolutions),
+        "steps": [int(s) for s in _split(args.steps)], "samplers": _split(args.samplers),
+        "repeats": args.repeats, "sd_cpp_path": diffugen.get_sd_cpp_path(),
+    }
+    results = []
+    for model, resolution, steps, sampler in itertools.product(
+            settings["models"], settings["resolutions"], settings["steps"], settings["samplers"]):
+        width, height = (int(v) for v in resolution.lower().split("x"))
+        tool = diffugen.generate_flux_image if model.startswith("flux-") else diffugen.generate_stable_diffusion_image
+        arguments = {"prompt": args.prompt, "model": model, "width": width, "height": height,
+                     "steps": steps, "sampling_method": sampler, "seed": args.seed}
+        samples, wall_time = run_load(lambda: classify_result(tool(**arguments)), args.repeats, 1)
+        result = summarize(f"{model}:{resolution}:{steps}:{sampler}", samples, wall_time,
+                           {"model": model, "width": width, "height": height, "steps": steps, "sampler": sampler})
+        _print_result(result)
+        results.append(result)
+
+    report = save_report(args.output, "real", results, settings)
+    print(f"Saved {len(report['results'])} results to {args.output}")
+
+def run_startup(args):
+    workdir = make_workdir(args.workdir)
+    env = stub_environment(workdir, 0.0)
+    settings = {"repeats": args.repeats, "mcp": not args.skip_mcp, "workdir": workdir}
+    calls = [(f"import:{module}", import_call(module, env, workdir)) for module in ("diffugen", "diffugen_openapi")]
+    if not args.skip_mcp:
+        calls.append(("mcp:startup", mcp_startup_call(env, workdir)))
+    results = []
+    for name, call in calls:
+        # One at a time so the runs do not compete for the CPU and disk
+        samples, wall_time = run_load(call, args.repeats, 1)
+        result = summarize(name, samples, wall_time)
+        _print_result(result)
+        results.append(result)
+
+    report = save_report(args.output, "startup", results, settings)
+    print(f"Saved {len(report['results'])} results to {args.output}")
+
+def _delta(before, after):
+    if before is None or after is None:
+        return "n/a"
+    if before == 0:
+        return f"{after}"
+    return f"{after} ({(after - before) / before * 100:+.1f}%)"
+
+def run_compare(args):
+    with open(args.before) as f:
+        before = {r["name"]: r for r in json.load(f)["results"]}
+    with open(args.after) as f:
+        after_report = json.load(f)
+    for result in after_report["results"]:
+        previous = before.get(result["name"])
+        if previous is None:
+            print(f"{result['name']:<28} (no baseline)")
+            continue
+        print(f"{result['name']:<28} throughput={_delta(previous['throughput'], result['throughput'])} "
+              f"p50={_delta(previous['latency']['p50'], result['latency']['p50'])} "
+              f"p95={_delta(previous['latency']['p95'], result['latency']['p95'])} "
+              f"p99={_delta(previous['latency']['p99'], result['latency']['p99'])} "
+              f"errors={_delta(previous['error_rate'], result['error_rate'])}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="DiffuGen benchmark suite")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    stub = subparsers.add_parser("stub", help="Measure DiffuGen overhead with a fake sd binary")
+    stub.add_argument("--targets", default="generate,mcp-flux",
+                      help=f"Comma-separated targets: {', '.join(list(HTTP_TARGETS) + list(MCP_TARGETS))}")
+    stub.add_argument("--requests", type=int, default=20, help="Requests per target")
+    stub.add_argument("--concurrency", type=int, default=1, help="Concurrent clients")
+    stub.add_argument("--delay", type=float, default=0.5, help="Seconds the stub spends sampling")
+    stub.add_argument("--load-delay", type=float, dest="load_delay", default=0.0, help="Seconds the stub spends loading")
+    stub.add_argument("--fail-rate", type=float, dest="fail_rate", default=0.0, help="Fraction of stub runs that fail")
+    stub.add_argument("--output-bytes", type=int, dest="output_bytes", default=0, help="Minimum size of stub images")
+    stub.add_argument("--workdir", default=None, help="Directory for the stub binary, outputs and logs")
+    stub.add_argument("--output", default="benchmark_stub.json", help="Where to save the JSON results")
+    stub.set_defaults(func=run_stub)
+
+    real = subparsers.add_parser("real", help="Sweep generation settings with the real sd binary")
+    real.add_argument("--models", default="flux-schnell", help="Comma-separated models")
+    real.add_argument("--resolutions", default="512x512", help="Comma-separated WIDTHxHEIGHT values")
+    real.add_argument("--steps", default="4", help="Comma-separated step counts")
+    real.add_argument("--samplers", default="euler", help="Comma-separated sampling methods")
+    real.add_argument("--repeats", type=int, default=1, help="Runs per combination")
+    real.add_argument("--prompt", default="a lighthouse on a cliff at sunset", help="Prompt to render")
+    real.add_argument("--seed", type=int, default=42, help="Fixed seed so runs are comparable")
+    real.add_argument("--output", default="benchmark_real.json", help="Where to save the JSON results")
+    real.set_defaults(func=run_real)
+
+    startup = subparsers.add_parser("startup", help="Measure import and MCP server startup time")
+    startup.add_argument("--repeats", type=int, default=10, help="Fresh processes per measurement")
+    startup.add_argument("--skip-mcp", action="store_true", dest="skip_mcp",
+                         help="Only time the imports, not the MCP stdio server")
+    startup.add_argument("--workdir", default=None, help="Directory for the stub binary and outputs")
+    startup.add_argument("--output", default="benchmark_startup.json", help="Where to save the JSON results")
+    startup.set_defaults(func=run_startup)
+
+    compare = subparsers.add_parser("compare", help="Compare two saved result files")
+    compare.add_argument("before", help="Baseline results JSON")
+    compare.add_argument("after", help="New results JSON")
+    compare.set_defaults(func=run_compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""Load generation and result aggregation for the DiffuGen benchmarks"""
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+from benchmarks.stub_sd import install_stub
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Error messages that mean the request was turned away rather than failed
+_REJECTION_MARKERS = ("already in progress", "rate limit", "queue is full", "try again")
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of values (pct in 0-100)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * pct / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+def summarize(name, samples, wall_time, settings=None):
+    """Aggregate request samples into throughput, latency percentiles and outcome rates"""
+    total = len(samples)
+    ok_latencies = [s["latency"] for s in samples if s["outcome"] == "ok"]
+    rejected = sum(1 for s in samples if s["outcome"] == "rejected")
+    errors = sum(1 for s in samples if s["outcome"] == "error")
+
+    def rounded(value):
+        return round(value, 4) if value is not None else None
+
+    phase_totals = {}
+    for sample in samples:
+        for phase, value in (sample.get("timings") or {}).items():
+            if isinstance(value, (int, float)):
+                phase_totals.setdefault(phase, []).append(value)
+
+    return {
+        "name": name,
+        "settings": settings or {},
+        "requests": total,
+        "succeeded": len(ok_latencies),
+        "rejected": rejected,
+        "errors": errors,
+        "wall_time": rounded(wall_time),
+        "throughput": rounded(len(ok_latencies) / wall_time) if wall_time > 0 else None,
+        "rejection_rate": rounded(rejected / total) if total else None,
+        "error_rate": rounded(errors / total) if total else None,
+        "latency": {
+            "p50": rounded(percentile(ok_latencies, 50)),
+            "p95": rounded(percentile(ok_latencies, 95)),
+            "p99": rounded(percentile(ok_latencies, 99)),
+            "mean": rounded(sum(ok_latencies) / len(ok_latencies)) if ok_latencies else None,
+            "max": rounded(max(ok_latencies)) if ok_latencies else None,
+        },
+        "phase_means": {phase: rounded(sum(values) / len(values)) for phase, values in phase_totals.items()},
+        "error_samples": [s.get("detail") for s in samples if s["outcome"] == "error"][:5],
+    }
+
+def run_load(call, total, concurrency):
+    """Invoke call() total times from concurrency threads.
+
+    call returns (outcome, detail, timings). Returns the samples and the wall time."""
+    def timed_call(_):
+        start = time.perf_counter()
+        try:
+            outcome, detail, timings = call()
+        except Exception as e:
+            outcome, detail, timings = "error", str(e), None
+        return {"latency": time.perf_counter() - start, "outcome": outcome, "detail": detail, "timings": timings}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(timed_call, range(total)))
+    return samples, time.perf_counter() - start
+
+def classify_result(result):
+    """Classify a DiffuGen tool result dict as ok, rejected or error"""
+    if result.get("success"):
+        return "ok", None, result.get("timings")
+    error = str(result.get("error", "Unknown error"))
+    if any(marker in error.lower() for marker in _REJECTION_MARKERS):
+        return "rejected", error, result.get("timings")
+    return "error", error, result.get("timings")
+
+def http_call(base_url, path, payload, timeout=600):
+    """Return a callable that POSTs payload to base_url + path and classifies the response"""
+    body = json.dumps(payload).encode()
+
+    def call():
+        request = urllib.request.Request(base_url + path, data=body, method="POST",
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                data = json.loads(response.read() or b"{}")
+                return "ok", None, data.get("timings")
+        except urllib.error.HTTPError as e:
+            detail = e.read().decode(errors="replace")
+            if e.code in (429, 503) or any(marker in detail.lower() for marker in _REJECTION_MARKERS):
+                return "rejected", f"HTTP {e.code}: {detail}", None
+            return "error", f"HTTP {e.code}: {detail}", None
+    return call
+
+def job_call(base_url, payload, poll_interval=0.1, timeout=600):
+    """Return a callable that submits payload to /jobs and polls the job until it finishes"""
+    body = json.dumps(payload).encode()
+
+    def call():
+        request = urllib.request.Request(base_url + "/jobs", data=body, method="POST",
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                job_id = json.loads(response.read())["job_id"]
+        except urllib.error.HTTPError as e:
+            detail = e.read().decode(errors="replace")
+            outcome = "rejected" if e.code in (429, 503) else "error"
+            return outcome, f"HTTP {e.code}: {detail}", None
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with urllib.request.urlopen(f"{base_url}/jobs/{job_id}", timeout=timeout) as response:
+                job = json.loads(response.read())
+            if job["status"] == "succeeded":
+                return "ok", None, job.get("timings")
+            if job["status"] == "failed":
+                return "error", job.get("error"), job.get("timings")
+            time.sleep(poll_interval)
+        return "error", f"Job {job_id} did not finish within {timeout}s", None
+    return call
+
+def import_call(module, env, workdir):
+    """Return a callable that times importing module in a fresh interpreter"""
+    code = ("import sys, time; sys.path.insert(0, %r); start = time.perf_counter(); "
+            "import %s; print(time.perf_counter() - start)" % (REPO_ROOT, module))
+
+    def call():
+        completed = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=dict(os.environ, **env),
+                                   capture_output=True, text=True, timeout=120)
+        if completed.returncode != 0:
+            return "error", completed.stderr.strip()[-500:], None
+        return "ok", None, {"import": float(completed.stdout.strip().splitlines()[-1])}
+    return call
+
+def _rpc_response(process, request_id, deadline):
+    """Read JSON-RPC lines from the server's stdout until the response to request_id"""
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError(f"No response to request {request_id}")
+        ready, _, _ = select.select([process.stdout], [], [], remaining)
+        if not ready:
+            continue
+        line = process.stdout.readline()
+        if not line:
+            raise RuntimeError(f"MCP server exited: {process.stderr.read().decode(errors='replace')[-500:]}")
+        message = json.loads(line)
+        if message.get("id") == request_id:
+            return message
+
+def mcp_startup_call(env, workdir, timeout=60):
+    """Return a callable that starts the MCP stdio server and times initialize and tools/list"""
+    def send(process, message):
+        process.stdin.write((json.dumps(message) + "\n").encode())
+        process.stdin.flush()
+
+    def call():
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, "diffugen.py")], cwd=workdir,
+                                   env=dict(os.environ, **env), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        deadline = time.time() + timeout
+        try:
+            send(process, {"jsonrpc": "2.0", "id": 1, "method": "initialize", "params": {
+                "protocolVersion": "2024-11-05", "capabilities": {},
+                "clientInfo": {"name": "diffugen-benchmark", "version": "1"}}})
+            response = _rpc_response(process, 1, deadline)
+            if "error" in response:
+                return "error", str(response["error"]), None
+            initialized = time.perf_counter()
+            send(process, {"jsonrpc": "2.0", "method": "notifications/initialized"})
+            send(process, {"jsonrpc": "2.0", "id": 2, "method": "tools/list"})
+            response = _rpc_response(process, 2, deadline)
+            if "error" in response:
+                return "error", str(response["error"]), None
+            listed = time.perf_counter()
+            return "ok", None, {"initialize": initialized - start, "tools_list": listed - initialized,
+                                "tools": len(response["result"]["tools"])}
+        except (RuntimeError, TimeoutError, ValueError) as e:
+            return "error", str(e), None
+        finally:
+            process.kill()
+            process.wait()
+    return call
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def stub_environment(workdir, delay, load_delay=0.0, fail_rate=0.0, output_bytes=0):
+    """Install the stub sd binary under workdir and return the environment that selects it"""
+    sd_cpp_path = os.path.join(workdir, "stable-diffusion.cpp")
+    install_stub(sd_cpp_path)
+    return {
+        "SD_CPP_PATH": sd_cpp_path,
+        "DIFFUGEN_OUTPUT_DIR": os.path.join(workdir, "outputs"),
+        "DIFFUGEN_STUB_DELAY": str(delay),
+        "DIFFUGEN_STUB_LOAD_DELAY": str(load_delay),
+        "DIFFUGEN_STUB_FAIL_RATE": str(fail_rate),
+        "DIFFUGEN_STUB_OUTPUT_BYTES": str(output_bytes),
+        # The benchmark measures generation throughput, not the request rate limiter
+        "DIFFUGEN_RATE_LIMIT": "1000000/minute",
+    }
+
+@contextmanager
+def openapi_server(env, workdir, startup_timeout=60):
+    """Start diffugen_openapi.py on a free local port and yield its base URL"""
+    port = _free_port()
+    server_env = dict(os.environ, **env)
+    log_path = os.path.join(workdir, "openapi_server.log")
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(REPO_ROOT, "diffugen_openapi.py"), "--host", "127.0.0.1", "--port", str(port)],
+            cwd=workdir, env=server_env, stdout=log, stderr=subprocess.STDOUT
+        )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.time() + startup_timeout
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"OpenAPI server exited during startup, see {log_path}")
+            try:
+                with urllib.request.urlopen(base_url + "/health", timeout=2):
+                    break
+            except (urllib.error.URLError, ConnectionError):
+                if time.time() > deadline:
+                    raise RuntimeError(f"OpenAPI server did not start within {startup_timeout}s, see {log_path}")
+                time.sleep(0.2)
+        yield base_url
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def make_workdir(path=None):
+    """Create (or reuse) the directory that holds the stub binary, outputs and server logs"""
+    if path:
+        os.makedirs(path, exist_ok=True)
+        return os.path.abspath(path)
+    return tempfile.mkdtemp(prefix="diffugen-bench-")
+
+def diffugen_version():
+    """Describe the DiffuGen revision under test"""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+def save_report(path, mode, results, settings):
+    """Write benchmark results as JSON for comparison between versions"""
+    report = {
+        "mode": mode,
+        "diffugen_version": diffugen_version(),
+        "timestamp": datetime.now().isoformat(),
+        "python_version": sys.version.split()[0],
+        "platform": sys.platform,
+        "settings": settings,
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
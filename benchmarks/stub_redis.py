@@ -0,0 +1,250 @@
+"""Stand-in for a Redis server, for the Redis job broker.
+
+The stub speaks RESP2 over TCP and keeps its data in memory. It implements the
+commands RedisBroker uses (strings with expiry, hashes, sorted sets and
+WATCH/MULTI/EXEC transactions), so the broker can be tested and benchmarked
+without a Redis install:
+
+    server = start_stub_redis()
+    broker = create_broker(server.url)
+    ...
+    server.shutdown()
+
+or ``python -m benchmarks.stub_redis --port 6379`` for a standalone server.
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+class _Store:
+    """Keys of every database, with a version per key for WATCH"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.values = {}  # (db, key) -> bytes, dict (hash) or dict member -> score (sorted set)
+        self.kinds = {}  # (db, key) -> "string", "hash" or "zset"
+        self.expires = {}  # (db, key) -> Unix time
+        self.versions = {}  # (db, key) -> count of writes
+
+    def touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def get(self, key, kind):
+        if key in self.expires and self.expires[key] <= time.time():
+            self.delete(key)
+        if key not in self.values:
+            return None
+        if self.kinds[key] != kind:
+            raise CommandError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return self.values[key]
+
+    def put(self, key, kind, value):
+        self.values[key] = value
+        self.kinds[key] = kind
+        self.touch(key)
+
+    def delete(self, key):
+        if self.values.pop(key, None) is not None:
+            self.kinds.pop(key, None)
+            self.expires.pop(key, None)
+            self.touch(key)
+            return True
+        return False
+
+class CommandError(Exception):
+    pass
+
+def _range(items, start, stop):
+    """Redis-style inclusive range, with negative indices counting from the end"""
+    count = len(items)
+    start, stop = int(start), int(stop)
+    start = max(0, start + count if start < 0 else start)
+    stop = stop + count if stop < 0 else stop
+    return items[start:stop + 1]
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.db = 0
+        self.watched = {}  # (db, key) -> version when watched
+        self.queued = None  # Commands queued after MULTI
+
+    def handle(self):
+        while True:
+            try:
+                command = self._read_command()
+            except (ConnectionError, ValueError):
+                return
+            if command is None:
+                return
+            try:
+                reply = self._dispatch(command)
+            except CommandError as e:
+                reply = e
+            self.wfile.write(_encode(reply))
+            self.wfile.flush()
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Inline command, e.g. from telnet
+            return line.split()
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _dispatch(self, command):
+        name = command[0].decode().upper()
+        store = self.server.store
+        if name == "MULTI":
+            self.queued = []
+            return "OK"
+        if name == "EXEC":
+            queued, self.queued = self.queued, None
+            if queued is None:
+                raise CommandError("ERR EXEC without MULTI")
+            with store.lock:
+                watched, self.watched = self.watched, {}
+                if any(store.versions.get(key, 0) != version for key, version in watched.items()):
+                    return _NULL_ARRAY
+                replies = []
+                for queued_command in queued:
+                    try:
+                        replies.append(self._run(queued_command[0].decode().upper(), queued_command[1:]))
+                    except CommandError as e:
+                        replies.append(e)
+                return replies
+        if self.queued is not None:
+            self.queued.append(command)
+            return "QUEUED"
+        if name == "WATCH":
+            with store.lock:
+                for key in command[1:]:
+                    self.watched.setdefault((self.db, key), store.versions.get((self.db, key), 0))
+            return "OK"
+        if name == "UNWATCH":
+            self.watched = {}
+            return "OK"
+        with store.lock:
+            return self._run(name, command[1:])
+
+    def _run(self, name, args):
+        store = self.server.store
+        key = (self.db, args[0]) if args else None
+        if name in ("PING", "AUTH"):
+            return "PONG" if name == "PING" else "OK"
+        if name == "SELECT":
+            self.db = int(args[0])
+            return "OK"
+        if name == "GET":
+            return store.get(key, "string")
+        if name == "SET":
+            store.put(key, "string", args[1])
+            store.expires.pop(key, None)
+            options = [arg.upper() for arg in args[2:]]
+            if b"EX" in options:
+                store.expires[key] = time.time() + float(args[2 + options.index(b"EX") + 1])
+            return "OK"
+        if name == "EXPIRE":
+            if store.get(key, store.kinds.get(key)) is None:
+                return 0
+            store.expires[key] = time.time() + float(args[1])
+            return 1
+        if name == "DEL":
+            return sum(store.delete((self.db, arg)) for arg in args)
+        if name == "HGET":
+            return (store.get(key, "hash") or {}).get(args[1])
+        if name == "HSET":
+            values = dict(store.get(key, "hash") or {})
+            added = 0
+            for field, value in zip(args[1::2], args[2::2]):
+                added += field not in values
+                values[field] = value
+            store.put(key, "hash", values)
+            return added
+        if name == "ZADD":
+            members = dict(store.get(key, "zset") or {})
+            added = 0
+            for score, member in zip(args[1::2], args[2::2]):
+                added += member not in members
+                members[member] = float(score)
+            store.put(key, "zset", members)
+            return added
+        if name == "ZREM":
+            members = dict(store.get(key, "zset") or {})
+            removed = sum(members.pop(member, None) is not None for member in args[1:])
+            if removed:
+                if members:
+                    store.put(key, "zset", members)
+                else:
+                    store.delete(key)
+            return removed
+        if name == "ZCARD":
+            return len(store.get(key, "zset") or {})
+        if name in ("ZRANGE", "ZREVRANGE"):
+            members = sorted((store.get(key, "zset") or {}).items(), key=lambda item: (item[1], item[0]),
+                             reverse=name == "ZREVRANGE")
+            selected = _range(members, args[1], args[2])
+            if any(arg.upper() == b"WITHSCORES" for arg in args[3:]):
+                return [part for member, score in selected for part in (member, repr(score).encode())]
+            return [member for member, _ in selected]
+        raise CommandError(f"ERR unknown command '{name}'")
+
+_NULL_ARRAY = object()
+
+def _encode(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if reply is _NULL_ARRAY:
+        return b"*-1\r\n"
+    if isinstance(reply, CommandError):
+        return b"-" + str(reply).encode() + b"\r\n"
+    if isinstance(reply, str):
+        return b"+" + reply.encode() + b"\r\n"
+    if isinstance(reply, (bool, int)):
+        return b":%d\r\n" % reply
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    return b"*%d\r\n" % len(reply) + b"".join(_encode(item) for item in reply)
+
+class StubRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, _Handler)
+        self.store = _Store()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+def start_stub_redis(host="127.0.0.1", port=0):
+    """Serve a stub Redis server from a background thread. Returns the server; see .url and .shutdown()"""
+    server = StubRedisServer((host, port))
+    threading.Thread(target=server.serve_forever, name="stub-redis", daemon=True).start()
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run an in-memory stand-in for a Redis server")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=6379, help="Port to listen on")
+    args = parser.parse_args(argv)
+    server = StubRedisServer((args.host, args.port))
+    print(f"Stub Redis server listening on {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
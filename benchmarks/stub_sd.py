@@ -0,0 +1,86 @@
+"""Stand-in for the stable-diffusion.cpp ``sd`` binary.
+
+The stub accepts the same command line DiffuGen builds, sleeps for a
+configurable time while printing sd.cpp-style log and progress lines, and
+writes a small valid PNG to the ``-o`` path. Behaviour is controlled through
+environment variables so the server under test needs no changes:
+
+    DIFFUGEN_STUB_DELAY         seconds to spend "sampling" (default 0.5)
+    DIFFUGEN_STUB_LOAD_DELAY    seconds to spend "loading the model" (default 0.0)
+    DIFFUGEN_STUB_FAIL_RATE     fraction of runs that exit with code 1 (default 0.0)
+    DIFFUGEN_STUB_OUTPUT_BYTES  minimum size of the written PNG in bytes (default 0)
+"""
+import os
+import random
+import stat
+import struct
+import sys
+import time
+import zlib
+
+def _png_bytes(width, height, min_bytes=0):
+    """Build a valid grayscale PNG, padded with a comment chunk up to min_bytes"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    raw = b"".join(b"\x00" + b"\x80" * width for _ in range(height))
+    png = (b"\x89PNG\r\n\x1a\n"
+           + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+           + chunk(b"IDAT", zlib.compress(raw)))
+    padding = min_bytes - len(png) - 24
+    if padding > 0:
+        png += chunk(b"tEXt", b"Comment\x00" + b"x" * padding)
+    return png + chunk(b"IEND", b"")
+
+def _arg(args, flag, default=None):
+    if flag in args and args.index(flag) + 1 < len(args):
+        return args[args.index(flag) + 1]
+    return default
+
+def main(argv=None):
+    args = list(sys.argv[1:] if argv is None else argv)
+    output_path = _arg(args, "-o", "output.png")
+    steps = int(_arg(args, "--steps", "20"))
+    width = int(_arg(args, "-W", "512"))
+    height = int(_arg(args, "-H", "512"))
+    delay = float(os.environ.get("DIFFUGEN_STUB_DELAY", "0.5"))
+    load_delay = float(os.environ.get("DIFFUGEN_STUB_LOAD_DELAY", "0.0"))
+    fail_rate = float(os.environ.get("DIFFUGEN_STUB_FAIL_RATE", "0.0"))
+    min_bytes = int(os.environ.get("DIFFUGEN_STUB_OUTPUT_BYTES", "0"))
+
+    time.sleep(load_delay)
+    print(f"[INFO ] model.cpp - loading tensors completed, taking {load_delay:.2f}s", flush=True)
+    print("[INFO ] stable-diffusion.cpp - get_learned_condition completed, taking 1 ms", flush=True)
+
+    if random.random() < fail_rate:
+        print("[ERROR] stub_sd.py - simulated failure", file=sys.stderr, flush=True)
+        return 1
+
+    step_delay = delay / max(steps, 1)
+    for step in range(1, steps + 1):
+        time.sleep(step_delay)
+        sys.stdout.write(f"\r  |{'=' * step}>| {step}/{steps} - {step_delay:.2f}s/it")
+        sys.stdout.flush()
+    print(flush=True)
+    print(f"[INFO ] stable-diffusion.cpp - sampling completed, taking {delay:.2f}s", flush=True)
+    print("[INFO ] stable-diffusion.cpp - decode_first_stage completed, taking 0.00s", flush=True)
+
+    # Keep the PNG small; the real dimensions only matter for the server's bookkeeping
+    with open(output_path, "wb") as f:
+        f.write(_png_bytes(min(width, 64), min(height, 64), min_bytes))
+    print(f"save result image to '{output_path}'", flush=True)
+    return 0
+
+def install_stub(sd_cpp_path):
+    """Create build/bin/sd under sd_cpp_path that runs this stub.
+
+    Returns the path of the created executable."""
+    bin_dir = os.path.join(sd_cpp_path, "build", "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    bin_path = os.path.join(bin_dir, "sd")
+    with open(bin_path, "w") as f:
+        f.write(f"#!/bin/sh\nexec \"{sys.executable}\" \"{os.path.abspath(__file__)}\" \"$@\"\n")
+    os.chmod(bin_path, os.stat(bin_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bin_path
+
+if __name__ == "__main__":
+    sys.exit(main())
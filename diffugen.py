@@ -8,112 +8,288 @@ import argparse
 import json
 from pathlib import Path
 import random
+import math
 import time
 import threading
+import tempfile
+import shutil
+import signal
 import atexit
+from contextlib import contextmanager, nullcontext
 
-# Simplified logging setup - log only essential info
+import diffugen_metrics as metrics
+from diffugen_cpu import get_cpu_plan
+from diffugen_jobs import QUEUED, RUNNING, CancelToken, JobManager, create_broker
+from diffugen_fairqueue import DEFAULT_TENANT, FairGate, FairPolicy
+from diffugen_eta import LatencyModel, schedule_etas
+from diffugen_memory import available_memory_mb, plan_memory
+from diffugen_sweep import DEFAULT_SWEEP, build_contact_sheet, cell_label, expand_grid, grid_columns, normalize_axes
+from diffugen_variants import ALL_MODELS, ConversionCancelled, VariantCache, VariantError, resolve_variant
+from diffugen_loadshed import QUEUE_FULL, WAIT_TOO_LONG, LoadTracker
+from diffugen_speculate import Speculator
+from diffugen_warmup import DEFAULT_WARMUP, Warmer
+from diffugen_webhooks import WebhookDispatcher, job_payload, validate_callback_url
+
+# Simplified logging setup - log only essential info. The file is only created
+# once something is logged, so importing diffugen does not touch the disk
 logging.basicConfig(
-    filename='diffugen_debug.log',
+    handlers=[logging.FileHandler(os.environ.get("DIFFUGEN_LOG_FILE", "diffugen_debug.log"), delay=True)],
     level=logging.INFO,  # Changed from DEBUG to INFO
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# fcntl provides cross-process locks on POSIX; elsewhere only threads in one process are coordinated
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Pillow resizes hi-res upscales to the exact requested size; without it only sizes the upscaler produces exactly work
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 # Queue management system
 class GenerationQueue:
-    def __init__(self):
+    """Cross-process generation slots backed by flock()ed files in a shared lock directory.
+    
+    Every process that points at the same lock_dir (MCP servers, uvicorn workers,
+    CLI runs) shares the same max_concurrent slots regardless of its working
+    directory. The kernel releases a slot's lock when its holder exits, so a
+    crashed process never leaves a stale lock behind. Threads of one process wait
+    in a fair queue across tenants and priority classes (see diffugen_fairqueue)."""
+    
+    def __init__(self, lock_dir, max_concurrent=1, poll_interval=0.1):
         self.lock = threading.Lock()
-        self.is_busy = False
-        self.lock_file = os.path.join(os.getcwd(), "diffugen.lock")
-        # Clean up any stale lock on startup
-        self._remove_lock_file()
-        # Register cleanup on exit
-        atexit.register(self._remove_lock_file)
-    
-    def acquire(self, timeout=0):
-        """Try to acquire the lock for image generation.
-        Returns True if successful, False if busy."""
-        with self.lock:
-            # First check local thread lock
-            if self.is_busy:
-                logging.info("Image generation already in progress (local lock)")
-                return False
-                
-            # Then check file lock (for inter-process locking)
-            if os.path.exists(self.lock_file):
-                try:
-                    # Check if the lock file is stale (older than 30 minutes)
-                    lock_time = os.path.getmtime(self.lock_file)
-                    if time.time() - lock_time > 1800:  # 30 minutes
-                        logging.warning("Found stale lock file, removing it")
-                        self._remove_lock_file()
-                    else:
-                        with open(self.lock_file, 'r') as f:
-                            pid = f.read().strip()
-                        logging.info(f"Image generation already in progress by process {pid}")
-                        return False
-                except Exception as e:
-                    logging.error(f"Error checking lock file: {e}")
-                    return False
-            
-            # If we got here, no active generation is running
-            try:
-                with open(self.lock_file, 'w') as f:
-                    f.write(str(os.getpid()))
-                self.is_busy = True
-                logging.info(f"Acquired generation lock (PID: {os.getpid()})")
+        self.lock_dir = lock_dir
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.poll_interval = poll_interval
+        self._held = {}  # slot index -> open lock file (or True without fcntl)
+        self._local = threading.local()
+        self.gate = FairGate()
+        self._lock_dir_ready = False
+        if fcntl is None:
+            logging.warning("fcntl is unavailable, generation slots are only coordinated within this process")
+    
+    def _slot_path(self, index):
+        return os.path.join(self.lock_dir, f"generation-slot-{index}.lock")
+    
+    def acquire(self, timeout=0, cancel_token=None, flow=(DEFAULT_TENANT, "interactive"), cost=1.0, weight=1.0,
+                queued_since=None):
+        """Try to acquire a generation slot, waiting up to timeout seconds (None waits
+        until a slot frees up or cancel_token fires).
+        
+        flow is the (tenant, priority class) the request belongs to; cost and weight
+        set its place in the fair queue. queued_since is when the request was
+        submitted, if it waited elsewhere (e.g. as a queued job) before this call.
+        Returns True if successful, False if every slot stayed busy or the wait was cancelled."""
+        start_time = time.time()
+        metrics.QUEUE_DEPTH.inc()
+        ticket = self.gate.join(flow, cost, weight)
+        while True:
+            # Only the waiter at the head of the fair queue competes for a slot
+            slot = self._try_acquire() if self.gate.is_next(ticket) else None
+            if slot is not None:
+                self.gate.leave(ticket, served=True)
+                self._local.slot = slot
+                waited = time.time() - start_time
+                metrics.QUEUE_WAIT_SECONDS.observe(waited)
+                metrics.TENANT_QUEUE_WAIT_SECONDS.observe(time.time() - (queued_since or start_time),
+                                                          tenant=flow[0], priority=flow[1])
                 return True
-            except Exception as e:
-                logging.error(f"Error creating lock file: {e}")
+            cancelled = cancel_token is not None and cancel_token.cancelled
+            if cancelled or (timeout is not None and time.time() - start_time >= timeout):
+                self.gate.leave(ticket, served=False)
+                metrics.QUEUE_DEPTH.dec()
+                if not cancelled:
+                    holders = ", ".join(str(h["pid"]) for h in self.holders()) or "unknown"
+                    logging.info(f"Image generation already in progress (held by process {holders})")
                 return False
+            # Woken early when a waiter ahead leaves; slots freed by other processes are polled
+            self.gate.wait(self.poll_interval)
+    
+    def _try_acquire(self):
+        """Take the first free slot without blocking. Returns its index or None"""
+        with self.lock:
+            if not self._lock_dir_ready:
+                # Created on first use rather than at import
+                os.makedirs(self.lock_dir, exist_ok=True)
+                self._lock_dir_ready = True
+            for index in range(self.max_concurrent):
+                if index in self._held:
+                    continue
+                if fcntl is None:
+                    self._held[index] = True
+                    return index
+                try:
+                    lock_file = open(self._slot_path(index), "a+")
+                except OSError as e:
+                    logging.error(f"Error opening lock file: {e}")
+                    return None
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    continue
+                # Record the holder for diagnostics; liveness comes from the lock itself
+                lock_file.seek(0)
+                lock_file.truncate()
+                lock_file.write(json.dumps({"pid": os.getpid(), "since": time.time()}))
+                lock_file.flush()
+                self._held[index] = lock_file
+                logging.info(f"Acquired generation slot {index} (PID: {os.getpid()})")
+                return index
+        return None
     
     def release(self):
-        """Release the generation lock."""
+        """Release the generation slot held by the calling thread."""
+        slot = getattr(self._local, "slot", None)
+        if slot is None:
+            return
+        self._local.slot = None
         with self.lock:
-            self.is_busy = False
-            self._remove_lock_file()
-            logging.info("Released generation lock")
+            lock_file = self._held.pop(slot, None)
+            if lock_file is not None and lock_file is not True:
+                try:
+                    lock_file.seek(0)
+                    lock_file.truncate()
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                finally:
+                    lock_file.close()
+            logging.info(f"Released generation slot {slot}")
+        metrics.QUEUE_DEPTH.dec()
     
-    def _remove_lock_file(self):
-        """Remove the lock file if it exists."""
-        try:
-            if os.path.exists(self.lock_file):
-                os.remove(self.lock_file)
-        except Exception as e:
-            logging.error(f"Error removing lock file: {e}")
+    def holders(self):
+        """Describe the live holders of busy slots.
+        
+        Slot files record the holder's PID; a PID that no longer exists means its
+        lock was released by the kernel, so that slot is reported as free."""
+        holders = []
+        for index in range(self.max_concurrent):
+            if index in self._held:
+                holders.append({"slot": index, "pid": os.getpid()})
+                continue
+            try:
+                with open(self._slot_path(index), "r") as lock_file:
+                    info = json.loads(lock_file.read() or "{}")
+            except (OSError, ValueError):
+                continue
+            pid = info.get("pid")
+            if pid and _pid_alive(pid):
+                holders.append({"slot": index, "pid": pid, "since": info.get("since")})
+        return holders
 
-# Create global generation queue
-generation_queue = GenerationQueue()
+def _pid_alive(pid):
+    """Check whether a process with this PID exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
 
 # Helper function to print to stderr
 def log_to_stderr(message):
     print(message, file=sys.stderr, flush=True)
 
-# Try to import real FastMCP with minimal error handling
-mcp = None
-try:
-    from mcp.server.fastmcp import FastMCP
-    mcp = FastMCP("DiffuGen")
-except ImportError as e:
-    log_to_stderr(f"Error importing FastMCP: {e}")
+class LazyMCP:
+    """Collects @mcp.tool() registrations and creates the FastMCP server only when it runs.
     
-    # Simple fallback MCP implementation
-    class FallbackMCP:
-        def __init__(self, name):
-            self.name = name
-            log_to_stderr(f"Using fallback MCP server: {name}")
-        
-        def tool(self, *args, **kwargs):
-            def decorator(func): return func
-            return decorator
-        
-        def start(self): return True
+    Importing the MCP SDK takes most of a second, and the OpenAPI server, workers,
+    CLI runs and tools that import diffugen never need it."""
+    
+    def __init__(self, name):
+        self.name = name
+        self._tools = []
+        self._server = None
+    
+    def tool(self, *args, **kwargs):
+        def decorator(func):
+            self._tools.append((func, args, kwargs))
+            return func
+        return decorator
+    
+    def server(self):
+        """The FastMCP server with every tool registered, or None if the MCP SDK is unavailable"""
+        if self._server is None:
+            try:
+                from mcp.server.fastmcp import FastMCP
+            except ImportError as e:
+                log_to_stderr(f"Error importing FastMCP: {e}")
+                return None
+            self._server = FastMCP(self.name)
+            for func, args, kwargs in self._tools:
+                self._server.tool(*args, **kwargs)(func)
+        return self._server
+    
+    def run(self):
+        server = self.server()
+        if server is None:
+            log_to_stderr("Failed to create MCP server")
+            sys.exit(1)
+        log_to_stderr("DiffuGen ready")
+        server.run()
+
+mcp = LazyMCP("DiffuGen")
+
+class LazyGlobal:
+    """A module global built by factory() on first use, and the same object after that.
+    
+    Like LazyMCP, this keeps importing diffugen free of work: the configuration is
+    read, and the queues, caches and background helpers built from it, only when
+    a generation, server or tool first touches them. Attribute and item access,
+    iteration and membership tests go to the built object."""
     
-    mcp = FallbackMCP("DiffuGen")
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_lock", threading.RLock())
+        object.__setattr__(self, "_built", False)
+        object.__setattr__(self, "_value", None)
+    
+    def _get(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    object.__setattr__(self, "_value", self._factory())
+                    object.__setattr__(self, "_built", True)
+        return self._value
+    
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+    
+    def __setattr__(self, name, value):
+        setattr(self._get(), name, value)
+    
+    def __getitem__(self, key):
+        return self._get()[key]
+    
+    def __setitem__(self, key, value):
+        self._get()[key] = value
+    
+    def __contains__(self, key):
+        return key in self._get()
+    
+    def __iter__(self):
+        return iter(self._get())
+    
+    def __len__(self):
+        return len(self._get())
+    
+    def __bool__(self):
+        return bool(self._get())
+    
+    def __repr__(self):
+        return repr(self._value) if self._built else "<LazyGlobal, not built yet>"
 
-if mcp is None:
-    log_to_stderr("Failed to create MCP server")
-    sys.exit(1)
+def _default_data_dir():
+    """Per-user directory for DiffuGen's databases, independent of the working directory"""
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), "AppData", "Local")
+    else:
+        base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "diffugen")
 
 # Function to load configuration
 def load_config():
@@ -124,6 +300,26 @@ def load_config():
         "default_model": None,  # No default model, will be determined by function
         "vram_usage": "adaptive",
         "gpu_layers": -1,
+        "model_settings": {},  # Per-model hardware overrides, see get_model_settings
+        "cpu": {},  # sd.cpp thread budget and core/NUMA pinning, see diffugen_cpu.plan_cpu
+        "timeouts": {},  # Generation time limits and hung-process watchdog, see get_generation_timeouts
+        "scheduling": {},  # Fair queuing priority classes, see diffugen_fairqueue
+        "hires": {},  # Two-pass hi-res generation, see plan_hires
+        "memory": {},  # Per-run memory-saving flags, see diffugen_memory.plan_memory
+        "variants": {},  # Quantized model variants, see get_variant_path
+        "warmup": {},  # Page-cache prefetch and warm-up runs for hot models, see diffugen_warmup
+        "sweep": {},  # Parameter sweep limits, see diffugen_sweep
+        "webhooks": {},  # Job completion webhooks, see diffugen_webhooks
+        "load_shedding": {},  # Queue limits for busy rejections with Retry-After, see diffugen_loadshed
+        "speculation": {},  # Pre-rendering follow-up images in idle GPU time, see diffugen_speculate
+        "lock_dir": os.path.join(tempfile.gettempdir(), "diffugen"),  # Shared by every DiffuGen process
+        "data_dir": _default_data_dir(),  # Job store and usage ledger, shared by every DiffuGen process
+        "max_concurrent": 1,  # Generations allowed to run at once across all processes
+        "queue_timeout": 0,  # Seconds to wait for a free slot before reporting busy
+        "broker": None,  # Job broker URL: memory, sqlite:///path/jobs.db or redis://host:6379/0 (None for jobs.db in data_dir)
+        "local_workers": None,  # Job worker threads in this process (0 for API-only nodes, None for the default, see get_local_workers)
+        "job_lease_seconds": 120,  # A running job without a worker heartbeat for this long is failed
+        "job_retention_days": 7,  # Finished jobs stay queryable this long (0 keeps them forever)
         "default_params": {
             "width": 512,
             "height": 512,
@@ -162,6 +358,82 @@ def load_config():
         config["vram_usage"] = os.environ.get("DIFFUGEN_VRAM_USAGE")
         logging.info(f"Using vram_usage from environment: {config['vram_usage']}")
     
+    if "DIFFUGEN_LOCK_DIR" in os.environ:
+        config["lock_dir"] = os.path.normpath(os.environ.get("DIFFUGEN_LOCK_DIR"))
+        logging.info(f"Using lock_dir from environment: {config['lock_dir']}")
+    
+    if "DIFFUGEN_DATA_DIR" in os.environ:
+        config["data_dir"] = os.path.normpath(os.environ.get("DIFFUGEN_DATA_DIR"))
+        logging.info(f"Using data_dir from environment: {config['data_dir']}")
+    
+    if "DIFFUGEN_MAX_CONCURRENT" in os.environ:
+        config["max_concurrent"] = int(os.environ.get("DIFFUGEN_MAX_CONCURRENT"))
+        logging.info(f"Using max_concurrent from environment: {config['max_concurrent']}")
+    
+    if "DIFFUGEN_QUEUE_TIMEOUT" in os.environ:
+        config["queue_timeout"] = float(os.environ.get("DIFFUGEN_QUEUE_TIMEOUT"))
+        logging.info(f"Using queue_timeout from environment: {config['queue_timeout']}")
+    
+    if "DIFFUGEN_BROKER" in os.environ:
+        config["broker"] = os.environ.get("DIFFUGEN_BROKER")
+        logging.info(f"Using broker from environment: {config['broker']}")
+    
+    if "DIFFUGEN_LOCAL_WORKERS" in os.environ:
+        config["local_workers"] = int(os.environ.get("DIFFUGEN_LOCAL_WORKERS"))
+        logging.info(f"Using local_workers from environment: {config['local_workers']}")
+    
+    if "DIFFUGEN_JOB_LEASE_SECONDS" in os.environ:
+        config["job_lease_seconds"] = float(os.environ.get("DIFFUGEN_JOB_LEASE_SECONDS"))
+        logging.info(f"Using job_lease_seconds from environment: {config['job_lease_seconds']}")
+    
+    if "DIFFUGEN_JOB_RETENTION_DAYS" in os.environ:
+        config["job_retention_days"] = float(os.environ.get("DIFFUGEN_JOB_RETENTION_DAYS"))
+        logging.info(f"Using job_retention_days from environment: {config['job_retention_days']}")
+    
+    cpu_env = {
+        "DIFFUGEN_SD_THREADS": "threads",
+        "DIFFUGEN_CPU_AFFINITY": "affinity",
+        "DIFFUGEN_RESERVED_CORES": "reserved_cores",
+        "DIFFUGEN_NUMA_NODE": "numa_node"
+    }
+    for env_name, key in cpu_env.items():
+        if env_name in os.environ:
+            value = os.environ.get(env_name)
+            config["cpu"][key] = int(value) if key in ("threads", "numa_node") else value
+            logging.info(f"Using cpu {key} from environment: {value}")
+    
+    webhook_env = {
+        "DIFFUGEN_WEBHOOK_SECRET": "secret",
+        "DIFFUGEN_PUBLIC_URL": "public_url"
+    }
+    for env_name, key in webhook_env.items():
+        if env_name in os.environ:
+            config["webhooks"][key] = os.environ.get(env_name)
+            logging.info(f"Using webhooks {key} from environment")
+    
+    timeout_env = {
+        "DIFFUGEN_TIMEOUT_BASE": "base_seconds",
+        "DIFFUGEN_TIMEOUT_PER_STEP_MP": "seconds_per_step_megapixel",
+        "DIFFUGEN_IDLE_TIMEOUT": "idle_seconds"
+    }
+    for env_name, key in timeout_env.items():
+        if env_name in os.environ:
+            config["timeouts"][key] = float(os.environ.get(env_name))
+            logging.info(f"Using timeout {key} from environment: {config['timeouts'][key]}")
+    
+    load_shedding_env = {
+        "DIFFUGEN_MAX_QUEUE": "max_queue",
+        "DIFFUGEN_MAX_WAIT_SECONDS": "max_wait_seconds"
+    }
+    for env_name, key in load_shedding_env.items():
+        if env_name in os.environ:
+            config["load_shedding"][key] = float(os.environ.get(env_name))
+            logging.info(f"Using load_shedding {key} from environment: {config['load_shedding'][key]}")
+    
+    if "DIFFUGEN_SPECULATION" in os.environ:
+        config["speculation"]["enabled"] = os.environ.get("DIFFUGEN_SPECULATION").lower() in ("1", "true", "yes")
+        logging.info(f"Using speculation enabled from environment: {config['speculation']['enabled']}")
+    
     # Try to read from diffugen.json configuration (second priority)
     try:
         diffugen_json_path = os.path.join(os.getcwd(), "diffugen.json")
@@ -203,10 +475,108 @@ def load_config():
                         if 'gpu_layers' in resources:
                             config['gpu_layers'] = resources['gpu_layers']
                             logging.info(f"Using gpu_layers from diffugen.json: {config['gpu_layers']}")
+                        
+                        if 'lock_dir' in resources and 'DIFFUGEN_LOCK_DIR' not in os.environ:
+                            config['lock_dir'] = os.path.normpath(resources['lock_dir'])
+                            logging.info(f"Using lock_dir from diffugen.json: {config['lock_dir']}")
+                        
+                        if 'data_dir' in resources and 'DIFFUGEN_DATA_DIR' not in os.environ:
+                            config['data_dir'] = os.path.normpath(resources['data_dir'])
+                            logging.info(f"Using data_dir from diffugen.json: {config['data_dir']}")
+                        
+                        if 'max_concurrent' in resources and 'DIFFUGEN_MAX_CONCURRENT' not in os.environ:
+                            config['max_concurrent'] = int(resources['max_concurrent'])
+                            logging.info(f"Using max_concurrent from diffugen.json: {config['max_concurrent']}")
+                        
+                        if 'queue_timeout' in resources and 'DIFFUGEN_QUEUE_TIMEOUT' not in os.environ:
+                            config['queue_timeout'] = float(resources['queue_timeout'])
+                            logging.info(f"Using queue_timeout from diffugen.json: {config['queue_timeout']}")
+                        
+                        if 'broker' in resources and 'DIFFUGEN_BROKER' not in os.environ:
+                            config['broker'] = resources['broker']
+                            logging.info(f"Using broker from diffugen.json: {config['broker']}")
+                        
+                        if 'local_workers' in resources and 'DIFFUGEN_LOCAL_WORKERS' not in os.environ:
+                            config['local_workers'] = int(resources['local_workers'])
+                            logging.info(f"Using local_workers from diffugen.json: {config['local_workers']}")
+                        
+                        if 'job_lease_seconds' in resources and 'DIFFUGEN_JOB_LEASE_SECONDS' not in os.environ:
+                            config['job_lease_seconds'] = float(resources['job_lease_seconds'])
+                            logging.info(f"Using job_lease_seconds from diffugen.json: {config['job_lease_seconds']}")
+                        
+                        if 'job_retention_days' in resources and 'DIFFUGEN_JOB_RETENTION_DAYS' not in os.environ:
+                            config['job_retention_days'] = float(resources['job_retention_days'])
+                            logging.info(f"Using job_retention_days from diffugen.json: {config['job_retention_days']}")
+                    
+                    # Extract CPU thread budget and pinning; environment variables take precedence
+                    if 'cpu' in server_config:
+                        for key, value in server_config['cpu'].items():
+                            config['cpu'].setdefault(key, value)
+                        logging.info(f"Using cpu settings from diffugen.json: {config['cpu']}")
+                    
+                    # Extract fair queuing priority classes
+                    if 'scheduling' in server_config:
+                        config['scheduling'] = server_config['scheduling']
+                        logging.info(f"Using scheduling settings from diffugen.json: {config['scheduling']}")
+                    
+                    # Extract two-pass hi-res settings
+                    if 'hires' in server_config:
+                        config['hires'] = server_config['hires']
+                        logging.info(f"Using hires settings from diffugen.json: {config['hires']}")
+                    
+                    # Extract memory planning settings
+                    if 'memory' in server_config:
+                        config['memory'] = server_config['memory']
+                        logging.info(f"Using memory settings from diffugen.json: {config['memory']}")
+                    
+                    # Extract quantized variant settings
+                    if 'variants' in server_config:
+                        config['variants'] = server_config['variants']
+                        logging.info(f"Using variants settings from diffugen.json: {config['variants']}")
+                    
+                    # Extract cold-start warm-up settings
+                    if 'warmup' in server_config:
+                        config['warmup'] = server_config['warmup']
+                        logging.info(f"Using warmup settings from diffugen.json: {config['warmup']}")
+                    
+                    # Extract parameter sweep settings
+                    if 'sweep' in server_config:
+                        config['sweep'] = server_config['sweep']
+                        logging.info(f"Using sweep settings from diffugen.json: {config['sweep']}")
+                    
+                    # Extract completion webhook settings; environment variables take precedence
+                    if 'webhooks' in server_config:
+                        for key, value in server_config['webhooks'].items():
+                            config['webhooks'].setdefault(key, value)
+                        logging.info(f"Using webhooks settings from diffugen.json: {', '.join(server_config['webhooks'])}")
+                    
+                    # Extract generation timeouts; environment variables take precedence
+                    if 'timeouts' in server_config:
+                        for key, value in server_config['timeouts'].items():
+                            config['timeouts'].setdefault(key, value)
+                        logging.info(f"Using timeouts from diffugen.json: {config['timeouts']}")
+                    
+                    # Extract load shedding limits; environment variables take precedence
+                    if 'load_shedding' in server_config:
+                        for key, value in server_config['load_shedding'].items():
+                            config['load_shedding'].setdefault(key, value)
+                        logging.info(f"Using load_shedding from diffugen.json: {config['load_shedding']}")
+                    
+                    # Extract speculative pre-generation settings; environment variables take precedence
+                    if 'speculation' in server_config:
+                        for key, value in server_config['speculation'].items():
+                            config['speculation'].setdefault(key, value)
+                        logging.info(f"Using speculation from diffugen.json: {config['speculation']}")
+                    
+                    # Extract per-model hardware settings (written by diffugen_autotune.py)
+                    if 'model_settings' in server_config:
+                        config['model_settings'] = server_config['model_settings']
+                        logging.info(f"Loaded model_settings for: {', '.join(config['model_settings'])}")
                     
                     # Extract default_params
                     if 'default_params' in server_config:
-                        config['default_params'] = server_config['default_params']
+                        # Merged over the built-in defaults, so a file without width/height keeps 512x512
+                        config['default_params'].update(server_config['default_params'])
                         logging.info("Loaded default_params from diffugen.json")
     except Exception as e:
         logging.warning(f"Error loading diffugen.json configuration: {e}")
@@ -215,17 +585,61 @@ def load_config():
     if not config["models_dir"]:
         config["models_dir"] = os.path.join(config["sd_cpp_path"], "models")
     
+    # The job store lives in data_dir, so processes started from different directories share it
+    if not config["broker"]:
+        config["broker"] = "sqlite:///" + os.path.abspath(os.path.join(config["data_dir"], "jobs.db"))
+    
     return config
 
-# Load the configuration
-config = load_config()
+# The configuration, loaded on first use
+config = LazyGlobal(load_config)
+
+def get_sd_cpp_path():
+    return os.path.normpath(config["sd_cpp_path"])
+
+def get_default_output_dir():
+    return os.path.normpath(config["output_dir"])
+
+def __getattr__(name):
+    # sd_cpp_path and default_output_dir were module globals; they come from the configuration
+    if name == "sd_cpp_path":
+        return get_sd_cpp_path()
+    if name == "default_output_dir":
+        return get_default_output_dir()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# The output directory is created by the first generation that writes to it
+metrics.watch_output_dir(get_default_output_dir)
 
-# Core path initialization (using the config we loaded)
-sd_cpp_path = os.path.normpath(config["sd_cpp_path"])
-default_output_dir = os.path.normpath(config["output_dir"])
+# Create global generation queue
+generation_queue = LazyGlobal(lambda: GenerationQueue(config["lock_dir"], config["max_concurrent"]))
+# Predicts the wait for a slot, to shed requests early with a Retry-After hint
+load_tracker = LazyGlobal(lambda: LoadTracker(config["max_concurrent"], config["load_shedding"]))
+fair_policy = LazyGlobal(lambda: FairPolicy(config["scheduling"]))
+# Learns generation latency from completed generations, for queue ETAs
+latency_model = LatencyModel()
+# Quantized model variants converted with sd.cpp, see get_variant_path
+variant_cache = LazyGlobal(lambda: VariantCache(
+    config["variants"].get("cache_dir") or os.path.join(config["models_dir"], "variants"),
+    os.path.join(get_sd_cpp_path(), "build", "bin", "sd"),
+    config["variants"].get("convert_timeout", 3600)
+))
+
+# Other accepted spellings of the model names
+MODEL_ALIASES = {
+    "sdxl-1.0": "sdxl", "sdxl1.0": "sdxl",
+    "sd3-medium": "sd3",
+    "sd1.5": "sd15", "sd-1.5": "sd15",
+    "flux_schnell": "flux-schnell", "fluxschnell": "flux-schnell", "flux1-schnell": "flux-schnell",
+    "flux_dev": "flux-dev", "fluxdev": "flux-dev", "flux1-dev": "flux-dev",
+}
+# The model each generate tool uses when none is given
+TOOL_DEFAULT_MODELS = {"stable": "sd15", "flux": "flux-schnell"}
 
-# Create output directory
-os.makedirs(default_output_dir, exist_ok=True)
+def resolve_model(model, tool=None):
+    """The model a generate tool ("stable" or "flux") will actually run for a requested model name"""
+    model = (model or TOOL_DEFAULT_MODELS.get(tool) or config["default_model"] or "flux-schnell").lower()
+    return MODEL_ALIASES.get(model, model)
 
 # Helper functions to get model-specific parameters from config
 def get_default_steps(model):
@@ -277,6 +691,7 @@ def get_default_sampling_method(model=None):
 # Lazy-loaded model paths - only resolved when needed
 _model_paths = {}
 _supporting_files = {}
+_last_generated = {}  # model -> time of its last successful generation here
 
 def get_model_path(model_name):
     """Lazy-load model paths only when needed"""
@@ -301,18 +716,836 @@ def get_supporting_file(file_name):
             "vae": os.path.join(models_dir, "ae.sft"),
             "clip_l": os.path.join(models_dir, "clip_l.safetensors"),
             "t5xxl": os.path.join(models_dir, "t5xxl_fp16.safetensors"),
-            "sdxl_vae": os.path.join(models_dir, "sdxl_vae-fp16-fix.safetensors")
+            "sdxl_vae": os.path.join(models_dir, "sdxl_vae-fp16-fix.safetensors"),
+            # ESRGAN model for hi-res upscaling
+            "upscaler": config["hires"].get("upscale_model") or os.path.join(models_dir, "RealESRGAN_x4plus.pth"),
+            # Tiny autoencoders for fast_decode, one per latent format
+            "taesd": os.path.join(models_dir, "taesd.safetensors"),
+            "taesdxl": os.path.join(models_dir, "taesdxl.safetensors"),
+            "taesd3": os.path.join(models_dir, "taesd3.safetensors"),
+            "taef1": os.path.join(models_dir, "taef1.safetensors")
         })
     return _supporting_files.get(file_name)
 
-# Minimal ready message
-log_to_stderr("DiffuGen ready")
+def get_variant_path(model, variant=None, convert=None):
+    """Weights to load for a model variant: a quantization type (q8_0, q4_0, ...) or
+    quality tier (quality, balanced, fast, fastest), defaulting to variants.default.
+    
+    Returns (path, quantization type or None). Variants are converted with sd.cpp on
+    first use unless convert (default: variants.convert_on_demand) is false; the
+    conversion stops when the thread's cancel token fires. Raises ValueError or VariantError."""
+    quant = resolve_variant(variant or config["variants"].get("default"))
+    if quant is None:
+        return get_model_path(model), None
+    if convert is None:
+        convert = config["variants"].get("convert_on_demand", True)
+    return variant_cache.get(get_model_path(model), quant, convert=convert,
+                             cancel_token=current_cancel_token()), quant
+
+def prepare_variant(model, variant=None):
+    """Convert a generation's variant if it is not cached yet, before the generation
+    waits for a slot: conversion needs no GPU but can take many minutes, and must not
+    hold a slot meanwhile. Returns an error result dict, or None"""
+    model_path = get_model_path(model)
+    if not model_path or not os.path.exists(model_path):
+        # Reported by the generation itself
+        return None
+    try:
+        get_variant_path(model, variant)
+    except ConversionCancelled as e:
+        logging.info(str(e))
+        return {"success": False, "error": str(e), "error_type": "cancelled"}
+    except (ValueError, VariantError) as e:
+        logging.error(str(e))
+        return {"success": False, "error": str(e)}
+    return None
+
+# The tiny autoencoder (TAESD) matching each model's latents
+TAESD_FILES = {"flux-schnell": "taef1", "flux-dev": "taef1", "sdxl": "taesdxl", "sd3": "taesd3", "sd15": "taesd"}
+
+def get_fast_decoder(model, fast_decode):
+    """Path of the TAESD decoder to use for a generation, or None to decode with the full VAE.
+    
+    A requested fast decode falls back to the VAE when the model's TAESD file is missing."""
+    if not fast_decode:
+        return None
+    taesd_path = get_supporting_file(TAESD_FILES.get(model, "taesd"))
+    if not os.path.exists(taesd_path):
+        logging.warning(f"TAESD decoder not found at {taesd_path}; decoding with the full VAE")
+        return None
+    return taesd_path
+
+def get_model_settings(model):
+    """Get the hardware settings for a model.
+    
+    Global vram_usage and gpu_layers apply to every model unless model_settings
+    (written by diffugen_autotune.py) overrides them for this model. With the default
+    "adaptive" vram_usage, get_generation_settings picks memory flags per run."""
+    settings = {
+        "vram_usage": config["vram_usage"],
+        "gpu_layers": config["gpu_layers"],
+        # Per-worker thread budget from the cpu section; None leaves sd.cpp's default
+        "threads": get_cpu_plan(config["cpu"], config["max_concurrent"]).threads,
+        # Flash attention has always been enabled for Flux models
+        "diffusion_fa": model.startswith("flux-"),
+        "flags": []
+    }
+    overrides = config.get("model_settings", {}).get(model, {})
+    settings.update({key: value for key, value in overrides.items() if key in settings})
+    return settings
+
+def get_model_files(model, model_path=None):
+    """Weight files sd.cpp loads for a model (or one of its variants), by component"""
+    encoders = ["clip_l", "t5xxl"] if model.startswith("flux-") else []
+    return {
+        "diffusion": [model_path or get_model_path(model)],
+        "text_encoders": [get_supporting_file(name) for name in encoders],
+        "vae": [get_supporting_file("vae")]
+    }
+
+def _weights_mb(model, model_path=None):
+    """Sizes in MB of the weights sd.cpp loads for a model (or one of its variants)"""
+    def size_mb(path):
+        return os.path.getsize(path) / 1048576 if path and os.path.exists(path) else 0.0
+    return {component: sum(size_mb(path) for path in paths)
+            for component, paths in get_model_files(model, model_path).items()}
+
+def get_generation_settings(model, width, height, batch_count=1, model_path=None):
+    """Hardware settings for one sd.cpp run, with memory-saving flags for its size.
+    
+    Returns (settings, memory), where memory records the flags chosen and the
+    estimated peak against the GPU memory available. A fixed vram_usage applies as is."""
+    settings = get_model_settings(model)
+    if settings["vram_usage"] != "adaptive":
+        return settings, {"flags": [f"--{settings['vram_usage']}"], "estimated_mb": None, "available_mb": None}
+    base_flags = settings["flags"] + (["--diffusion-fa"] if settings["diffusion_fa"] else [])
+    memory = plan_memory(model, width, height, batch_count, _weights_mb(model, model_path),
+                         available_memory_mb(config["memory"], config["max_concurrent"]), base_flags, config["memory"])
+    settings["flags"] = settings["flags"] + memory["flags"]
+    return settings, memory
+
+# Defaults for the timeouts section. The total limit grows with the work:
+# base_seconds + seconds_per_step_megapixel * steps * megapixels
+DEFAULT_TIMEOUTS = {
+    "base_seconds": 600,  # Model loading, text encoding and decoding
+    "seconds_per_step_megapixel": 60,  # Sampling time per step per million pixels
+    "idle_seconds": 300  # Watchdog: kill sd.cpp after this long without any output
+}
+
+def get_generation_timeouts(model, steps, width, height):
+    """Get the (total, idle) time limits in seconds for a generation; None means no limit.
+    
+    The timeouts section may override the defaults globally and per model under "models"."""
+    timeouts = dict(DEFAULT_TIMEOUTS)
+    timeouts.update({key: value for key, value in config["timeouts"].items() if key in DEFAULT_TIMEOUTS})
+    timeouts.update(config["timeouts"].get("models", {}).get(model, {}))
+    megapixels = width * height / 1_000_000
+    total = timeouts["base_seconds"] + timeouts["seconds_per_step_megapixel"] * steps * megapixels
+    idle = timeouts["idle_seconds"]
+    return (total if total > 0 else None), (idle if idle and idle > 0 else None)
+
+def _hardware_args(settings):
+    """Translate hardware settings into sd.cpp command line arguments"""
+    args = []
+    if settings.get("diffusion_fa"):
+        args.append("--diffusion-fa")
+    if settings.get("vram_usage", "adaptive") != "adaptive":
+        args.append(f"--{settings['vram_usage']}")
+    if settings.get("gpu_layers", -1) != -1:
+        args.extend(["--gpu-layer", str(settings["gpu_layers"])])
+    if settings.get("threads"):
+        args.extend(["--threads", str(settings["threads"])])
+    for flag in settings.get("flags", []):
+        if flag not in args:
+            args.append(flag)
+    return args
+
+def build_sd_command(model, prompt, output_path, width, height, steps, cfg_scale,
+                     sampling_method, seed, negative_prompt="", settings=None,
+                     init_image=None, strength=None, upscale_model=None, upscale_repeats=1, taesd=None,
+                     model_path=None):
+    """Build the sd.cpp command line for a normalized model name.
+    
+    settings replaces the model's configured hardware settings (see get_model_settings).
+    init_image and strength make it an img2img run; upscale_model runs an ESRGAN
+    upscale of the result upscale_repeats times. taesd decodes with that tiny
+    autoencoder instead of the VAE. model_path replaces the model's installed weights
+    (see get_variant_path)."""
+    bin_path = os.path.join(get_sd_cpp_path(), "build", "bin", "sd")
+    
+    base_command = [
+        bin_path,
+        "-p", prompt
+    ]
+    
+    if init_image:
+        base_command.extend(["-M", "img2img", "-i", init_image, "--strength", str(strength)])
+    if upscale_model:
+        base_command.extend(["--upscale-model", upscale_model, "--upscale-repeats", str(upscale_repeats)])
+    
+    # Add negative prompt if provided (SD models only)
+    if negative_prompt and not model.startswith("flux-"):
+        base_command.extend(["--negative-prompt", negative_prompt])
+        
+    # Add remaining parameters
+    base_command.extend([
+        "--cfg-scale", str(cfg_scale),
+        "--sampling-method", sampling_method,
+        "--steps", str(steps),
+        "-H", str(height),
+        "-W", str(width),
+        "-o", output_path,
+        "--seed", str(seed)
+    ])
+    
+    # Add model-specific paths
+    base_command.extend(["--diffusion-model", model_path or get_model_path(model)])
+    
+    vae_path = get_supporting_file("vae")
+    if vae_path:
+        base_command.extend(["--vae", vae_path])
+    if taesd:
+        base_command.extend(["--taesd", taesd])
+    
+    if model.startswith("flux-"):
+        # Get supporting files for Flux
+        clip_l_path = get_supporting_file("clip_l")
+        t5xxl_path = get_supporting_file("t5xxl")
+        
+        if clip_l_path:
+            base_command.extend(["--clip_l", clip_l_path])
+            
+        if t5xxl_path:
+            base_command.extend(["--t5xxl", t5xxl_path])
+    else:
+        clip_path = get_supporting_file("clip")
+        t5xxl_path = get_supporting_file("t5xxl")
+        
+        if model == "sdxl":
+            if clip_path and t5xxl_path:
+                base_command.extend(["--clip", clip_path])
+                base_command.extend(["--t5xxl", t5xxl_path])
+        elif model == "sd15":
+            if clip_path:
+                base_command.extend(["--clip", clip_path])
+    
+    # Add GPU and memory usage settings
+    base_command.extend(_hardware_args(settings if settings is not None else get_model_settings(model)))
+    return base_command
+
+# Two-pass hi-res: generate at the model's native resolution, then upscale or refine to the target size
+HIRES_MODES = ("upscale", "refine")
+NATIVE_RESOLUTIONS = {"flux-schnell": 1024, "flux-dev": 1024, "sdxl": 1024, "sd3": 1024, "sd15": 512}
+DEFAULT_HIRES = {
+    "upscale_scale": 4,  # Scale factor of the ESRGAN upscale model
+    "refine_strength": 0.35,  # img2img denoising strength of the refine pass
+}
+
+def _round_to_64(value):
+    return max(64, int(round(value / 64)) * 64)
+
+def plan_hires(model, width, height, mode, strength=None):
+    """Plan a two-pass hi-res generation of a width x height image.
+    
+    Returns None when the target is no larger than the model's native resolution.
+    Otherwise returns the first pass size, which has the model's native area and the
+    target's aspect ratio, and the second pass: an ESRGAN upscale, repeated until the
+    image covers the target and then resized to it, or a low-strength img2img refine
+    at the target size."""
+    settings = dict(DEFAULT_HIRES, **config["hires"])
+    native = settings.get("native_resolution", {}).get(model, NATIVE_RESOLUTIONS.get(model, 512))
+    factor = math.sqrt(width * height) / native
+    if factor <= 1:
+        return None
+    base_width, base_height = _round_to_64(width / factor), _round_to_64(height / factor)
+    if mode == "upscale":
+        scale = int(settings["upscale_scale"])
+        repeats = 1
+        while base_width * scale ** repeats < width or base_height * scale ** repeats < height:
+            repeats += 1
+        return {"mode": mode, "base_width": base_width, "base_height": base_height, "width": width, "height": height,
+                "upscaled_width": base_width * scale ** repeats, "upscaled_height": base_height * scale ** repeats,
+                "upscale_repeats": repeats}
+    return {"mode": mode, "base_width": base_width, "base_height": base_height, "width": width, "height": height,
+            "strength": float(strength if strength is not None else settings["refine_strength"])}
+
+def _resize_image(path, width, height):
+    """Resize an image file in place to exactly width x height"""
+    with Image.open(path) as image:
+        resized = image.resize((width, height), Image.LANCZOS)
+    resized.save(path)
+
+def _prepare_hires(model, prompt, output_path, width, height, steps, cfg_scale, sampling_method, seed,
+                   hires, hires_strength=None, negative_prompt="", taesd=None, model_path=None):
+    """Build the sd.cpp commands for a generation that may use two-pass hi-res.
+    
+    Returns (base_command, refine_command, plan, memory) or an error result dict, where
+    memory records the memory-saving flags chosen for each run (see get_generation_settings)."""
+    if hires and hires not in HIRES_MODES:
+        return {"success": False, "error": f"Invalid hires mode: {hires}. Use one of: {', '.join(HIRES_MODES)}"}
+    plan = plan_hires(model, width, height, hires, hires_strength) if hires else None
+    if plan is None:
+        settings, memory = get_generation_settings(model, width, height, model_path=model_path)
+        return build_sd_command(model, prompt, output_path, width, height, steps, cfg_scale, sampling_method, seed,
+                                negative_prompt=negative_prompt, settings=settings, taesd=taesd,
+                                model_path=model_path), None, None, memory
+    logging.info(f"Hi-res {plan['mode']}: {plan['base_width']}x{plan['base_height']} -> {plan['width']}x{plan['height']}")
+    if plan["mode"] == "upscale":
+        upscaler = get_supporting_file("upscaler")
+        if not os.path.exists(upscaler):
+            return {"success": False, "error": f"Upscale model not found at {upscaler}. Download an ESRGAN model "
+                                               "(e.g. RealESRGAN_x4plus.pth) or set hires.upscale_model"}
+        if Image is None and (plan["upscaled_width"], plan["upscaled_height"]) != (width, height):
+            return {"success": False, "error": f"Upscaling to {width}x{height} needs Pillow to resize the "
+                                               f"{plan['upscaled_width']}x{plan['upscaled_height']} upscale: "
+                                               "pip install pillow, or use hires=refine"}
+        settings, memory = get_generation_settings(model, plan["base_width"], plan["base_height"],
+                                                   model_path=model_path)
+        base_command = build_sd_command(model, prompt, output_path, plan["base_width"], plan["base_height"], steps,
+                                        cfg_scale, sampling_method, seed, negative_prompt=negative_prompt,
+                                        settings=settings, upscale_model=upscaler,
+                                        upscale_repeats=plan["upscale_repeats"], taesd=taesd, model_path=model_path)
+        return base_command, None, plan, memory
+    # The first pass writes next to the final image and is removed once refined
+    plan["base_path"] = os.path.splitext(output_path)[0] + "_base.png"
+    base_settings, base_memory = get_generation_settings(model, plan["base_width"], plan["base_height"],
+                                                         model_path=model_path)
+    base_command = build_sd_command(model, prompt, plan["base_path"], plan["base_width"], plan["base_height"], steps,
+                                    cfg_scale, sampling_method, seed, negative_prompt=negative_prompt,
+                                    settings=base_settings, taesd=taesd, model_path=model_path)
+    settings, memory = get_generation_settings(model, width, height, model_path=model_path)
+    refine_command = build_sd_command(model, prompt, output_path, width, height, steps, cfg_scale, sampling_method,
+                                      seed, negative_prompt=negative_prompt, settings=settings,
+                                      init_image=plan["base_path"], strength=plan["strength"], taesd=taesd,
+                                      model_path=model_path)
+    return base_command, refine_command, plan, dict(memory, passes={"base": base_memory, "refine": memory})
+
+class GenerationCancelled(Exception):
+    """Raised when a generation's cancel token fires while sd.cpp is running"""
+
+class GenerationTimeout(Exception):
+    """Raised when sd.cpp exceeds its time limit or stops producing output"""
+    
+    def __init__(self, kind, seconds):
+        self.kind = kind
+        self.seconds = seconds
+        if kind == "idle":
+            super().__init__(f"sd.cpp produced no output for {seconds:.0f}s and was stopped")
+        else:
+            super().__init__(f"Generation exceeded its {seconds:.0f}s time limit and was stopped")
+
+_cancel_state = threading.local()
+
+@contextmanager
+def cancel_scope(token, wait_for_slot=False):
+    """Make token the cancel token for generations run by this thread.
+    
+    With wait_for_slot, generations wait for a free generation slot (until cancelled)
+    instead of giving up after queue_timeout."""
+    previous = (getattr(_cancel_state, "token", None), getattr(_cancel_state, "wait_for_slot", False))
+    _cancel_state.token = token
+    _cancel_state.wait_for_slot = wait_for_slot
+    try:
+        yield token
+    finally:
+        _cancel_state.token, _cancel_state.wait_for_slot = previous
+
+def current_cancel_token():
+    return getattr(_cancel_state, "token", None)
+
+_tenant_state = threading.local()
+
+@contextmanager
+def tenant_scope(tenant, priority=None, weight=1.0, cost=1.0, queued_since=None):
+    """Attribute generations run by this thread to a tenant and priority class for fair queuing.
+    
+    weight is the tenant's weight and cost the request's estimated work (see estimate_work)."""
+    previous = getattr(_tenant_state, "request", None)
+    _tenant_state.request = {
+        "flow": (tenant or DEFAULT_TENANT, fair_policy.priority(priority)),
+        "weight": fair_policy.weight(priority, weight),
+        "cost": cost,
+        "queued_since": queued_since
+    }
+    try:
+        yield
+    finally:
+        _tenant_state.request = previous
+
+_latency_state = threading.local()
+
+@contextmanager
+def latency_sampling(enabled):
+    """Whether generations run by this thread teach the latency model (warm-up runs do not)"""
+    previous = getattr(_latency_state, "enabled", True)
+    _latency_state.enabled = enabled
+    try:
+        yield
+    finally:
+        _latency_state.enabled = previous
+
+@contextmanager
+def work_scope(cost):
+    """Queue generations run by this thread in the block at the fair gate with cost as their
+    estimated work, keeping the thread's tenant and priority class"""
+    previous = getattr(_tenant_state, "request", None)
+    if previous is not None:
+        _tenant_state.request = dict(previous, cost=cost)
+    try:
+        yield
+    finally:
+        _tenant_state.request = previous
+
+_slot_state = threading.local()
+
+def _with_defaults(model, steps, width, height):
+    model = resolve_model(model)
+    return (model, steps or get_default_steps(model), width or config["default_params"]["width"],
+            height or config["default_params"]["height"])
+
+def estimate_work(model, steps=None, width=None, height=None, hires=None):
+    """Estimated work of a generation: steps x megapixels, with the model's defaults filled in.
+    
+    A hi-res generation counts its first pass, plus the steps a refine pass actually
+    runs at the target size (an ESRGAN upscale is comparatively free)."""
+    model, steps, width, height = _with_defaults(model, steps, width, height)
+    plan = plan_hires(model, width, height, hires) if hires in HIRES_MODES else None
+    if plan is None:
+        return steps * width * height / 1_000_000
+    work = steps * plan["base_width"] * plan["base_height"] / 1_000_000
+    if plan["mode"] == "refine":
+        work += steps * plan["strength"] * width * height / 1_000_000
+    return work
+
+def predict_generation_seconds(model, steps=None, width=None, height=None, hires=None):
+    """Predicted sd.cpp run time of a generation, from the learned latency model"""
+    model, steps, width, height = _with_defaults(model, steps, width, height)
+    plan = plan_hires(model, width, height, hires) if hires in HIRES_MODES else None
+    if plan is None:
+        return latency_model.predict(model, steps, width, height)
+    seconds = latency_model.predict(model, steps, plan["base_width"], plan["base_height"])
+    if plan["mode"] == "refine":
+        seconds += latency_model.predict(model, max(1, round(steps * plan["strength"])), width, height)
+    return seconds
+
+def _busy_message(shed):
+    retry = f"Please retry in about {shed['retry_after']} seconds."
+    if shed["reason"] == QUEUE_FULL:
+        return f"The generation queue is full ({shed['waiting']} requests waiting). {retry}"
+    if shed["reason"] == WAIT_TOO_LONG:
+        return f"The predicted wait for a free generation slot is {shed['predicted_wait']:.0f}s. {retry}"
+    return f"Another image generation is already in progress. {retry}"
+
+def busy_result(shed):
+    """The busy error result for a shed request (see LoadTracker.check), with its retry hint"""
+    metrics.BUSY_REJECTIONS.inc(reason=shed["reason"])
+    return {"success": False, "error": _busy_message(shed), "error_type": "busy", "retry_after": shed["retry_after"]}
+
+def check_load_shedding():
+    """None if a new generation request may queue for a slot, else its busy error result"""
+    shed = load_tracker.check()
+    return busy_result(shed) if shed else None
+
+def _acquire_generation_slot(predicted_seconds=None):
+    """Acquire a generation slot for this thread. Returns None on success, or the error result.
+    
+    predicted_seconds is the generation's predicted run time, for load shedding."""
+    token = current_cancel_token()
+    timeout = None if token is not None and getattr(_cancel_state, "wait_for_slot", False) else config["queue_timeout"]
+    if timeout is not None:
+        # Callers that wait (jobs, HTTP requests) were admitted before they got here
+        busy = check_load_shedding()
+        if busy:
+            return busy
+    request = getattr(_tenant_state, "request", None) or {
+        "flow": (DEFAULT_TENANT, fair_policy.default_class), "weight": fair_policy.weight(None),
+        "cost": 1.0, "queued_since": None
+    }
+    entry = load_tracker.enter(predicted_seconds)
+    if generation_queue.acquire(timeout=timeout, cancel_token=token, flow=request["flow"], cost=request["cost"],
+                                weight=request["weight"], queued_since=request["queued_since"]):
+        load_tracker.start(entry)
+        _slot_state.entry = entry
+        return None
+    load_tracker.leave(entry)
+    if token is not None and token.cancelled:
+        metrics.CANCELLATIONS.inc(reason=token.reason)
+        return {"success": False, "error": "Generation cancelled", "error_type": "cancelled"}
+    return busy_result({"reason": "timeout", "retry_after": load_tracker.retry_after()})
+
+def _release_generation_slot():
+    """Release the slot taken by _acquire_generation_slot"""
+    load_tracker.leave(getattr(_slot_state, "entry", None))
+    _slot_state.entry = None
+    generation_queue.release()
+
+def _terminate_process_group(process, grace=3.0):
+    """Stop sd.cpp and anything it started (e.g. a numactl wrapper), escalating to SIGKILL.
+    
+    Never blocks, since cancel callbacks may run on the server's event loop."""
+    if process.poll() is not None:
+        return
+    if hasattr(os, "killpg"):
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        
+        def kill_if_alive():
+            if process.poll() is None:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        timer = threading.Timer(grace, kill_if_alive)
+        timer.daemon = True
+        timer.start()
+    else:
+        process.kill()
+
+# sd.cpp runs in its own session, so it no longer receives the terminal's Ctrl-C;
+# stop any still-running generations when this process exits
+_active_processes = set()
+
+def _terminate_active_processes():
+    for process in list(_active_processes):
+        _terminate_process_group(process, grace=0)
+
+atexit.register(_terminate_active_processes)
+
+def _run_sd_process(base_command, model, trace, timeout=None, idle_timeout=None):
+    """Run an sd.cpp command, timestamping the spawn, every output line and the exit.
+    
+    Timestamps are collected in trace["events"] and trace["lines"] so they remain
+    available to the caller when the process fails. sd.cpp runs in its own process
+    group, which is terminated if this thread's cancel token fires, if it runs longer
+    than timeout seconds, or if it prints nothing for idle_timeout seconds."""
+    events = trace.setdefault("events", {})
+    timed_lines = trace.setdefault("lines", [])
+    cpu_plan = get_cpu_plan(config["cpu"], config["max_concurrent"])
+    token = current_cancel_token()
+    if token is not None and token.cancelled:
+        raise GenerationCancelled(token.reason)
+    events["spawn_start"] = time.time()
+    with cpu_plan.pinned():
+        process = subprocess.Popen(
+            cpu_plan.wrap_command(base_command),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            start_new_session=True
+        )
+    events["spawned"] = time.time()
+    _active_processes.add(process)
+    remove_cancel_callback = token.add_callback(lambda: _terminate_process_group(process)) if token else None
+    
+    stdout_lines = []
+    stderr_lines = []
+    
+    def read_stream(stream, sink):
+        # Text mode translates sd.cpp's carriage-return progress updates into separate lines
+        for line in stream:
+            now = time.time()
+            sink.append(line)
+            timed_lines.append((now, line))
+        stream.close()
+    
+    readers = [
+        threading.Thread(target=read_stream, args=(process.stdout, stdout_lines), daemon=True),
+        threading.Thread(target=read_stream, args=(process.stderr, stderr_lines), daemon=True)
+    ]
+    for reader in readers:
+        reader.start()
+    timed_out = None
+    try:
+        while True:
+            try:
+                returncode = process.wait(timeout=1.0)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            # Watchdog: sd.cpp reports progress on every step, so silence means it is wedged
+            now = time.time()
+            last_output = timed_lines[-1][0] if timed_lines else events["spawned"]
+            if timeout is not None and now - events["spawned"] > timeout:
+                timed_out = GenerationTimeout("total", timeout)
+            elif idle_timeout is not None and now - last_output > idle_timeout:
+                timed_out = GenerationTimeout("idle", idle_timeout)
+            if timed_out:
+                logging.error(f"Stopping sd.cpp (PID {process.pid}): {timed_out}")
+                _terminate_process_group(process)
+                returncode = process.wait()
+                break
+        for reader in readers:
+            reader.join()
+    except BaseException:
+        # Interrupted (e.g. Ctrl-C on the CLI): don't leave sd.cpp running in its own session
+        _terminate_process_group(process, grace=0)
+        raise
+    finally:
+        _active_processes.discard(process)
+        if remove_cancel_callback:
+            remove_cancel_callback()
+        events["exited"] = time.time()
+        metrics.SUBPROCESS_SECONDS.observe(events["exited"] - events["spawn_start"], model=model)
+    
+    stdout = "".join(stdout_lines)
+    stderr = "".join(stderr_lines)
+    if token is not None and token.cancelled:
+        raise GenerationCancelled(token.reason)
+    if timed_out:
+        raise timed_out
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, base_command, stdout, stderr)
+    return subprocess.CompletedProcess(base_command, returncode, stdout, stderr)
+
+# sd.cpp log lines that report how long each pipeline stage took
+_SD_PHASE_PATTERNS = [
+    # (phase, pattern, multiplier to seconds)
+    ("tensor_load", re.compile(r"loading tensors completed, taking ([\d.]+)\s*s"), 1.0),
+    ("model_load", re.compile(r"loading model from .* completed, taking ([\d.]+)\s*s"), 1.0),
+    ("text_encode", re.compile(r"get_learned_condition completed, taking ([\d.]+)\s*ms"), 0.001),
+    ("sampling", re.compile(r"sampling completed, taking ([\d.]+)\s*s"), 1.0),
+    ("latent_decode", re.compile(r"decode_first_stage completed, taking ([\d.]+)\s*s"), 1.0),
+    ("decode", re.compile(r"decoding \d+ latents completed, taking ([\d.]+)\s*s"), 1.0),
+    ("upscale", re.compile(r"upscaled, taking ([\d.]+)\s*s"), 1.0),
+    ("sd_total", re.compile(r"(?:txt2img|img2img|generate_image) completed in ([\d.]+)\s*s"), 1.0),
+]
+# Phases some sd.cpp versions also report in parts (tensor loading within model loading, one
+# decode per latent): the whole is used when it is printed, otherwise the sum of its parts
+_SD_PHASE_PARTS = {"tensor_load": "model_load", "latent_decode": "decode"}
+_SD_PROGRESS_PATTERN = re.compile(r"\|\s*(\d+)/(\d+)\s*-\s*([\d.]+)\s*(s/it|it/s)")
+# The last stage that produces the image: VAE decode, or the ESRGAN upscale after it
+_SD_DECODE_DONE_PATTERN = re.compile(r"decod\w* .*completed|upscaled, taking")
+
+def _parse_sd_timings(timed_lines):
+    """Extract per-phase durations (in seconds) from sd.cpp's log output"""
+    timings = {}
+    decode_done_at = None
+    for timestamp, line in timed_lines:
+        for phase, pattern, scale in _SD_PHASE_PATTERNS:
+            match = pattern.search(line)
+            if match:
+                # Batches report one line per image, so sum repeated phases
+                timings[phase] = timings.get(phase, 0.0) + float(match.group(1)) * scale
+                break
+        progress = _SD_PROGRESS_PATTERN.search(line)
+        if progress:
+            rate = float(progress.group(3))
+            timings["sampling_steps"] = int(progress.group(2))
+            if rate > 0:
+                timings["seconds_per_step"] = rate if progress.group(4) == "s/it" else 1.0 / rate
+        if _SD_DECODE_DONE_PATTERN.search(line):
+            decode_done_at = timestamp
+    for part, phase in _SD_PHASE_PARTS.items():
+        seconds = timings.pop(part, None)
+        if seconds is not None:
+            timings.setdefault(phase, seconds)
+    return timings, decode_done_at
+
+def _build_timings(queue_start, start_time, prepared_at, trace, finished_at):
+    """Combine wall-clock timestamps with sd.cpp's own timing output into a timings dict"""
+    events = trace.get("events", {})
+    sd_timings, decode_done_at = _parse_sd_timings(trace.get("lines", []))
+    timings = {
+        "queue_wait": start_time - queue_start,
+        "preflight": prepared_at - start_time,
+    }
+    if "spawned" in events:
+        timings["spawn"] = events["spawned"] - events["spawn_start"]
+    timings.update(sd_timings)
+    if "exited" in events:
+        timings["process_total"] = events["exited"] - events["spawn_start"]
+        # sd.cpp does not time the PNG write, so measure from the decode log line to process exit
+        if decode_done_at is not None:
+            timings["save"] = max(0.0, events["exited"] - decode_done_at)
+    timings["total"] = finished_at - queue_start
+    return {name: round(value, 3) if isinstance(value, float) else value for name, value in timings.items()}
+
+def _pass_timings(trace):
+    """sd.cpp phase timings and run time of one pass of a multi-pass generation"""
+    timings, _ = _parse_sd_timings(trace.get("lines", []))
+    events = trace.get("events", {})
+    if "exited" in events:
+        timings["process_total"] = events["exited"] - events["spawn_start"]
+    return {name: round(value, 3) if isinstance(value, float) else value for name, value in timings.items()}
+
+def _combine_pass_timings(timings, passes):
+    """Add per-pass timings and sum the phases of every pass into the top-level timings"""
+    timings = dict(timings, passes=passes)
+    for phase in ("model_load", "text_encode", "sampling", "decode", "sd_total", "process_total"):
+        total = sum(pass_timings.get(phase, 0.0) for pass_timings in passes.values())
+        if total:
+            timings[phase] = round(total, 3)
+    return timings
+
+def _execute_generation(base_command, output_path, model, sanitized_prompt, width, height,
+                        steps, cfg_scale, seed, sampling_method, queue_start, start_time,
+                        negative_prompt=None, refine_command=None, hires=None, decoder="vae", memory=None,
+                        variant=None):
+    """Run a prepared sd.cpp command and build the tool response, recording generation metrics.
+    
+    For two-pass hi-res, hires is the plan from plan_hires and refine_command the
+    img2img pass run on the first pass's image (refine mode only). decoder names
+    the autoencoder that decodes the image ("vae" or "taesd"), memory the
+    memory-saving flags chosen for the run and variant the quantization type of
+    the weights (None for the installed weights)."""
+    if hires is not None:
+        width, height = hires["width"], hires["height"]
+    resolution = f"{width}x{height}"
+    prepared_at = time.time()
+    trace = {}
+    refine_trace = {}
+    resize_seconds = None
+    
+    def timings_so_far():
+        timings = _build_timings(queue_start, start_time, prepared_at, trace, time.time())
+        if refine_trace:
+            timings = _combine_pass_timings(timings, {"base": _pass_timings(trace), "refine": _pass_timings(refine_trace)})
+        if resize_seconds is not None:
+            timings["resize"] = round(resize_seconds, 3)
+        logging.info(f"Generation timings ({model}, {resolution}): {json.dumps(timings)}")
+        return timings
+    
+    try:
+        # Run the command
+        logging.info(f"Running command: {' '.join(base_command)}")
+        
+        timeout, idle_timeout = get_generation_timeouts(model, steps, width, height)
+        result = _run_sd_process(base_command, model, trace, timeout=timeout, idle_timeout=idle_timeout)
+        if refine_command is not None:
+            logging.info(f"Running refine pass: {' '.join(refine_command)}")
+            result = _run_sd_process(refine_command, model, refine_trace, timeout=timeout, idle_timeout=idle_timeout)
+        if hires is not None and hires["mode"] == "upscale" and \
+                (hires["upscaled_width"], hires["upscaled_height"]) != (width, height):
+            # The upscaler multiplies the size by a fixed factor; bring it to the size that was asked for
+            resize_start = time.time()
+            _resize_image(output_path, width, height)
+            resize_seconds = time.time() - resize_start
+        
+        logging.info(f"Successfully generated image at: {output_path} (size: {os.path.getsize(output_path)} bytes)")
+        metrics.GENERATIONS.inc(model=model, status="success", exit_code="0")
+        _last_generated[model] = time.time()
+        metrics.GENERATION_SECONDS.observe(time.time() - start_time, model=model, resolution=resolution)
+        timings = timings_so_far()
+        if hires is None and decoder == "vae" and variant is None and getattr(_latency_state, "enabled", True):
+            # Multi-pass runs, fast decodes and quantized variants would skew the learned latency
+            latency_model.observe(model, steps, width, height, timings)
+        
+        # Format the response to match OpenAPI style
+        image_description = "Image of " + sanitized_prompt[:50] + ("..." if len(sanitized_prompt) > 50 else "")
+        
+        markdown_response = f"Here's the image you requested:\n\n{image_description}\n\n**Generation Details:**\n\nModel: {model}\nResolution: {width}x{height} pixels\nSteps: {steps}\nCFG Scale: {cfg_scale}\nSampling Method: {sampling_method}\nSeed: {seed}\nThis image was generated based on your prompt {sanitized_prompt}. Let me know if you'd like adjustments!"
+        
+        response = {
+            "success": True,
+            "image_path": output_path,
+            "prompt": sanitized_prompt,
+            "model": model,
+            "width": width,
+            "height": height,
+            "steps": steps,
+            "cfg_scale": cfg_scale,
+            "seed": seed,
+            "sampling_method": sampling_method,
+            "command": " ".join(base_command),
+            "output": result.stdout,
+            "markdown_response": markdown_response,
+            "timings": timings,
+            "decoder": decoder,
+            "memory": memory,
+            "variant": variant
+        }
+        if negative_prompt is not None:
+            response["negative_prompt"] = negative_prompt
+        if hires is not None:
+            response["hires"] = {key: value for key, value in hires.items() if key != "base_path"}
+        if refine_command is not None:
+            response["refine_command"] = " ".join(refine_command)
+        return response
+    
+    except GenerationCancelled as e:
+        reason = str(e) or "cancelled"
+        logging.info(f"Generation cancelled ({reason}), stopped sd.cpp for {output_path}")
+        # sd.cpp may have been killed mid-write
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        metrics.GENERATIONS.inc(model=model, status="cancelled", exit_code="cancelled")
+        metrics.CANCELLATIONS.inc(reason=reason)
+        
+        return {
+            "success": False,
+            "error": "Generation cancelled",
+            "error_type": "cancelled",
+            "command": " ".join(base_command),
+            "timings": timings_so_far()
+        }
+    except GenerationTimeout as e:
+        error_msg = str(e)
+        logging.error(f"Image generation timed out: {error_msg}")
+        logging.error(f"Command: {' '.join(base_command)}")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        metrics.GENERATIONS.inc(model=model, status="timeout", exit_code="timeout")
+        metrics.TIMEOUTS.inc(model=model, kind=e.kind)
+        
+        return {
+            "success": False,
+            "error": error_msg,
+            "error_type": "timeout",
+            "command": " ".join(base_command),
+            "timings": timings_so_far()
+        }
+    except subprocess.CalledProcessError as e:
+        error_msg = f"Process error (exit code {e.returncode}): {str(e)}"
+        logging.error(f"Image generation failed: {error_msg}")
+        logging.error(f"Command: {' '.join(base_command)}")
+        if e.stderr:
+            logging.error(f"Process stderr: {e.stderr}")
+        metrics.GENERATIONS.inc(model=model, status="failure", exit_code=str(e.returncode))
+        
+        return {
+            "success": False,
+            "error": error_msg,
+            "stderr": e.stderr,
+            "command": " ".join(base_command),
+            "exit_code": e.returncode,
+            "timings": timings_so_far()
+        }
+    except FileNotFoundError as e:
+        error_msg = f"Binary not found at {base_command[0]}"
+        logging.error(f"Image generation failed: {error_msg}")
+        metrics.GENERATIONS.inc(model=model, status="failure", exit_code="binary_not_found")
+        
+        return {
+            "success": False,
+            "error": error_msg,
+            "command": " ".join(base_command),
+        }
+    except Exception as e:
+        error_msg = f"Unexpected error: {str(e)}"
+        logging.error(f"Image generation failed with unexpected error: {error_msg}")
+        logging.error(f"Command: {' '.join(base_command)}")
+        metrics.GENERATIONS.inc(model=model, status="failure", exit_code="error")
+        
+        return {
+            "success": False,
+            "error": error_msg,
+            "command": " ".join(base_command),
+            "timings": timings_so_far()
+        }
+    finally:
+        # The refine pass's input image is an intermediate file
+        if hires is not None and hires.get("base_path") and os.path.exists(hires["base_path"]):
+            os.remove(hires["base_path"])
 
 @mcp.tool()
 def generate_stable_diffusion_image(prompt: str, model: str = None, output_dir: str = None, 
                                    width: int = None, height: int = None, steps: int = None, 
                                    cfg_scale: float = None, seed: int = -1, 
-                                   sampling_method: str = None, negative_prompt: str = "") -> dict:
+                                   sampling_method: str = None, negative_prompt: str = "",
+                                   hires: str = None, hires_strength: float = None,
+                                   fast_decode: bool = False, variant: str = None) -> dict:
     """Generate an image using standard Stable Diffusion models (SDXL, SD3 or SD1.5)
     
     Args:
@@ -326,45 +1559,48 @@ def generate_stable_diffusion_image(prompt: str, model: str = None, output_dir:
         seed: Seed for reproducibility (-1 for random)
         sampling_method: Sampling method (euler, euler_a, heun, dpm2, dpm++2s_a, dpm++2m, dpm++2mv2, lcm)
         negative_prompt: Negative prompt (for SD models ONLY)
+        hires: Two-pass hi-res for sizes above the model's native resolution: "upscale"
+            (generate small, then ESRGAN upscale) or "refine" (generate at native size,
+            then a low-strength img2img pass at the full size)
+        hires_strength: Denoising strength of the refine pass (default: 0.35)
+        fast_decode: Decode with the tiny autoencoder (TAESD) for a quicker, slightly
+            less detailed preview
+        variant: Quantized weights to use: a quality tier (quality, balanced, fast,
+            fastest) or a quantization type (q8_0, q5_0, q4_0, ...). Smaller weights
+            load faster and use less memory at some cost in quality
         
     Returns:
-        A dictionary containing the path to the generated image and the command used
+        A dictionary containing the path to the generated image, the command used and
+        a per-phase timings breakdown (queue wait, model load, sampling, decode, save)
     """
     logging.info(f"Generate stable diffusion image request: prompt={prompt}, model={model}")
     
+    # Select the model, defaulting to SD1.5, before predicting how long it will take
+    model = resolve_model(model, "stable")
+    if not model.startswith("flux-"):
+        conversion_error = prepare_variant(model, variant)
+        if conversion_error:
+            return conversion_error
+    
     # Use the generation queue to prevent concurrent generation
-    if not generation_queue.acquire():
-        return {
-            "success": False,
-            "error": "Another image generation is already in progress. Please try again when the current generation completes."
-        }
+    queue_start = time.time()
+    slot_error = _acquire_generation_slot(predict_generation_seconds(model, steps, width, height, hires))
+    if slot_error:
+        return slot_error
     
+    start_time = time.time()
     try:
         # Sanitize prompt and negative prompt
         sanitized_prompt = re.sub(r'[^\w\s.,;:!?\'"-]+', '', prompt).strip()
         sanitized_negative_prompt = negative_prompt
         if negative_prompt:
             sanitized_negative_prompt = re.sub(r'[^\w\s.,;:!?\'"-]+', '', negative_prompt).strip()
-            
-        # Select appropriate model
-        if not model:
-            model = "sd15"  # Default to SD1.5
-        
-        model = model.lower()
         
         # Only allow SD models in this function
         if model.startswith("flux-"):
             error_msg = f"Please use generate_flux_image for Flux models (received {model})"
             logging.error(error_msg)
             return {"success": False, "error": error_msg}
-            
-        # Normalize model name
-        if model in ["sdxl", "sdxl-1.0", "sdxl1.0"]:
-            model = "sdxl"
-        elif model in ["sd3", "sd3-medium"]:
-            model = "sd3"
-        elif model in ["sd15", "sd1.5", "sd-1.5"]:
-            model = "sd15"
         
         # Use default parameters if not specified
         if width is None:
@@ -383,7 +1619,7 @@ def generate_stable_diffusion_image(prompt: str, model: str = None, output_dir:
             sampling_method = get_default_sampling_method(model)
         
         if output_dir is None:
-            output_dir = default_output_dir
+            output_dir = get_default_output_dir()
             
         # Ensure output directory exists
         os.makedirs(output_dir, exist_ok=True)
@@ -395,6 +1631,13 @@ def generate_stable_diffusion_image(prompt: str, model: str = None, output_dir:
             logging.error(error_msg)
             return {"success": False, "error": error_msg}
         
+        # Select the quantized variant, converted by prepare_variant before the slot was taken
+        try:
+            model_path, quant = get_variant_path(model, variant, convert=False)
+        except (ValueError, VariantError) as e:
+            logging.error(str(e))
+            return {"success": False, "error": str(e)}
+        
         # Generate a random seed if not provided
         if seed == -1:
             seed = random.randint(1, 1000000000)
@@ -407,132 +1650,32 @@ def generate_stable_diffusion_image(prompt: str, model: str = None, output_dir:
         output_filename = f"{model}_{truncated_prompt}_{unique_id}.png"
         output_path = os.path.join(output_dir, output_filename)
             
-        # Prepare command for sd.cpp
-        bin_path = os.path.join(sd_cpp_path, "build", "bin", "sd")
-        
-        base_command = [
-            bin_path,
-            "-p", sanitized_prompt
-        ]
-        
-        # Add negative prompt if provided
-        if sanitized_negative_prompt:
-            base_command.extend(["--negative-prompt", sanitized_negative_prompt])
-            
-        # Add remaining parameters
-        base_command.extend([
-            "--cfg-scale", str(cfg_scale),
-            "--sampling-method", sampling_method,
-            "--steps", str(steps),
-            "-H", str(height),
-            "-W", str(width),
-            "-o", output_path,
-            "--seed", str(seed)
-        ])
-        
-        # Add model-specific paths
-        base_command.extend(["--diffusion-model", model_path])
-        
-        # Get supporting files
-        vae_path = get_supporting_file("vae")
-        clip_path = get_supporting_file("clip")
-        clip_l_path = get_supporting_file("clip_l")
-        t5xxl_path = get_supporting_file("t5xxl")
-        
-        if vae_path:
-            base_command.extend(["--vae", vae_path])
-        
-        if model == "sdxl":
-            if clip_path and t5xxl_path:
-                base_command.extend(["--clip", clip_path])
-                base_command.extend(["--t5xxl", t5xxl_path])
-        elif model == "sd15":
-            if clip_path:
-                base_command.extend(["--clip", clip_path])
-                
-        # Add GPU and memory usage settings
-        if config["vram_usage"] != "adaptive":
-            base_command.append(f"--{config['vram_usage']}")
-            
-        if config["gpu_layers"] != -1:
-            base_command.extend(["--gpu-layer", str(config["gpu_layers"])])
+        # Prepare command(s) for sd.cpp
+        taesd = get_fast_decoder(model, fast_decode)
+        prepared = _prepare_hires(model, sanitized_prompt, output_path, width, height, steps, cfg_scale,
+                                  sampling_method, seed, hires, hires_strength,
+                                  negative_prompt=sanitized_negative_prompt, taesd=taesd, model_path=model_path)
+        if isinstance(prepared, dict):
+            logging.error(prepared["error"])
+            return prepared
+        base_command, refine_command, hires_plan, memory_plan = prepared
         
-        try:
-            # Run the command
-            logging.info(f"Running command: {' '.join(base_command)}")
-            
-            result = subprocess.run(
-                base_command,
-                check=True,
-                capture_output=True,
-                text=True
-            )
-            
-            logging.info(f"Successfully generated image at: {output_path} (size: {os.path.getsize(output_path)} bytes)")
-            
-            # Format the response to match OpenAPI style
-            image_description = "Image of " + sanitized_prompt[:50] + ("..." if len(sanitized_prompt) > 50 else "")
-            
-            markdown_response = f"Here's the image you requested:\n\n{image_description}\n\n**Generation Details:**\n\nModel: {model}\nResolution: {width}x{height} pixels\nSteps: {steps}\nCFG Scale: {cfg_scale}\nSampling Method: {sampling_method}\nSeed: {seed}\nThis image was generated based on your prompt {sanitized_prompt}. Let me know if you'd like adjustments!"
-            
-            return {
-                "success": True,
-                "image_path": output_path,
-                "prompt": sanitized_prompt,
-                "model": model,
-                "width": width,
-                "height": height,
-                "steps": steps,
-                "cfg_scale": cfg_scale,
-                "seed": seed,
-                "sampling_method": sampling_method,
-                "command": " ".join(base_command),
-                "output": result.stdout,
-                "markdown_response": markdown_response
-            }
-        
-        except subprocess.CalledProcessError as e:
-            error_msg = f"Process error (exit code {e.returncode}): {str(e)}"
-            logging.error(f"Image generation failed: {error_msg}")
-            logging.error(f"Command: {' '.join(base_command)}")
-            if e.stderr:
-                logging.error(f"Process stderr: {e.stderr}")
-            
-            return {
-                "success": False,
-                "error": error_msg,
-                "stderr": e.stderr,
-                "command": " ".join(base_command),
-                "exit_code": e.returncode
-            }
-        except FileNotFoundError as e:
-            error_msg = f"Binary not found at {base_command[0]}"
-            logging.error(f"Image generation failed: {error_msg}")
-            
-            return {
-                "success": False,
-                "error": error_msg,
-                "command": " ".join(base_command),
-            }
-        except Exception as e:
-            error_msg = f"Unexpected error: {str(e)}"
-            logging.error(f"Image generation failed with unexpected error: {error_msg}")
-            logging.error(f"Command: {' '.join(base_command)}")
-            
-            return {
-                "success": False,
-                "error": error_msg,
-                "command": " ".join(base_command),
-            }
+        return _execute_generation(base_command, output_path, model, sanitized_prompt, width, height,
+                                   steps, cfg_scale, seed, sampling_method, queue_start, start_time,
+                                   negative_prompt=sanitized_negative_prompt,
+                                   refine_command=refine_command, hires=hires_plan,
+                                   decoder="taesd" if taesd else "vae", memory=memory_plan, variant=quant)
     finally:
         # Always release the lock when done
-        generation_queue.release()
+        _release_generation_slot()
 
 @mcp.tool()
 def generate_flux_image(prompt: str, output_dir: str = None, cfg_scale: float = None, 
                         sampling_method: str = None, steps: int = None,
                         model: str = None, width: int = None, 
-                        height: int = None, seed: int = -1) -> dict:
+                        height: int = None, seed: int = -1,
+                        hires: str = None, hires_strength: float = None,
+                        fast_decode: bool = False, variant: str = None) -> dict:
     """
     Generate an image using Flux stable diffusion models ONLY.
     Use this tool for any request involving flux-schnell or flux-dev models.
@@ -547,28 +1690,39 @@ def generate_flux_image(prompt: str, output_dir: str = None, cfg_scale: float =
         width: Image width in pixels (default: 512)
         height: Image height in pixels (default: 512)
         seed: Seed for reproducibility (-1 for random)
+        hires: Two-pass hi-res for sizes above the model's native resolution: "upscale"
+            (generate small, then ESRGAN upscale) or "refine" (generate at native size,
+            then a low-strength img2img pass at the full size)
+        hires_strength: Denoising strength of the refine pass (default: 0.35)
+        fast_decode: Decode with the tiny autoencoder (TAESD) for a quicker, slightly
+            less detailed preview
+        variant: Quantized weights to use: a quality tier (quality, balanced, fast,
+            fastest) or a quantization type (q8_0, q5_0, q4_0, ...). Smaller weights
+            load faster and use less memory at some cost in quality
         
     Returns:
-        A dictionary containing the path to the generated image and the command used
+        A dictionary containing the path to the generated image, the command used and
+        a per-phase timings breakdown (queue wait, model load, sampling, decode, save)
     """
     logging.info(f"Generate flux image request: prompt={prompt}, model={model}")
     
+    # Select the model, defaulting to flux-schnell, before predicting how long it will take
+    model = resolve_model(model, "flux")
+    if model.startswith("flux-"):
+        conversion_error = prepare_variant(model, variant)
+        if conversion_error:
+            return conversion_error
+    
     # Use the generation queue to prevent concurrent generation
-    if not generation_queue.acquire():
-        return {
-            "success": False,
-            "error": "Another image generation is already in progress. Please try again when the current generation completes."
-        }
+    queue_start = time.time()
+    slot_error = _acquire_generation_slot(predict_generation_seconds(model, steps, width, height, hires))
+    if slot_error:
+        return slot_error
     
+    start_time = time.time()
     try:
         # Sanitize prompt
         sanitized_prompt = re.sub(r'[^\w\s.,;:!?\'"-]+', '', prompt).strip()
-            
-        # Select appropriate model
-        if not model:
-            model = "flux-schnell"  # Default to flux-schnell
-        
-        model = model.lower()
         
         # Only allow Flux models in this function
         if not model.startswith("flux-"):
@@ -579,12 +1733,6 @@ def generate_flux_image(prompt: str, output_dir: str = None, cfg_scale: float =
                 error_msg = f"Invalid model: {model}. For Flux image generation, use 'flux-schnell' or 'flux-dev'"
             logging.error(error_msg)
             return {"success": False, "error": error_msg}
-            
-        # Normalize model name
-        if model in ["flux-schnell", "flux_schnell", "fluxschnell", "flux1-schnell"]:
-            model = "flux-schnell"
-        elif model in ["flux-dev", "flux_dev", "fluxdev", "flux1-dev"]:
-            model = "flux-dev"
         
         # Use default parameters if not specified
         if width is None:
@@ -603,7 +1751,7 @@ def generate_flux_image(prompt: str, output_dir: str = None, cfg_scale: float =
             sampling_method = get_default_sampling_method(model)
         
         if output_dir is None:
-            output_dir = default_output_dir
+            output_dir = get_default_output_dir()
             
         # Ensure output directory exists
         os.makedirs(output_dir, exist_ok=True)
@@ -615,6 +1763,13 @@ def generate_flux_image(prompt: str, output_dir: str = None, cfg_scale: float =
             logging.error(error_msg)
             return {"success": False, "error": error_msg}
         
+        # Select the quantized variant, converted by prepare_variant before the slot was taken
+        try:
+            model_path, quant = get_variant_path(model, variant, convert=False)
+        except (ValueError, VariantError) as e:
+            logging.error(str(e))
+            return {"success": False, "error": str(e)}
+        
         # Generate a random seed if not provided
         if seed == -1:
             seed = random.randint(1, 1000000000)
@@ -627,119 +1782,505 @@ def generate_flux_image(prompt: str, output_dir: str = None, cfg_scale: float =
         output_filename = f"{model}_{truncated_prompt}_{unique_id}.png"
         output_path = os.path.join(output_dir, output_filename)
             
-        # Prepare command for sd.cpp
-        bin_path = os.path.join(sd_cpp_path, "build", "bin", "sd")
-        
-        base_command = [
-            bin_path,
-            "-p", sanitized_prompt,
-            "--cfg-scale", str(cfg_scale),
-            "--sampling-method", sampling_method,
-            "--steps", str(steps),
-            "-H", str(height),
-            "-W", str(width),
-            "-o", output_path,
-            "--diffusion-fa",  # Add Flux-specific flag
-            "--seed", str(seed)
-        ]
-        
-        # Add model-specific paths
-        base_command.extend(["--diffusion-model", model_path])
+        # Prepare command(s) for sd.cpp
+        taesd = get_fast_decoder(model, fast_decode)
+        prepared = _prepare_hires(model, sanitized_prompt, output_path, width, height, steps, cfg_scale,
+                                  sampling_method, seed, hires, hires_strength, taesd=taesd, model_path=model_path)
+        if isinstance(prepared, dict):
+            logging.error(prepared["error"])
+            return prepared
+        base_command, refine_command, hires_plan, memory_plan = prepared
         
-        # Get supporting files for Flux
-        vae_path = get_supporting_file("vae")
-        clip_l_path = get_supporting_file("clip_l")
-        t5xxl_path = get_supporting_file("t5xxl")
+        return _execute_generation(base_command, output_path, model, sanitized_prompt, width, height,
+                                   steps, cfg_scale, seed, sampling_method, queue_start, start_time,
+                                   refine_command=refine_command, hires=hires_plan,
+                                   decoder="taesd" if taesd else "vae", memory=memory_plan, variant=quant)
+    finally:
+        # Always release the lock when done
+        _release_generation_slot()
+
+@mcp.tool()
+def get_metrics() -> dict:
+    """Get DiffuGen's runtime metrics (queue depth and wait times, generation latency,
+    success and failure counts, busy rejections and output directory size)
+    
+    Returns:
+        A dictionary with a snapshot of every metric and the Prometheus text rendering
+    """
+    return {
+        "success": True,
+        "metrics": metrics.registry.snapshot(),
+        "prometheus": metrics.registry.render()
+    }
+
+# Asynchronous jobs: the generate functions a job's tool name maps to
+JOB_TOOLS = {
+    "stable": generate_stable_diffusion_image,
+    "flux": generate_flux_image,
+}
+
+def generate_sweep(prompt: str, axes: dict, model: str = None, width: int = None, height: int = None,
+                   steps: int = None, cfg_scale: float = None, seed: int = -1, sampling_method: str = None,
+                   negative_prompt: str = "", output_dir: str = None, contact_sheet: bool = True,
+                   fast_decode: bool = False, variant: str = None, on_progress=None) -> dict:
+    """Render one prompt over every combination of the sweep axes (see diffugen_sweep).
+    
+    Each cell takes a generation slot of its own through the fair gate, so other tenants'
+    requests run between cells instead of waiting for the whole grid. Once the first
+    cell is admitted the rest wait for their turn rather than being shed. on_progress(result)
+    is called with the cells finished so far after each one. Without a seed axis every
+    cell uses the same seed."""
+    model = resolve_model(model)
+    settings = dict(DEFAULT_SWEEP, **config["sweep"])
+    try:
+        axes = normalize_axes(axes, int(settings["max_cells"]))
+    except ValueError as e:
+        logging.error(str(e))
+        return {"success": False, "error": str(e)}
+    if "seed" not in axes and (seed is None or seed == -1):
+        seed = random.randint(1, 1000000000)
+    
+    flux = model.startswith("flux-")
+    base = {"prompt": prompt, "model": model, "width": width, "height": height, "steps": steps,
+            "cfg_scale": cfg_scale, "seed": seed, "sampling_method": sampling_method,
+            "fast_decode": fast_decode, "variant": variant}
+    if not flux:
+        base["negative_prompt"] = negative_prompt
+    grid = expand_grid(axes)
+    sweep_dir = os.path.join(output_dir or get_default_output_dir(), f"sweep_{model}_{uuid.uuid4().hex[:8]}")
+    cells = []
+    
+    def report(**extra):
+        return {"model": model, "prompt": prompt, "axes": axes, "cells": cells, "completed": len(cells),
+                "total": len(grid), "output_dir": sweep_dir, **extra}
+    
+    logging.info(f"Sweep of {len(grid)} cells for {model}: {axes}")
+    start_time = time.time()
+    conversion_error = prepare_variant(model, variant)
+    if conversion_error:
+        return conversion_error
+    for index, values in enumerate(grid):
+        # The first cell is admitted (or shed) like any generation; the rest of the grid waits its turn
+        waiting = cancel_scope(current_cancel_token() or CancelToken(), wait_for_slot=True) if index else nullcontext()
+        with waiting, work_scope(estimate_work(model, values.get("steps", steps), width, height)):
+            result = JOB_TOOLS["flux" if flux else "stable"](**dict(base, **values, output_dir=sweep_dir))
+        if not result.get("success") and "command" not in result and result.get("error_type") != "cancelled":
+            # Rejected before sd.cpp ran (busy, unknown model, bad size, ...): every cell would fail the same way
+            return {"success": False, "error": result.get("error"), "error_type": result.get("error_type"),
+                    "retry_after": result.get("retry_after")}
+        cells.append({"index": index, "values": values, "label": cell_label(values),
+                      "success": bool(result.get("success")), "image_path": result.get("image_path"),
+                      "seed": result.get("seed"), "error": result.get("error"), "timings": result.get("timings")})
+        if result.get("error_type") == "cancelled":
+            return {"success": False, "error": "Sweep cancelled", "error_type": "cancelled", **report()}
+        if on_progress is not None:
+            try:
+                on_progress(report())
+            except Exception as e:
+                logging.warning(f"Could not report sweep progress: {e}")
+    
+    succeeded = [cell for cell in cells if cell["success"]]
+    sheet = None
+    if contact_sheet and succeeded:
+        try:
+            sheet = build_contact_sheet(cells, sweep_dir, "contact_sheet", grid_columns(axes), f"{model}: {prompt}",
+                                        int(settings["thumbnail_size"]))
+        except Exception as e:
+            logging.warning(f"Could not build the sweep contact sheet: {e}")
+    timings = {"total": round(time.time() - start_time, 3),
+               "process_total": round(sum((cell["timings"] or {}).get("process_total", 0.0) for cell in cells), 3)}
+    if not succeeded:
+        return {"success": False, "error": f"All {len(cells)} sweep cells failed: {cells[0]['error']}",
+                "timings": timings, **report()}
+    return {"success": True, "contact_sheet": sheet,
+            # A PNG sheet is the job's image; an HTML sheet only links the cell images
+            "image_path": sheet if sheet and sheet.endswith(".png") else None,
+            "failed_cells": len(cells) - len(succeeded), "timings": timings, **report()}
+
+JOB_TOOLS["sweep"] = generate_sweep
+
+def estimate_sweep_work(model, axes, steps=None, width=None, height=None):
+    """Estimated work of a sweep: the sum of its cells' work (see estimate_work)"""
+    return sum(estimate_work(model, values.get("steps", steps), width, height)
+               for values in expand_grid(normalize_axes(axes, int(dict(DEFAULT_SWEEP, **config["sweep"])["max_cells"]))))
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+_job_broker = None
+_job_broker_lock = threading.Lock()
+
+def run_generation_job(job, cancel_token=None):
+    """Run a job through its generate function, waiting for a free generation slot"""
+    # The job already waited its fair turn at the broker; this only orders it among local slot waiters
+    with cancel_scope(cancel_token or CancelToken(), wait_for_slot=True), \
+            tenant_scope(job.get("tenant"), job.get("priority"), cost=job.get("cost", 1.0),
+                         queued_since=job["submitted_at"]):
+        params = dict(job["params"])
+        if job["tool"] == "sweep":
+            # Publish each finished cell while the rest of the grid runs
+            params["on_progress"] = lambda result: get_job_manager().report_progress(job["id"], result)
+        return JOB_TOOLS[job["tool"]](**params)
+
+def get_job_broker():
+    """Connect to the configured broker (once), without starting any job workers"""
+    global _job_broker
+    with _job_broker_lock:
+        if _job_broker is None:
+            _job_broker = create_broker(config["broker"])
+        return _job_broker
+
+def get_local_workers():
+    """Job worker threads for this process: local_workers, or by default one, except in an
+    MCP session on a shared broker (see the MCP server startup)"""
+    return 1 if config["local_workers"] is None else int(config["local_workers"])
+
+def get_job_manager():
+    """Connect to the configured broker and start this process's job workers (once)"""
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager(get_job_broker(), run_generation_job, get_local_workers(),
+                                      on_remote_result=_learn_from_job,
+                                      lease_seconds=float(config["job_lease_seconds"]),
+                                      retention_seconds=float(config["job_retention_days"]) * 86400,
+                                      on_finished=_notify_job_finished)
+            _job_manager.start()
+            logging.info(f"Job broker {config['broker']} with {get_local_workers()} local workers")
+        return _job_manager
+
+def start_job_workers():
+    """Connect to a durable broker at startup, so jobs queued before a restart run
+    without waiting for the next job request. The memory broker starts on first use"""
+    if config["broker"].startswith("memory"):
+        return
+    try:
+        get_job_manager()
+    except Exception as e:
+        logging.error(f"Could not start job workers on {config['broker']}: {e}")
+
+# Delivers job completion webhooks from a background thread, see diffugen_webhooks
+webhooks = LazyGlobal(lambda: WebhookDispatcher(config["webhooks"]))
+
+def _notify_job_finished(job):
+    """POST the finished job to its callback URL, if it has one, and record the outcome in the job"""
+    if job.get("callback_url"):
+        webhooks.deliver(job["callback_url"], job_payload(job, webhooks.settings["public_url"]), delivery_id=job["id"],
+                         on_done=lambda delivered: get_job_manager().webhook_done(job["id"], delivered))
+
+def _learn_from_job(job):
+    """Learn generation latency from a job that ran on another node"""
+    result = job.get("result") or {}
+    if result.get("timings") and result.get("steps") and not result.get("hires") \
+            and result.get("decoder", "vae") == "vae" and not result.get("variant"):
+        latency_model.observe(result["model"], result["steps"], result["width"], result["height"], result["timings"])
+
+def _predict_job_seconds(job):
+    params = job["params"]
+    if job["tool"] == "sweep":
+        return sum(predict_generation_seconds(params.get("model"), values.get("steps", params.get("steps")),
+                                              params.get("width"), params.get("height"))
+                   for values in expand_grid(params["axes"]))
+    return predict_generation_seconds(params.get("model"), params.get("steps"), params.get("width"),
+                                      params.get("height"), params.get("hires"))
+
+def estimate_job_times(limit=1000):
+    """Predicted (start, completion) Unix times of running and queued jobs, by job ID.
+    
+    Replays the queue in claim order over the workers that are busy now (at least
+    the local workers), so ETAs are updated as the queue moves and as latency is learned."""
+    manager = get_job_manager()
+    running = manager.list(status=RUNNING, limit=limit)
+    queued = manager.broker.queued(limit)
+    workers = max(1, len(running), manager.local_workers)
+    return schedule_etas(running, queued, workers, _predict_job_seconds)
+
+def job_eta(job_id, etas=None):
+    """{"estimated_start", "estimated_completion"} for a running or queued job, or {}.
+    
+    etas is a result of estimate_job_times to reuse when looking up several jobs."""
+    try:
+        eta = (etas if etas is not None else estimate_job_times()).get(job_id)
+    except Exception as e:
+        logging.warning(f"Could not estimate job times: {e}")
+        return {}
+    if eta is None:
+        return {}
+    return {"estimated_start": round(eta[0], 1), "estimated_completion": round(eta[1], 1)}
+
+def _tenant_queue_depths():
+    """Waiting requests per (tenant, priority class): slot waiters here plus queued jobs"""
+    depths = dict(generation_queue.gate.depths())
+    if _job_manager is not None:
+        for flow, count in _job_manager.broker.queue_stats().items():
+            depths[flow] = depths.get(flow, 0) + count
+    return depths
+
+metrics.TENANT_QUEUE_DEPTH.set_function(_tenant_queue_depths)
+
+def _warm_files(model):
+    """Weight files to prefetch for a hot model: its default variant if already converted"""
+    try:
+        quant = resolve_variant(config["variants"].get("default"))
+        model_path = variant_cache.get(get_model_path(model), quant, convert=False) if quant else None
+    except (ValueError, VariantError):
+        model_path = None
+    return [path for paths in get_model_files(model, model_path).values() for path in paths]
+
+def _warmup_generation(model):
+    """A tiny generation that loads a model once, run by the warmer"""
+    generate = JOB_TOOLS["flux" if model.startswith("flux-") else "stable"]
+    output_dir = tempfile.mkdtemp(prefix="diffugen-warmup-")
+    try:
+        with cancel_scope(CancelToken(), wait_for_slot=True), tenant_scope(DEFAULT_TENANT, "batch"), \
+                latency_sampling(False):
+            return generate(prompt="warm-up", model=model, output_dir=output_dir, width=256, height=256, steps=1)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+# Keeps the hot models' weights in the page cache; servers start it, see diffugen_warmup
+warmer = LazyGlobal(lambda: Warmer(config["warmup"], _warm_files, _warmup_generation,
+                                   lambda: not generation_queue.holders()))
+metrics.WARM.set_function(lambda: 1 if warmer.status()["ready"] else 0)
+
+def _gpu_idle():
+    """No generation is running or waiting for a slot, and no job is queued"""
+    if generation_queue.holders() or load_tracker.stats()["waiting"]:
+        return False
+    try:
+        return _job_manager is None or _job_manager.broker.queue_length() == 0
+    except Exception:
+        return False
+
+def _speculative_generation(params, tenant, token):
+    """Render one speculative image as the tenant's lowest-priority work, giving up if the GPU is busy"""
+    arguments = {name: value for name, value in params.items() if name != "tool"}
+    with cancel_scope(token), tenant_scope(tenant, "batch"):
+        return JOB_TOOLS[params["tool"]](**arguments)
+
+def _discard_image(result):
+    if result.get("image_path") and os.path.exists(result["image_path"]):
+        os.remove(result["image_path"])
+
+# Pre-renders follow-up images for recent prompts; the OpenAPI server starts it, see diffugen_speculate
+speculator = LazyGlobal(lambda: Speculator(config["speculation"], _speculative_generation, _gpu_idle, _discard_image,
+                                           lambda outcome: metrics.SPECULATIVE_IMAGES.inc(outcome=outcome)))
+metrics.SPECULATIVE_READY.set_function(lambda: speculator.status()["ready"])
+
+def readiness():
+    """Whether this node can serve a generation soon, and what that rests on: the sd.cpp
+    binary, the installed models and which of them are warm, the slots and queues, and
+    the predicted wait for a slot. "reasons" says why a node is not ready"""
+    binary = os.path.join(get_sd_cpp_path(), "build", "bin", "sd")
+    binary_available = os.path.isfile(binary) and os.access(binary, os.X_OK)
+    warmup = warmer.status()
+    # Weights stay in the page cache after a run until the warmer would refresh them
+    warm_window = float(warmer.settings["refresh_seconds"] or DEFAULT_WARMUP["refresh_seconds"])
+    models = {}
+    for model in ALL_MODELS:
+        paths = [path for paths in get_model_files(model).values() for path in paths if path]
+        prefetched = warmup["models"].get(model, {}).get("prefetched", False)
+        models[model] = {
+            "installed": bool(paths) and all(os.path.exists(path) for path in paths),
+            "warm": prefetched or time.time() - _last_generated.get(model, 0) < warm_window
+        }
+    busy_slots = len(generation_queue.holders())
+    queue = {
+        "slots": generation_queue.max_concurrent,
+        "free_slots": max(0, generation_queue.max_concurrent - busy_slots),
+        "waiting": load_tracker.stats()["waiting"],
+        "queued_jobs": None
+    }
+    if _job_manager is not None:
+        try:
+            queue["queued_jobs"] = _job_manager.broker.queue_length()
+        except Exception as e:
+            logging.warning(f"Could not read the job queue length: {e}")
+    reasons = []
+    if not binary_available:
+        reasons.append(f"sd.cpp binary not found at {binary}")
+    if not any(entry["installed"] for entry in models.values()):
+        reasons.append("No model is installed")
+    if not warmup["ready"]:
+        reasons.append(f"Warm-up is {warmup['state']}")
+    shed = load_tracker.check()
+    if shed:
+        reasons.append(_busy_message(shed))
+    return {
+        "ready": not reasons,
+        "reasons": reasons,
+        "binary": {"path": binary, "available": binary_available},
+        "models": models,
+        "warm_models": [model for model, entry in models.items() if entry["installed"] and entry["warm"]],
+        "queue": queue,
+        "estimated_wait": round(load_tracker.predicted_wait(), 1),
+        "retry_after": shed["retry_after"] if shed else None,
+        "warmup": warmup["state"]
+    }
+
+@mcp.tool()
+def get_readiness() -> dict:
+    """Check whether DiffuGen can generate an image soon: the sd.cpp binary and installed
+    models, which models are warm, free generation slots, queue depth and estimated wait
+    
+    Returns:
+        A dictionary with "ready", the reasons it is not ready, and the details behind it
+    """
+    return {"success": True, **readiness()}
+
+@mcp.tool()
+def submit_generation_job(prompt: str, model: str = None, width: int = None, height: int = None,
+                          steps: int = None, cfg_scale: float = None, seed: int = -1,
+                          sampling_method: str = None, negative_prompt: str = "", priority: str = "batch",
+                          hires: str = None, hires_strength: float = None, fast_decode: bool = False,
+                          variant: str = None, callback_url: str = None) -> dict:
+    """Queue an image generation and return immediately with a job ID.
+    Use get_generation_job to follow the job and fetch the result.
+    
+    Args:
+        prompt: The image description to generate
+        model: Model to use (flux-schnell, flux-dev, sdxl, sd3, sd15)
+        width: Image width in pixels
+        height: Image height in pixels
+        steps: Number of diffusion steps
+        cfg_scale: CFG scale parameter
+        seed: Seed for reproducibility (-1 for random)
+        sampling_method: Sampling method
+        negative_prompt: Negative prompt (for SD models ONLY)
+        priority: Priority class (interactive or batch)
+        hires: Two-pass hi-res mode for large images ("upscale" or "refine")
+        hires_strength: Denoising strength of the refine pass
+        fast_decode: Decode with the tiny autoencoder (TAESD) for a quick preview
+        variant: Quantized weights (quality, balanced, fast, fastest, or q8_0, q4_0, ...)
+        callback_url: URL that receives a signed POST with the result when the job finishes
         
-        if vae_path:
-            base_command.extend(["--vae", vae_path])
+    Returns:
+        A dictionary with the job ID, its status and its estimated start and completion
+        times (Unix time), so you can decide to wait or ask for fewer steps or a smaller size
+    """
+    model = resolve_model(model)
+    if callback_url:
+        try:
+            validate_callback_url(callback_url, webhooks.settings)
+        except ValueError as e:
+            return {"success": False, "error": str(e)}
+    params = {"prompt": prompt, "model": model, "width": width, "height": height, "steps": steps,
+              "cfg_scale": cfg_scale, "seed": seed, "sampling_method": sampling_method,
+              "hires": hires, "hires_strength": hires_strength, "fast_decode": fast_decode, "variant": variant}
+    if model.startswith("flux-"):
+        tool = "flux"
+    else:
+        tool = "stable"
+        params["negative_prompt"] = negative_prompt
+    try:
+        priority = fair_policy.priority(priority)
+        job = get_job_manager().submit(tool, params, DEFAULT_TENANT, priority, fair_policy.weight(priority),
+                                       estimate_work(model, steps, width, height, hires), callback_url)
+    except Exception as e:
+        logging.error(f"Could not submit job: {e}")
+        return {"success": False, "error": f"Could not submit job: {e}"}
+    return {"success": True, "job_id": job["id"], "status": job["status"], **job_eta(job["id"])}
+
+@mcp.tool()
+def submit_sweep_job(prompt: str, axes: dict, model: str = None, width: int = None, height: int = None,
+                     steps: int = None, cfg_scale: float = None, seed: int = -1, sampling_method: str = None,
+                     negative_prompt: str = "", contact_sheet: bool = True, priority: str = "batch",
+                     fast_decode: bool = False, variant: str = None, callback_url: str = None) -> dict:
+    """Queue a parameter sweep: one prompt rendered over every combination of settings,
+    run as a single job that loads the model once. Use get_generation_job to follow it;
+    while it runs, its result lists the cells finished so far.
+    
+    Args:
+        prompt: The image description to generate
+        axes: Values to try per parameter, e.g. {"cfg_scale": [3, 5, 7], "steps": [20, 30],
+            "sampling_method": ["euler", "dpm++2m"], "seed": [1, 2]}
+        model: Model to use (flux-schnell, flux-dev, sdxl, sd3, sd15)
+        width: Image width in pixels
+        height: Image height in pixels
+        steps: Number of diffusion steps, unless swept
+        cfg_scale: CFG scale parameter, unless swept
+        seed: Seed shared by every cell, unless swept (-1 for one random seed)
+        sampling_method: Sampling method, unless swept
+        negative_prompt: Negative prompt (for SD models ONLY)
+        contact_sheet: Also build a labeled grid of all the cells
+        priority: Priority class (interactive or batch)
+        fast_decode: Decode with the tiny autoencoder (TAESD) for quick previews
+        variant: Quantized weights (quality, balanced, fast, fastest, or q8_0, q4_0, ...)
+        callback_url: URL that receives a signed POST with the result when the sweep finishes
         
-        if clip_l_path:
-            base_command.extend(["--clip_l", clip_l_path])
-            
-        if t5xxl_path:
-            base_command.extend(["--t5xxl", t5xxl_path])
+    Returns:
+        A dictionary with the job ID, the number of cells and the job's estimated start
+        and completion times (Unix time)
+    """
+    model = resolve_model(model)
+    try:
+        axes = normalize_axes(axes, int(dict(DEFAULT_SWEEP, **config["sweep"])["max_cells"]))
+        if callback_url:
+            validate_callback_url(callback_url, webhooks.settings)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    params = {"prompt": prompt, "axes": axes, "model": model, "width": width, "height": height, "steps": steps,
+              "cfg_scale": cfg_scale, "seed": seed, "sampling_method": sampling_method,
+              "negative_prompt": negative_prompt, "contact_sheet": contact_sheet, "fast_decode": fast_decode,
+              "variant": variant}
+    try:
+        priority = fair_policy.priority(priority)
+        job = get_job_manager().submit("sweep", params, DEFAULT_TENANT, priority, fair_policy.weight(priority),
+                                       estimate_sweep_work(model, axes, steps, width, height), callback_url)
+    except Exception as e:
+        logging.error(f"Could not submit sweep: {e}")
+        return {"success": False, "error": f"Could not submit sweep: {e}"}
+    return {"success": True, "job_id": job["id"], "status": job["status"], "cells": len(expand_grid(axes)),
+            **job_eta(job["id"])}
+
+@mcp.tool()
+def get_generation_job(job_id: str) -> dict:
+    """Get the status of a queued image generation job, and its result once finished
+    
+    Args:
+        job_id: The job ID returned by submit_generation_job
         
-        # Add GPU and memory usage settings
-        if config["vram_usage"] != "adaptive":
-            base_command.append(f"--{config['vram_usage']}")
-            
-        if config["gpu_layers"] != -1:
-            base_command.extend(["--gpu-layer", str(config["gpu_layers"])])
+    Returns:
+        A dictionary with the job's status, timestamps, estimated start and completion
+        times (while it waits or runs) and, when finished, the generation result
+    """
+    try:
+        job = get_job_manager().get(job_id)
+    except Exception as e:
+        logging.error(f"Could not read job {job_id}: {e}")
+        return {"success": False, "error": f"Could not read job: {e}"}
+    if job is None:
+        return {"success": False, "error": f"Job not found: {job_id}"}
+    if job["status"] in (QUEUED, RUNNING):
+        return {"success": True, "job": job, **job_eta(job_id)}
+    return {"success": True, "job": job}
+
+@mcp.tool()
+def cancel_generation_job(job_id: str) -> dict:
+    """Cancel a queued or running image generation job. A running job's sd.cpp
+    process is stopped and its partial output removed.
+    
+    Args:
+        job_id: The job ID returned by submit_generation_job
         
-        try:
-            # Run the command
-            logging.info(f"Running command: {' '.join(base_command)}")
-            
-            result = subprocess.run(
-                base_command,
-                check=True,
-                capture_output=True,
-                text=True
-            )
-            
-            logging.info(f"Successfully generated image at: {output_path} (size: {os.path.getsize(output_path)} bytes)")
-            
-            # Format the response to match OpenAPI style
-            image_description = "Image of " + sanitized_prompt[:50] + ("..." if len(sanitized_prompt) > 50 else "")
-            
-            markdown_response = f"Here's the image you requested:\n\n{image_description}\n\n**Generation Details:**\n\nModel: {model}\nResolution: {width}x{height} pixels\nSteps: {steps}\nCFG Scale: {cfg_scale}\nSampling Method: {sampling_method}\nSeed: {seed}\nThis image was generated based on your prompt {sanitized_prompt}. Let me know if you'd like adjustments!"
-            
-            return {
-                "success": True,
-                "image_path": output_path,
-                "prompt": sanitized_prompt,
-                "model": model,
-                "width": width,
-                "height": height,
-                "steps": steps,
-                "cfg_scale": cfg_scale,
-                "seed": seed,
-                "sampling_method": sampling_method,
-                "command": " ".join(base_command),
-                "output": result.stdout,
-                "markdown_response": markdown_response
-            }
-        
-        except subprocess.CalledProcessError as e:
-            error_msg = f"Process error (exit code {e.returncode}): {str(e)}"
-            logging.error(f"Image generation failed: {error_msg}")
-            logging.error(f"Command: {' '.join(base_command)}")
-            if e.stderr:
-                logging.error(f"Process stderr: {e.stderr}")
-            
-            return {
-                "success": False,
-                "error": error_msg,
-                "stderr": e.stderr,
-                "command": " ".join(base_command),
-                "exit_code": e.returncode
-            }
-        except FileNotFoundError as e:
-            error_msg = f"Binary not found at {base_command[0]}"
-            logging.error(f"Image generation failed: {error_msg}")
-            
-            return {
-                "success": False,
-                "error": error_msg,
-                "command": " ".join(base_command),
-            }
-        except Exception as e:
-            error_msg = f"Unexpected error: {str(e)}"
-            logging.error(f"Image generation failed with unexpected error: {error_msg}")
-            logging.error(f"Command: {' '.join(base_command)}")
-            
-            return {
-                "success": False,
-                "error": error_msg,
-                "command": " ".join(base_command),
-            }
-    finally:
-        # Always release the lock when done
-        generation_queue.release()
+    Returns:
+        A dictionary with the job's status after the cancel request
+    """
+    try:
+        job = get_job_manager().cancel(job_id)
+    except Exception as e:
+        logging.error(f"Could not cancel job {job_id}: {e}")
+        return {"success": False, "error": f"Could not cancel job: {e}"}
+    if job is None:
+        return {"success": False, "error": f"Job not found: {job_id}"}
+    return {"success": True, "job_id": job_id, "status": job["status"],
+            "cancel_requested": job.get("cancel_requested", False)}
 
 if __name__ == "__main__":
     try:
+        # Bulk generation from a manifest, see diffugen_bulk
+        if len(sys.argv) > 1 and sys.argv[1] == "--bulk":
+            from diffugen_bulk import main as bulk_main
+            sys.exit(bulk_main(sys.argv[2:]))
         # Check if command line arguments are provided for direct image generation
         if len(sys.argv) > 1:
             # Parse command line arguments
@@ -765,6 +2306,14 @@ if __name__ == "__main__":
                                 help="Negative prompt")
             parser.add_argument("--output-dir", type=str, dest="output_dir", default=None, 
                                 help="Directory to save the image")
+            parser.add_argument("--hires", type=str, choices=HIRES_MODES, default=None,
+                                help="Two-pass hi-res mode for sizes above the model's native resolution")
+            parser.add_argument("--hires-strength", type=float, dest="hires_strength", default=None,
+                                help="Denoising strength of the hi-res refine pass")
+            parser.add_argument("--fast-decode", action="store_true", dest="fast_decode",
+                                help="Decode with the tiny autoencoder (TAESD) for a quick preview")
+            parser.add_argument("--variant", type=str, default=None,
+                                help="Quantized weights: quality, balanced, fast, fastest, or q8_0, q5_0, q4_0, ...")
             
             # Parse arguments
             args, unknown = parser.parse_known_args()
@@ -799,7 +2348,11 @@ if __name__ == "__main__":
                     cfg_scale=args.cfg_scale,
                     seed=args.seed,
                     sampling_method=args.sampling_method,
-                    output_dir=args.output_dir
+                    output_dir=args.output_dir,
+                    hires=args.hires,
+                    hires_strength=args.hires_strength,
+                    fast_decode=args.fast_decode,
+                    variant=args.variant
                 )
             else:
                 log_to_stderr(f"Generating SD image with model: {args.model}")
@@ -813,7 +2366,11 @@ if __name__ == "__main__":
                     seed=args.seed,
                     sampling_method=args.sampling_method,
                     negative_prompt=args.negative_prompt,
-                    output_dir=args.output_dir
+                    output_dir=args.output_dir,
+                    hires=args.hires,
+                    hires_strength=args.hires_strength,
+                    fast_decode=args.fast_decode,
+                    variant=args.variant
                 )
             
             # Print the result path
@@ -825,6 +2382,14 @@ if __name__ == "__main__":
                 sys.exit(1)
         else:
             # No arguments provided, start the MCP server
+            warmer.start()
+            if config["local_workers"] is None:
+                # A session process exits with its client, killing any job it runs. Jobs on a
+                # shared broker are left to the OpenAPI server or diffugen_worker.py
+                if not config["broker"].startswith("memory"):
+                    config["local_workers"] = 0
+            else:
+                start_job_workers()
             mcp.run()
     except Exception as e:
         logging.error(f"Error running DiffuGen: {e}")
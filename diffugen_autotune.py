@@ -0,0 +1,262 @@
+"""Auto-tune sd.cpp hardware flags per model.
+
+Runs short calibration generations for every installed model across sd.cpp's
+memory modes, CPU thread counts, flash attention and offload options, records
+latency and peak memory for each run, and writes the fastest settings into the
+model_settings section of diffugen.json. The generate functions in diffugen.py
+pick those settings up through get_model_settings.
+
+Usage:
+    python diffugen_autotune.py [--models flux-schnell,sdxl] [--threads 4,8,16] [--dry-run]
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import diffugen
+from diffugen import build_sd_command, get_model_path, get_model_settings, log_to_stderr
+from diffugen_cpu import get_cpu_plan
+
+# Memory modes: sd.cpp flags that trade speed for lower memory use
+MEMORY_MODES = {
+    "default": [],
+    "vae-tiling": ["--vae-tiling"],
+    "vae-on-cpu": ["--vae-on-cpu"],
+    "clip-on-cpu": ["--clip-on-cpu"],
+}
+OFFLOAD_FLAG = "--offload-to-cpu"
+ALL_MODELS = ["flux-schnell", "flux-dev", "sdxl", "sd3", "sd15"]
+
+def _installed_models():
+    return [model for model in ALL_MODELS if os.path.exists(get_model_path(model) or "")]
+
+def _default_thread_counts():
+    cores = os.cpu_count() or 4
+    counts = {max(1, cores // 4), max(1, cores // 2), cores}
+    return sorted(counts)
+
+class _GpuMemorySampler:
+    """Poll nvidia-smi for peak GPU memory use while a calibration run is active"""
+
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._available = shutil.which("nvidia-smi") is not None
+
+    def _sample(self):
+        try:
+            output = subprocess.run(
+                ["nvidia-smi", "--query-gpu=memory.used", "--format=csv,noheader,nounits"],
+                capture_output=True, text=True, timeout=5, check=True
+            ).stdout
+            return sum(int(line.strip()) for line in output.splitlines() if line.strip())
+        except Exception:
+            return None
+
+    def __enter__(self):
+        if self._available:
+            self._baseline = self._sample() or 0
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            used = self._sample()
+            if used is not None:
+                delta = max(0, used - self._baseline)
+                self.peak_mb = delta if self.peak_mb is None else max(self.peak_mb, delta)
+            self._stop.wait(self.interval)
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+def calibrate(model, settings, steps, size, output_dir, timeout):
+    """Run one short generation with the given hardware settings.
+
+    Returns a dict with success, latency in seconds and peak host/GPU memory in MB."""
+    output_path = os.path.join(output_dir, f"autotune_{model}.png")
+    command = build_sd_command(
+        model, "a lighthouse on a cliff at sunset", output_path, size, size, steps,
+        diffugen.get_default_cfg_scale(model), diffugen.get_default_sampling_method(model), 42,
+        settings=settings
+    )
+    # Calibrate under the same core/NUMA pinning the server applies
+    cpu_plan = get_cpu_plan(diffugen.config["cpu"], diffugen.config["max_concurrent"])
+    start = time.time()
+    with tempfile.TemporaryFile() as stderr_file, _GpuMemorySampler() as gpu:
+        try:
+            with cpu_plan.pinned():
+                process = subprocess.Popen(cpu_plan.wrap_command(command), stdout=subprocess.DEVNULL, stderr=stderr_file)
+        except FileNotFoundError:
+            return {"success": False, "error": f"Binary not found at {command[0]}"}
+        timer = threading.Timer(timeout, process.kill)
+        timer.start()
+        try:
+            # wait4 reports the child's own peak RSS, unlike getrusage(RUSAGE_CHILDREN)
+            _, status, usage = os.wait4(process.pid, 0)
+        finally:
+            timer.cancel()
+        process.returncode = os.waitstatus_to_exitcode(status)
+        latency = time.time() - start
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode(errors="replace")
+
+    if process.returncode != 0 or not os.path.exists(output_path):
+        return {"success": False, "error": f"exit code {process.returncode}: {stderr.strip()[-300:]}"}
+    os.remove(output_path)
+    return {
+        "success": True,
+        "latency": round(latency, 3),
+        # ru_maxrss is reported in kilobytes on Linux
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "peak_gpu_mb": gpu.peak_mb,
+    }
+
+def _candidate_settings(base, memory_mode=None, threads=None, diffusion_fa=None, offload=None):
+    settings = dict(base, flags=list(base.get("flags", [])))
+    if memory_mode is not None:
+        settings["flags"] = [f for f in settings["flags"] if f not in sum(MEMORY_MODES.values(), [])]
+        settings["flags"].extend(MEMORY_MODES[memory_mode])
+    if threads is not None:
+        settings["threads"] = threads
+    if diffusion_fa is not None:
+        settings["diffusion_fa"] = diffusion_fa
+    if offload is not None:
+        settings["flags"] = [f for f in settings["flags"] if f != OFFLOAD_FLAG]
+        if offload:
+            settings["flags"].append(OFFLOAD_FLAG)
+    return settings
+
+def _calibrate_repeated(model, settings, steps, size, output_dir, timeout, repeats):
+    """Calibrate repeats times, reporting the median latency and the highest peak memory"""
+    results = [calibrate(model, settings, steps, size, output_dir, timeout) for _ in range(repeats)]
+    failed = [r for r in results if not r["success"]]
+    if failed:
+        return failed[0]
+    latencies = sorted(r["latency"] for r in results)
+    gpu_peaks = [r["peak_gpu_mb"] for r in results if r["peak_gpu_mb"] is not None]
+    return {
+        "success": True,
+        "latency": latencies[len(latencies) // 2],
+        "peak_rss_mb": max(r["peak_rss_mb"] for r in results),
+        "peak_gpu_mb": max(gpu_peaks) if gpu_peaks else None,
+    }
+
+def tune_model(model, thread_counts, steps, size, output_dir, timeout, memory_budget_mb=None,
+               repeats=1, min_gain=0.03):
+    """Find the fastest settings for model by tuning one option at a time.
+
+    Memory mode, thread count, flash attention and offloading are searched in turn,
+    each starting from the best settings found so far, which keeps the number of
+    calibration runs linear in the number of options. A candidate must beat the
+    current best by min_gain (a fraction) so timing noise does not add flags."""
+    best_settings = get_model_settings(model)
+    best_result = None
+    runs = []
+
+    def within_budget(result):
+        if memory_budget_mb is None:
+            return True
+        peak = result.get("peak_gpu_mb") or result.get("peak_rss_mb") or 0
+        return peak <= memory_budget_mb
+
+    dimensions = [
+        ("memory_mode", list(MEMORY_MODES)),
+        ("threads", thread_counts),
+        ("diffusion_fa", [True, False]),
+        ("offload", [False, True]),
+    ]
+    for dimension, values in dimensions:
+        for value in values:
+            candidate = _candidate_settings(best_settings, **{dimension: value})
+            result = _calibrate_repeated(model, candidate, steps, size, output_dir, timeout, repeats)
+            runs.append({"settings": candidate, **result})
+            status = f"{result['latency']}s, rss {result['peak_rss_mb']} MB, gpu {result['peak_gpu_mb']} MB" \
+                if result["success"] else f"failed ({result['error']})"
+            log_to_stderr(f"  {model} {dimension}={value}: {status}")
+            if not result["success"] or not within_budget(result):
+                continue
+            if best_result is None or result["latency"] < best_result["latency"] * (1 - min_gain):
+                best_settings, best_result = candidate, result
+    return best_settings, best_result, runs
+
+def write_model_settings(config_path, tuned):
+    """Merge tuned per-model settings into the model_settings section of diffugen.json"""
+    with open(config_path, "r") as f:
+        diffugen_config = json.load(f)
+    server_config = diffugen_config.setdefault("mcpServers", {}).setdefault("diffugen", {})
+    model_settings = server_config.setdefault("model_settings", {})
+    for model, settings in tuned.items():
+        model_settings[model] = settings
+    with open(config_path, "w") as f:
+        json.dump(diffugen_config, f, indent=2)
+        f.write("\n")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Auto-tune sd.cpp hardware flags per model")
+    parser.add_argument("--models", type=str, default=None,
+                        help="Comma-separated models to tune (default: every installed model)")
+    parser.add_argument("--threads", type=str, default=None,
+                        help="Comma-separated CPU thread counts to try (default: quarter, half and all cores)")
+    parser.add_argument("--steps", type=int, default=2, help="Diffusion steps per calibration run")
+    parser.add_argument("--size", type=int, default=512, help="Calibration image width and height")
+    parser.add_argument("--repeats", type=int, default=1, help="Calibration runs per candidate (median is used)")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds before a calibration run is killed")
+    parser.add_argument("--memory-budget-mb", type=float, dest="memory_budget_mb", default=None,
+                        help="Reject settings whose peak memory exceeds this many MB")
+    parser.add_argument("--config", type=str, default=os.path.join(os.getcwd(), "diffugen.json"),
+                        help="diffugen.json to update")
+    parser.add_argument("--report", type=str, default=None, help="Write every calibration run to this JSON file")
+    parser.add_argument("--dry-run", action="store_true", help="Print the chosen settings without writing them")
+    args = parser.parse_args(argv)
+
+    models = args.models.split(",") if args.models else _installed_models()
+    if not models:
+        log_to_stderr("No installed models found, nothing to tune")
+        return 1
+    thread_counts = [int(t) for t in args.threads.split(",")] if args.threads else _default_thread_counts()
+
+    tuned = {}
+    report = {}
+    with tempfile.TemporaryDirectory(prefix="diffugen-autotune-") as output_dir:
+        for model in models:
+            log_to_stderr(f"Tuning {model}...")
+            settings, result, runs = tune_model(model, thread_counts, args.steps, args.size,
+                                                output_dir, args.timeout, args.memory_budget_mb, args.repeats)
+            report[model] = runs
+            if result is None:
+                log_to_stderr(f"  No working settings found for {model}, leaving it unchanged")
+                continue
+            tuned[model] = dict(settings, tuned_latency=result["latency"], tuned_peak_rss_mb=result["peak_rss_mb"],
+                                tuned_peak_gpu_mb=result["peak_gpu_mb"], tuned_at=time.strftime("%Y-%m-%dT%H:%M:%S"))
+            log_to_stderr(f"  Best for {model}: {json.dumps(settings)} ({result['latency']}s)")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+    print(json.dumps(tuned, indent=2))
+    if args.dry_run or not tuned:
+        return 0
+    try:
+        write_model_settings(args.config, tuned)
+        log_to_stderr(f"Wrote model_settings for {', '.join(tuned)} to {args.config}")
+    except Exception as e:
+        log_to_stderr(f"Could not update {args.config}: {e}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
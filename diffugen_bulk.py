@@ -0,0 +1,260 @@
+"""Resumable bulk generation from a JSONL or CSV manifest.
+
+Each manifest entry is one generation: a JSON object per line, or a CSV row
+under a header, with a prompt and any of the generate parameters:
+
+    {"id": "fox-01", "prompt": "a red fox in snow", "model": "sdxl", "steps": 25, "seed": 7}
+
+DiffuGen is imported once and the entries run on a thread pool in this process,
+waiting their turn for a generation slot. With --broker they are submitted to a
+shared job broker and run by its workers instead (see diffugen_worker.py).
+
+Every finished entry is appended to a results manifest (JSONL) right away. Run
+the same command again after a crash or Ctrl-C and entries that already
+succeeded are skipped; failed ones are retried. Entries are identified by their
+"id", or by their contents when they have none.
+
+    python diffugen_bulk.py prompts.jsonl --results results.jsonl --concurrency 2
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from diffugen_jobs import FINISHED_STATES, SUCCEEDED, CancelToken
+
+# Entry fields and how CSV values are converted
+ENTRY_FIELDS = {
+    "prompt": str, "model": str, "width": int, "height": int, "steps": int, "cfg_scale": float, "seed": int,
+    "sampling_method": str, "negative_prompt": str, "hires": str, "hires_strength": float,
+    "fast_decode": lambda value: str(value).lower() in ("1", "true", "yes"), "variant": str,
+}
+
+def _entry_key(entry, seen):
+    """Stable identity of an entry: its id, else a hash of its contents (numbered when repeated)"""
+    if entry.get("id") not in (None, ""):
+        return str(entry["id"])
+    digest = hashlib.sha1(json.dumps(entry, sort_keys=True).encode()).hexdigest()[:12]
+    seen[digest] = seen.get(digest, 0) + 1
+    return digest if seen[digest] == 1 else f"{digest}-{seen[digest]}"
+
+def read_manifest(path):
+    """Entries of a JSONL or CSV manifest as (line, key, params, error) tuples, in order"""
+    entries = []
+    seen = {}
+    with open(path, newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = [(index + 2, {key: value for key, value in row.items() if value not in (None, "")})
+                    for index, row in enumerate(csv.DictReader(f))]
+        else:
+            rows = []
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip() or line.lstrip().startswith("#"):
+                    continue
+                try:
+                    rows.append((line_number, json.loads(line)))
+                except ValueError as e:
+                    rows.append((line_number, {"_error": f"Invalid JSON: {e}"}))
+    for line_number, raw in rows:
+        if not isinstance(raw, dict):
+            raw = {"_error": "Entry is not a JSON object"}
+        error = raw.pop("_error", None)
+        # Unreadable lines have no contents to identify them by
+        key = f"line-{line_number}" if error else _entry_key(raw, seen)
+        params = {}
+        unknown = [name for name in raw if name not in ENTRY_FIELDS and name != "id"]
+        if error is None and unknown:
+            error = f"Unknown fields: {', '.join(unknown)}"
+        if error is None and not raw.get("prompt"):
+            error = "Entry has no prompt"
+        if error is None:
+            try:
+                params = {name: ENTRY_FIELDS[name](value) for name, value in raw.items() if name != "id"}
+            except (TypeError, ValueError) as e:
+                error = f"Invalid value: {e}"
+        entries.append((line_number, key, params, error))
+    return entries
+
+def completed_keys(results_path):
+    """Keys of entries the results manifest records as succeeded"""
+    done = set()
+    if not os.path.exists(results_path):
+        return done
+    with open(results_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash; that entry runs again
+                continue
+            if record.get("status") == "succeeded":
+                done.add(record["id"])
+    return done
+
+class ResultsWriter:
+    """Appends result records to the results manifest, one durable line each"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        cut_short = False
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                if f.seek(0, os.SEEK_END) > 0:
+                    f.seek(-1, os.SEEK_END)
+                    cut_short = f.read(1) != b"\n"
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+        if cut_short:
+            # End the line a crash cut short, so the next record is not appended to it
+            self._file.write("\n")
+
+    def write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+def _record(line_number, key, params, result, started):
+    record = {"id": key, "line": line_number, "status": "succeeded" if result.get("success") else "failed",
+              "prompt": params.get("prompt"), "model": result.get("model") or params.get("model"),
+              "image_path": result.get("image_path"), "seed": result.get("seed"), "error": result.get("error"),
+              "timings": result.get("timings"), "seconds": round(time.time() - started, 3),
+              "finished_at": time.time()}
+    if result.get("error_type"):
+        record["error_type"] = result["error_type"]
+    return record
+
+def run_local(diffugen, params, output_dir, token):
+    """Generate one entry in this process, waiting for a free generation slot"""
+    model = (params.get("model") or diffugen.config["default_model"] or "flux-schnell").lower()
+    arguments = dict(params, model=model, output_dir=output_dir)
+    generate = diffugen.generate_flux_image if model.startswith("flux-") else diffugen.generate_stable_diffusion_image
+    if model.startswith("flux-"):
+        arguments.pop("negative_prompt", None)
+    with diffugen.cancel_scope(token, wait_for_slot=True), diffugen.tenant_scope("bulk", "batch"):
+        return generate(**arguments)
+
+def run_job(diffugen, params, output_dir, token, poll_interval=1.0):
+    """Generate one entry on the broker's workers and copy the image into output_dir"""
+    submitted = diffugen.submit_generation_job(**params)
+    if not submitted.get("success"):
+        return submitted
+    job_id = submitted["job_id"]
+    manager = diffugen.get_job_manager()
+    while True:
+        if token.cancelled:
+            manager.cancel(job_id)
+            return {"success": False, "error": "Generation cancelled", "error_type": "cancelled"}
+        job = manager.get(job_id)
+        if job is None:
+            return {"success": False, "error": f"Job {job_id} expired"}
+        if job["status"] in FINISHED_STATES:
+            break
+        token.wait(poll_interval)
+    result = dict(job.get("result") or {}, job_id=job_id)
+    if job["status"] != SUCCEEDED:
+        result.update(success=False, error=job.get("error") or result.get("error"))
+        return result
+    image = manager.get_image(job_id)
+    if image is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        result["image_path"] = os.path.join(output_dir, os.path.basename(result["image_path"]))
+        with open(result["image_path"], "wb") as f:
+            f.write(image)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate every entry of a JSONL or CSV manifest, resumably")
+    parser.add_argument("manifest", help="JSONL or CSV file with one generation per line/row")
+    parser.add_argument("--results", default=None,
+                        help="Results manifest to append to and resume from (default: <manifest>.results.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Entries in flight at once")
+    parser.add_argument("--output-dir", dest="output_dir", default=None, help="Directory for the images")
+    parser.add_argument("--broker", default=None,
+                        help="Run the entries on a shared job broker's workers (sqlite:///... or redis://...)")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after this many entries")
+    args = parser.parse_args(argv)
+
+    results_path = args.results or os.path.splitext(args.manifest)[0] + ".results.jsonl"
+    try:
+        entries = read_manifest(args.manifest)
+    except OSError as e:
+        print(f"Could not read manifest: {e}", file=sys.stderr)
+        return 1
+    done = completed_keys(results_path)
+    pending = [entry for entry in entries if entry[1] not in done]
+    skipped = len(entries) - len(pending)
+    if args.limit is not None:
+        pending = pending[:args.limit]
+
+    # diffugen reads its configuration on first use, after these
+    if args.broker:
+        os.environ["DIFFUGEN_BROKER"] = args.broker
+        os.environ["DIFFUGEN_LOCAL_WORKERS"] = "0"
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import diffugen
+    if args.broker and diffugen.config["broker"].startswith("memory"):
+        diffugen.log_to_stderr("--broker needs a shared broker: sqlite:///... or redis://...")
+        return 1
+    output_dir = args.output_dir or diffugen.get_default_output_dir()
+    run = run_job if args.broker else run_local
+
+    diffugen.log_to_stderr(f"{len(entries)} entries, {skipped} already done, {len(pending)} to run "
+                           f"with concurrency {args.concurrency}; results in {results_path}")
+    writer = ResultsWriter(results_path)
+    token = CancelToken()
+    counts = {"succeeded": 0, "failed": 0}
+
+    def process(entry):
+        line_number, key, params, error = entry
+        started = time.time()
+        if error is not None:
+            result = {"success": False, "error": error, "error_type": "invalid"}
+        else:
+            try:
+                result = run(diffugen, params, output_dir, token)
+            except Exception as e:
+                result = {"success": False, "error": f"Unexpected error: {e}"}
+        if result.get("error_type") == "cancelled":
+            # Interrupted, not failed: it runs again on resume without a failure on record
+            return
+        record = _record(line_number, key, params, result, started)
+        writer.write(record)
+        counts[record["status"]] += 1
+        diffugen.log_to_stderr(f"[{counts['succeeded'] + counts['failed']}/{len(pending)}] {key}: "
+                               f"{record['status']} {record['image_path'] or record['error']}")
+
+    pool = ThreadPoolExecutor(max_workers=max(1, args.concurrency))
+    try:
+        remaining = iter(pending)
+        in_flight = set()
+        while True:
+            # Submit lazily so an interrupt leaves the rest of the manifest untouched
+            while len(in_flight) < max(1, args.concurrency):
+                entry = next(remaining, None)
+                if entry is None:
+                    break
+                in_flight.add(pool.submit(process, entry))
+            if not in_flight:
+                break
+            _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+    except KeyboardInterrupt:
+        diffugen.log_to_stderr("Interrupted; stopping running generations. Run the same command again to resume")
+        token.cancel("interrupted")
+    finally:
+        pool.shutdown(wait=True)
+        writer.close()
+    diffugen.log_to_stderr(f"Done: {counts['succeeded']} succeeded, {counts['failed']} failed")
+    return 1 if counts["failed"] or token.cancelled else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
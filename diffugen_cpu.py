@@ -0,0 +1,138 @@
+"""CPU thread budgeting and core/NUMA pinning for sd.cpp processes.
+
+The cpu section of diffugen.json (or the DIFFUGEN_SD_THREADS,
+DIFFUGEN_CPU_AFFINITY, DIFFUGEN_RESERVED_CORES and DIFFUGEN_NUMA_NODE
+environment variables) decides which cores sd.cpp may run on and how many
+threads it starts. Reserved cores are never given to sd.cpp, so the server's
+event loop stays responsive while images render.
+"""
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+def parse_cpu_list(value):
+    """Parse a Linux cpulist ("0-3,8,10-11") or a list of ints into a sorted list of cores"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (list, tuple, set)):
+        return sorted({int(core) for core in value})
+    cores = set()
+    for part in str(value).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            cores.update(range(int(start), int(end) + 1))
+        else:
+            cores.add(int(part))
+    return sorted(cores)
+
+def numa_node_cpus(node):
+    """Cores belonging to a NUMA node, or None if the node is unknown"""
+    try:
+        with open(f"/sys/devices/system/node/node{int(node)}/cpulist", "r") as f:
+            return parse_cpu_list(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def _available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+class CpuPlan:
+    """Where sd.cpp processes run and how many threads they use"""
+
+    def __init__(self, cores=None, threads=None, numa_node=None, use_numactl=False):
+        self.cores = cores
+        self.threads = threads
+        self.numa_node = numa_node
+        self.use_numactl = use_numactl
+
+    def wrap_command(self, command):
+        """Prefix command with numactl when NUMA memory binding is requested"""
+        if self.use_numactl and self.numa_node is not None:
+            return ["numactl", f"--cpunodebind={self.numa_node}", f"--membind={self.numa_node}"] + list(command)
+        return list(command)
+
+    @contextmanager
+    def pinned(self):
+        """Apply the core affinity to processes spawned inside this block.
+
+        A child inherits the affinity mask of the thread that spawns it, so the
+        spawning thread is pinned for the duration of the spawn and restored
+        afterwards. Unlike preexec_fn this is safe in a multi-threaded server and,
+        unlike pinning the child after spawn, sd.cpp never starts a thread outside the mask."""
+        if not self.cores or not hasattr(os, "sched_setaffinity"):
+            yield
+            return
+        previous = os.sched_getaffinity(0)
+        try:
+            os.sched_setaffinity(0, self.cores)
+        except OSError as e:
+            logging.warning(f"Could not pin sd.cpp to cores {self.cores}: {e}")
+            yield
+            return
+        try:
+            yield
+        finally:
+            os.sched_setaffinity(0, previous)
+
+    def describe(self):
+        return {"cores": self.cores, "threads": self.threads, "numa_node": self.numa_node}
+
+def plan_cpu(cpu_config, concurrent_workers=1):
+    """Resolve the cpu configuration section into a CpuPlan.
+
+    cpu_config keys (all optional):
+        threads: sd.cpp threads per worker
+        affinity: cores sd.cpp may use (cpulist string or list)
+        reserved_cores: cores kept free for the server process
+        numa_node: restrict sd.cpp to one NUMA node's cores (and memory, with numactl)
+    """
+    cpu_config = cpu_config or {}
+    available = _available_cpus()
+    cores = parse_cpu_list(cpu_config.get("affinity"))
+    numa_node = cpu_config.get("numa_node")
+    use_numactl = False
+
+    if numa_node is not None:
+        node_cores = numa_node_cpus(numa_node)
+        if node_cores is None:
+            logging.warning(f"NUMA node {numa_node} not found, ignoring numa_node")
+            numa_node = None
+        else:
+            cores = sorted(set(cores or node_cores) & set(node_cores))
+            use_numactl = shutil.which("numactl") is not None
+            if not use_numactl:
+                logging.info("numactl not installed, pinning sd.cpp to NUMA node cores without memory binding")
+
+    reserved = parse_cpu_list(cpu_config.get("reserved_cores")) or []
+    if reserved:
+        cores = sorted(set(cores or available) - set(reserved))
+        if not cores:
+            logging.warning("reserved_cores leaves no cores for sd.cpp, ignoring reservation")
+            cores = available
+
+    threads = cpu_config.get("threads")
+    if threads is None and cores:
+        # Don't start more threads than the cores sd.cpp is allowed to use
+        threads = max(1, len(cores) // max(1, concurrent_workers))
+    return CpuPlan(cores=cores, threads=int(threads) if threads else None,
+                   numa_node=numa_node, use_numactl=use_numactl)
+
+_plan = None
+_plan_lock = threading.Lock()
+
+def get_cpu_plan(cpu_config, concurrent_workers=1):
+    """Resolve the CPU plan once per process"""
+    global _plan
+    with _plan_lock:
+        if _plan is None:
+            _plan = plan_cpu(cpu_config, concurrent_workers)
+            if _plan.cores or _plan.threads:
+                logging.info(f"sd.cpp CPU plan: {_plan.describe()}")
+        return _plan
@@ -0,0 +1,85 @@
+"""Generation latency model and queue ETA prediction.
+
+The latency model learns, per model, how long sd.cpp takes per step per
+megapixel and how much fixed overhead (model load, decode, save) each run has,
+from the timings of completed generations. It starts from rough priors and
+follows the hardware with an exponentially weighted average, so it adapts to
+auto-tuned settings and to load changes.
+
+Queue ETAs come from replaying the job queue in claim order over the available
+workers: each job starts when the earliest busy worker is predicted to finish.
+"""
+import heapq
+import threading
+import time
+
+# Rough priors for a mid-range GPU, replaced by measurements as generations complete
+DEFAULT_PRIORS = {
+    "flux-schnell": {"seconds_per_step_mp": 2.0, "overhead_seconds": 15.0},
+    "flux-dev": {"seconds_per_step_mp": 2.0, "overhead_seconds": 15.0},
+    "sdxl": {"seconds_per_step_mp": 0.6, "overhead_seconds": 8.0},
+    "sd3": {"seconds_per_step_mp": 0.8, "overhead_seconds": 10.0},
+    "sd15": {"seconds_per_step_mp": 0.3, "overhead_seconds": 4.0},
+}
+FALLBACK_PRIOR = {"seconds_per_step_mp": 1.0, "overhead_seconds": 10.0}
+
+class LatencyModel:
+    """Per-model seconds per step-megapixel and per-run overhead, learned online"""
+
+    def __init__(self, alpha=0.2, priors=None):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._models = {model: dict(prior, samples=0) for model, prior in (priors or DEFAULT_PRIORS).items()}
+
+    def predict(self, model, steps, width, height):
+        """Predicted sd.cpp run time in seconds"""
+        with self._lock:
+            params = self._models.get(model, FALLBACK_PRIOR)
+            return params["overhead_seconds"] + params["seconds_per_step_mp"] * steps * width * height / 1_000_000
+
+    def observe(self, model, steps, width, height, timings):
+        """Learn from a completed generation's timings (see diffugen._build_timings)"""
+        total = timings.get("process_total")
+        work = steps * width * height / 1_000_000
+        if not total or work <= 0:
+            return
+        # sd.cpp reports its sampling time; without it, attribute the run to sampling after the prior overhead
+        sampling = timings.get("sampling")
+        with self._lock:
+            params = self._models.setdefault(model, dict(FALLBACK_PRIOR, samples=0))
+            if sampling is None:
+                sampling = max(0.0, total - params["overhead_seconds"])
+            per_step_mp = sampling / work
+            overhead = max(0.0, total - sampling)
+            # The first measurement replaces the prior outright
+            alpha = 1.0 if params["samples"] == 0 else self.alpha
+            params["seconds_per_step_mp"] += alpha * (per_step_mp - params["seconds_per_step_mp"])
+            params["overhead_seconds"] += alpha * (overhead - params["overhead_seconds"])
+            params["samples"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {model: {name: round(value, 4) for name, value in params.items()}
+                    for model, params in self._models.items()}
+
+def schedule_etas(running, queued, workers, predict, now=None):
+    """Estimate (start, completion) Unix times for running and queued jobs.
+
+    running and queued are job records (queued in claim order), workers the number
+    of jobs that run at once, and predict(job) a job's predicted run time."""
+    now = now or time.time()
+    etas = {}
+    free_at = []
+    for job in running:
+        started = job.get("started_at") or now
+        completion = max(now, started + predict(job))
+        etas[job["id"]] = (started, completion)
+        free_at.append(completion)
+    free_at.extend([now] * max(0, workers - len(free_at)))
+    heapq.heapify(free_at)
+    for job in queued:
+        start = heapq.heappop(free_at)
+        completion = start + predict(job)
+        etas[job["id"]] = (start, completion)
+        heapq.heappush(free_at, completion)
+    return etas
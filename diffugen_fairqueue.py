@@ -0,0 +1,152 @@
+"""Weighted fair queuing across tenants and priority classes.
+
+Requests are grouped into flows, one per (tenant, priority class), and served by
+self-clocked fair queuing: each request gets a virtual finish tag
+
+    finish = max(virtual_time, flow's last finish) + cost / weight
+
+and the request with the smallest tag runs next. A flow's weight is the tenant's
+weight times its priority class weight, so an interactive request from a normal
+tenant overtakes a backlog of batch jobs, and a tenant submitting a hundred
+flux-dev jobs only gets its share of the GPU while others are waiting. Idle flows
+start again at the current virtual time, so nobody can bank credit.
+
+The scheduling section of diffugen.json configures the class weights:
+
+    "scheduling": {"classes": {"interactive": 4, "batch": 1}, "default_class": "interactive"}
+
+Tenant weights come from the API that identifies the tenant (see the api_keys
+entries in openapi_config.json).
+"""
+import heapq
+import itertools
+import threading
+
+DEFAULT_CLASSES = {"interactive": 4.0, "batch": 1.0}
+DEFAULT_TENANT = "local"
+
+class FairPolicy:
+    """Priority classes and how they weigh against each other"""
+
+    def __init__(self, scheduling_config=None):
+        scheduling_config = scheduling_config or {}
+        self.classes = {name: float(weight) for name, weight in
+                        scheduling_config.get("classes", DEFAULT_CLASSES).items()}
+        self.default_class = scheduling_config.get("default_class", "interactive")
+        if self.default_class not in self.classes:
+            self.default_class = next(iter(self.classes))
+
+    def priority(self, priority):
+        """Map a requested priority class to a configured one"""
+        return priority if priority in self.classes else self.default_class
+
+    def weight(self, priority, tenant_weight=1.0):
+        return max(float(tenant_weight or 1.0), 0.001) * self.classes[self.priority(priority)]
+
+def fair_tags(virtual_time, last_finish, cost, weight):
+    """Start and finish tags for a request joining a flow"""
+    start = max(virtual_time, last_finish or 0.0)
+    return start, start + max(float(cost), 0.001) / weight
+
+class FairQueue:
+    """In-memory fair queue of items keyed by flow. Not thread-safe; callers hold a lock"""
+
+    def __init__(self):
+        self.virtual_time = 0.0
+        self._heap = []
+        self._last_finish = {}
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def push(self, item_id, flow, cost, weight, item=None):
+        """Queue item_id for flow; returns its finish tag"""
+        _, finish = fair_tags(self.virtual_time, self._last_finish.get(flow), cost, weight)
+        self._last_finish[flow] = finish
+        entry = [finish, next(self._counter), item_id, flow, item]
+        self._entries[item_id] = entry
+        heapq.heappush(self._heap, entry)
+        return finish
+
+    def _drop_removed(self):
+        while self._heap and self._heap[0][2] not in self._entries:
+            heapq.heappop(self._heap)
+
+    def peek(self):
+        """The item_id that runs next, or None"""
+        self._drop_removed()
+        return self._heap[0][2] if self._heap else None
+
+    def pop(self):
+        """Remove and return (item_id, item) for the next request, advancing virtual time"""
+        self._drop_removed()
+        if not self._heap:
+            return None
+        item_id, item = self._heap[0][2], self._heap[0][4]
+        self.remove(item_id, served=True)
+        return item_id, item
+
+    def remove(self, item_id, served=False):
+        """Drop a queued item; served advances virtual time to it, otherwise it was
+        cancelled or gave up. Returns True if it was queued"""
+        entry = self._entries.pop(item_id, None)
+        if entry is None:
+            return False
+        if served:
+            self.virtual_time = max(self.virtual_time, entry[0])
+            # Flows that have fallen behind virtual time restart from it anyway
+            if len(self._last_finish) > 1000:
+                self._last_finish = {f: t for f, t in self._last_finish.items() if t > self.virtual_time}
+        return True
+
+    def ordered(self, limit=None):
+        """(item_id, item) of queued items in the order they will be served"""
+        entries = sorted(self._entries.values())[:limit]
+        return [(entry[2], entry[4]) for entry in entries]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, item_id):
+        return item_id in self._entries
+
+    def depths(self):
+        """Queued items per flow"""
+        counts = {}
+        for entry in self._entries.values():
+            counts[entry[3]] = counts.get(entry[3], 0) + 1
+        return counts
+
+class FairGate:
+    """Orders threads waiting for a shared resource (the generation slots) fairly.
+
+    Only the waiter at the head of the fair queue may try to take a slot, so
+    slots freed in this process go to waiters in fair order."""
+
+    def __init__(self):
+        self._queue = FairQueue()
+        self._condition = threading.Condition()
+        self._tickets = itertools.count()
+
+    def join(self, flow, cost, weight):
+        with self._condition:
+            ticket = next(self._tickets)
+            self._queue.push(ticket, flow, cost, weight)
+            return ticket
+
+    def is_next(self, ticket):
+        with self._condition:
+            return self._queue.peek() == ticket
+
+    def leave(self, ticket, served):
+        """Remove ticket after it was served (advancing virtual time) or gave up"""
+        with self._condition:
+            self._queue.remove(ticket, served=served)
+            self._condition.notify_all()
+
+    def wait(self, timeout):
+        with self._condition:
+            self._condition.wait(timeout)
+
+    def depths(self):
+        with self._condition:
+            return self._queue.depths()
@@ -0,0 +1,1101 @@
+"""Asynchronous generation jobs and the brokers that carry them.
+
+A broker stores jobs, hands queued jobs to workers and keeps their results:
+
+    memory://              in-process only, lost when the process exits
+    sqlite:///path/jobs.db durable, shared by every process on one host (the default)
+    redis://host:6379/0    shared by API and worker nodes across machines;
+                           any server speaking the Redis protocol will do
+
+API processes submit jobs and read results. Workers (threads inside the API
+process, or diffugen_worker.py on GPU nodes) claim jobs, run them through the
+normal generate functions and publish the result together with the image
+bytes, so every API node can serve the image.
+
+Queued jobs are claimed in weighted fair order across tenants and priority
+classes (see diffugen_fairqueue), not first come first served.
+
+With a durable broker, queued jobs survive a restart and are picked up again
+by the next worker. Running jobs send heartbeats; a job whose worker process
+has exited, or that has not sent one within the lease, is marked failed.
+Finished jobs stay queryable for the retention period.
+
+A finished job's completion webhook is recorded in the job as pending until it
+is delivered or given up, together with the process delivering it. Pending
+webhooks of a process that exited are delivered again by the next process on
+its host, with the same delivery ID (the job ID).
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+
+from diffugen_fairqueue import DEFAULT_TENANT, FairQueue, fair_tags
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+# Completion webhook states
+WEBHOOK_PENDING = "pending"
+WEBHOOK_DELIVERED = "delivered"
+WEBHOOK_FAILED = "failed"
+
+class CancelToken:
+    """Signals that a generation should stop; callbacks run once, on the first cancel"""
+
+    def __init__(self):
+        self.reason = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        """Call callback on cancel (immediately if already cancelled); returns a function that removes it"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def wait(self, timeout):
+        return self._event.wait(timeout)
+
+def _process_alive(pid):
+    """Check whether a process with this PID exists on this host"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def new_job(tool, params, tenant=DEFAULT_TENANT, priority="interactive", weight=1.0, cost=1.0, callback_url=None):
+    """Create a queued job record.
+    
+    weight is the flow's fair queuing weight and cost the job's estimated work.
+    callback_url receives a webhook when the job finishes (see diffugen_webhooks)."""
+    return {
+        "id": uuid.uuid4().hex,
+        "status": QUEUED,
+        "tool": tool,
+        "params": params,
+        "tenant": tenant,
+        "priority": priority,
+        "weight": weight,
+        "cost": cost,
+        "submitted_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "worker": None,
+        "heartbeat_at": None,
+        "result": None,
+        "error": None,
+        "cancel_requested": False,
+        "callback_url": callback_url,
+        "webhook_status": None,
+        "webhook_owner": None,
+    }
+
+class MemoryBroker:
+    """Jobs kept in this process only"""
+    stores_images = False
+
+    def __init__(self):
+        self._jobs = {}
+        self._queue = FairQueue()
+        self._condition = threading.Condition()
+
+    def submit(self, job):
+        with self._condition:
+            self._jobs[job["id"]] = dict(job)
+            self._queue.push(job["id"], (job["tenant"], job["priority"]), job["cost"], job["weight"])
+            self._condition.notify()
+        return job
+
+    def claim(self, worker, timeout=1.0):
+        deadline = time.time() + timeout
+        with self._condition:
+            while not self._queue:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            job_id, _ = self._queue.pop()
+            job = self._jobs[job_id]
+            now = time.time()
+            job.update(status=RUNNING, worker=worker, started_at=now, heartbeat_at=now)
+            return dict(job)
+
+    def finish(self, job_id, status, result=None, error=None, image=None, worker=None):
+        """Record the outcome of a job that is still running (on worker, if given).
+        Returns whether it was, so a result that lost a race with recovery is dropped"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != RUNNING or (worker is not None and job["worker"] != worker):
+                return False
+            job.update(status=status, result=result, error=error, finished_at=time.time())
+            return True
+
+    def progress(self, job_id, result):
+        """Publish the partial result of a running job"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is not None and job["status"] == RUNNING:
+                job["result"] = result
+
+    def heartbeat(self, job_id):
+        """Record that a running job's worker is alive"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job["heartbeat_at"] = time.time()
+
+    def stale_running(self, lease_seconds):
+        """Running jobs without a heartbeat for lease_seconds"""
+        cutoff = time.time() - lease_seconds
+        with self._condition:
+            return [dict(job) for job in self._jobs.values()
+                    if job["status"] == RUNNING and (job.get("heartbeat_at") or job["started_at"] or 0) < cutoff]
+
+    def fail_running(self, job_id, error):
+        """Mark a job failed if it is still running. Returns whether it was"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != RUNNING:
+                return False
+            job.update(status=FAILED, error=error, finished_at=time.time())
+            return True
+
+    def purge(self, finished_before):
+        """Delete jobs that finished before the given time. Returns how many"""
+        with self._condition:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job["status"] in FINISHED_STATES and (job["finished_at"] or 0) < finished_before]
+            for job_id in expired:
+                del self._jobs[job_id]
+        return len(expired)
+
+    def get(self, job_id):
+        with self._condition:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def get_image(self, job_id):
+        return None
+
+    def cancel(self, job_id):
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job["status"] == QUEUED:
+                self._queue.remove(job_id)
+                job.update(status=CANCELLED, error="Cancelled before it started", finished_at=time.time())
+            elif job["status"] == RUNNING:
+                job["cancel_requested"] = True
+            return dict(job)
+
+    def set_webhook(self, job_id, status, owner, expected_owner=None):
+        """Record a job's webhook state and the process delivering it. With expected_owner, only
+        while that process still owns it (taking over from an exited one). Returns whether it was set"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or (expected_owner is not None and job.get("webhook_owner") != expected_owner):
+                return False
+            job.update(webhook_status=status, webhook_owner=owner)
+            return True
+
+    def pending_webhooks(self, limit=1000):
+        """Finished jobs whose completion webhook has not been delivered or given up yet"""
+        with self._condition:
+            return [dict(job) for job in self._jobs.values() if job.get("webhook_status") == WEBHOOK_PENDING][:limit]
+
+    def list(self, status=None, limit=50, tenant=None):
+        with self._condition:
+            jobs = [dict(job) for job in self._jobs.values()
+                    if (status is None or job["status"] == status) and (tenant is None or job["tenant"] == tenant)]
+        return sorted(jobs, key=lambda job: job["submitted_at"], reverse=True)[:limit]
+
+    def queue_length(self):
+        with self._condition:
+            return len(self._queue)
+
+    def queued(self, limit=1000):
+        """Queued jobs in the order workers will claim them"""
+        with self._condition:
+            return [dict(self._jobs[job_id]) for job_id, _ in self._queue.ordered(limit)]
+
+    def queue_stats(self):
+        """Queued jobs per (tenant, priority) flow"""
+        with self._condition:
+            return self._queue.depths()
+
+class SQLiteBroker:
+    """Jobs in a SQLite database shared by every process on the host.
+    
+    The database runs in WAL mode, so readers (status polls) never block the
+    writers that submit, claim and finish jobs, and every commit is durable."""
+    stores_images = True
+
+    def __init__(self, path, poll_interval=0.25):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection(immediate=True) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    tool TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    submitted_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    worker TEXT,
+                    result TEXT,
+                    error TEXT,
+                    image BLOB
+                )
+            """)
+            # Columns added since the first release are migrated in place
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            for column, definition in self._ADDED_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, submitted_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_fair ON jobs (status, fair_finish)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_webhook ON jobs (webhook_status)")
+            # Fair queuing state: each flow's last finish tag, and the virtual time under flow ''
+            conn.execute("CREATE TABLE IF NOT EXISTS fair_flows (flow TEXT PRIMARY KEY, last_finish REAL NOT NULL)")
+
+    _ADDED_COLUMNS = {
+        "cancel_requested": "INTEGER NOT NULL DEFAULT 0",
+        "tenant": f"TEXT NOT NULL DEFAULT '{DEFAULT_TENANT}'",
+        "priority": "TEXT NOT NULL DEFAULT 'interactive'",
+        "weight": "REAL NOT NULL DEFAULT 1",
+        "cost": "REAL NOT NULL DEFAULT 1",
+        "fair_finish": "REAL NOT NULL DEFAULT 0",
+        "heartbeat_at": "REAL",
+        "callback_url": "TEXT",
+        "webhook_status": "TEXT",
+        "webhook_owner": "TEXT",
+    }
+
+    def _connection(self, immediate=False):
+        # One connection per thread; sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            # WAL is a property of the database file; NORMAL sync is durable across process crashes in WAL mode
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return _Transaction(conn, immediate)
+
+    @staticmethod
+    def _row_to_job(row):
+        if row is None:
+            return None
+        job = {
+            "id": row[0], "status": row[1], "tool": row[2], "params": json.loads(row[3]),
+            "submitted_at": row[4], "started_at": row[5], "finished_at": row[6], "worker": row[7],
+            "result": json.loads(row[8]) if row[8] else None, "error": row[9],
+            "cancel_requested": bool(row[10]), "tenant": row[11], "priority": row[12],
+            "weight": row[13], "cost": row[14], "heartbeat_at": row[15], "callback_url": row[16],
+            "webhook_status": row[17], "webhook_owner": row[18],
+        }
+        return job
+
+    _COLUMNS = ("id, status, tool, params, submitted_at, started_at, finished_at, worker, result, error, "
+                "cancel_requested, tenant, priority, weight, cost, heartbeat_at, callback_url, webhook_status, "
+                "webhook_owner")
+
+    @staticmethod
+    def _flow_key(job):
+        return json.dumps([job["tenant"], job["priority"]])
+
+    def submit(self, job):
+        # Reads and updates the flow's finish tag, so it must hold the write lock throughout
+        with self._connection(immediate=True) as conn:
+            virtual_time = conn.execute("SELECT last_finish FROM fair_flows WHERE flow = ''").fetchone()
+            last_finish = conn.execute("SELECT last_finish FROM fair_flows WHERE flow = ?",
+                                       (self._flow_key(job),)).fetchone()
+            _, finish = fair_tags(virtual_time[0] if virtual_time else 0.0, last_finish[0] if last_finish else None,
+                                  job["cost"], job["weight"])
+            conn.execute("INSERT OR REPLACE INTO fair_flows (flow, last_finish) VALUES (?, ?)",
+                         (self._flow_key(job), finish))
+            conn.execute(
+                "INSERT INTO jobs (id, status, tool, params, submitted_at, tenant, priority, weight, cost, fair_finish, "
+                "callback_url) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job["id"], job["status"], job["tool"], json.dumps(job["params"]), job["submitted_at"],
+                 job["tenant"], job["priority"], job["weight"], job["cost"], finish, job.get("callback_url"))
+            )
+        return job
+
+    def claim(self, worker, timeout=1.0):
+        deadline = time.time() + timeout
+        while True:
+            # Look for a job without the write lock, so idle workers polling an empty queue never block writers
+            with self._connection() as conn:
+                candidate = conn.execute("SELECT id FROM jobs WHERE status = ? LIMIT 1", (QUEUED,)).fetchone()
+            if candidate is not None:
+                with self._connection(immediate=True) as conn:
+                    row = conn.execute(
+                        f"SELECT {self._COLUMNS}, fair_finish FROM jobs WHERE status = ? "
+                        "ORDER BY fair_finish, submitted_at LIMIT 1", (QUEUED,)
+                    ).fetchone()
+                    if row is not None:
+                        started_at = time.time()
+                        conn.execute("UPDATE jobs SET status = ?, worker = ?, started_at = ?, heartbeat_at = ? "
+                                     "WHERE id = ?", (RUNNING, worker, started_at, started_at, row[0]))
+                        # Advance virtual time to the claimed job's finish tag
+                        conn.execute("INSERT INTO fair_flows (flow, last_finish) VALUES ('', ?) "
+                                     "ON CONFLICT(flow) DO UPDATE SET last_finish = MAX(last_finish, excluded.last_finish)",
+                                     (row[-1],))
+                        job = self._row_to_job(row)
+                        job.update(status=RUNNING, worker=worker, started_at=started_at, heartbeat_at=started_at)
+                        return job
+                # Another worker claimed it first; look again at once
+                continue
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def finish(self, job_id, status, result=None, error=None, image=None, worker=None):
+        with self._connection(immediate=True) as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, image = ?, finished_at = ? "
+                "WHERE id = ? AND status = ? AND (? IS NULL OR worker = ?)",
+                (status, json.dumps(result) if result is not None else None, error, image, time.time(), job_id,
+                 RUNNING, worker, worker)
+            )
+            return cursor.rowcount > 0
+
+    def progress(self, job_id, result):
+        with self._connection() as conn:
+            conn.execute("UPDATE jobs SET result = ? WHERE id = ? AND status = ?", (json.dumps(result), job_id, RUNNING))
+
+    def heartbeat(self, job_id):
+        with self._connection() as conn:
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def stale_running(self, lease_seconds):
+        with self._connection() as conn:
+            rows = conn.execute(f"SELECT {self._COLUMNS} FROM jobs WHERE status = ? "
+                                "AND COALESCE(heartbeat_at, started_at, 0) < ?",
+                                (RUNNING, time.time() - lease_seconds)).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def fail_running(self, job_id, error):
+        with self._connection(immediate=True) as conn:
+            cursor = conn.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status = ?",
+                                  (FAILED, error, time.time(), job_id, RUNNING))
+            return cursor.rowcount > 0
+
+    def purge(self, finished_before):
+        with self._connection() as conn:
+            cursor = conn.execute(f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(FINISHED_STATES))}) "
+                                  "AND finished_at < ?", (*FINISHED_STATES, finished_before))
+            return cursor.rowcount
+
+    def get(self, job_id):
+        with self._connection() as conn:
+            row = conn.execute(f"SELECT {self._COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row)
+
+    def get_image(self, job_id):
+        with self._connection() as conn:
+            row = conn.execute("SELECT image FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def cancel(self, job_id):
+        with self._connection(immediate=True) as conn:
+            conn.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status = ?",
+                         (CANCELLED, "Cancelled before it started", time.time(), job_id, QUEUED))
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?", (job_id, RUNNING))
+            row = conn.execute(f"SELECT {self._COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row)
+
+    def set_webhook(self, job_id, status, owner, expected_owner=None):
+        with self._connection(immediate=True) as conn:
+            cursor = conn.execute("UPDATE jobs SET webhook_status = ?, webhook_owner = ? "
+                                  "WHERE id = ? AND (? IS NULL OR webhook_owner = ?)",
+                                  (status, owner, job_id, expected_owner, expected_owner))
+            return cursor.rowcount > 0
+
+    def pending_webhooks(self, limit=1000):
+        with self._connection() as conn:
+            rows = conn.execute(f"SELECT {self._COLUMNS} FROM jobs WHERE webhook_status = ? LIMIT ?",
+                                (WEBHOOK_PENDING, limit)).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def list(self, status=None, limit=50, tenant=None):
+        conditions, params = [], []
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status)
+        if tenant is not None:
+            conditions.append("tenant = ?")
+            params.append(tenant)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        with self._connection() as conn:
+            rows = conn.execute(f"SELECT {self._COLUMNS} FROM jobs {where}ORDER BY submitted_at DESC LIMIT ?",
+                                (*params, limit)).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def queue_length(self):
+        with self._connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+
+    def queued(self, limit=1000):
+        with self._connection() as conn:
+            rows = conn.execute(f"SELECT {self._COLUMNS} FROM jobs WHERE status = ? "
+                                "ORDER BY fair_finish, submitted_at LIMIT ?", (QUEUED, limit)).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def queue_stats(self):
+        with self._connection() as conn:
+            rows = conn.execute("SELECT tenant, priority, COUNT(*) FROM jobs WHERE status = ? GROUP BY tenant, priority",
+                                (QUEUED,)).fetchall()
+        return {(tenant, priority): count for tenant, priority, count in rows}
+
+class _Transaction:
+    """Run a block of statements in one immediate (write-locking) SQLite transaction.
+
+    Without immediate, each statement runs on its own in autocommit mode: reads see
+    a consistent WAL snapshot without taking the write lock, and single-statement
+    writes hold it only for that statement."""
+
+    def __init__(self, conn, immediate=False):
+        self.conn = conn
+        self.immediate = immediate
+
+    def __enter__(self):
+        if self.immediate:
+            self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.immediate:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+class RespClient:
+    """Minimal client for the Redis serialization protocol (RESP2)"""
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None, timeout=30):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        # Counts connections, so a transaction can tell that a reconnect dropped its WATCH
+        self.connections = 0
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.connections += 1
+        self._file = self._sock.makefile("rb")
+        if self.password:
+            self._call("AUTH", self.password)
+        if self.db:
+            self._call("SELECT", self.db)
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._file.close()
+                self._sock.close()
+            finally:
+                self._sock = None
+                self._file = None
+
+    def execute(self, *args, timeout=None):
+        """Send one command and return its reply, reconnecting once on a dropped connection"""
+        for attempt in range(2):
+            try:
+                if self._sock is None:
+                    self._connect()
+                self._sock.settimeout(timeout if timeout is not None else self.timeout)
+                return self._call(*args)
+            except (ConnectionError, socket.timeout, OSError):
+                self.close()
+                if attempt:
+                    raise
+
+    def _call(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self._sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("Connection closed by broker")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RuntimeError(f"Broker error: {payload.decode()}")
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            data = self._file.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            count = int(payload)
+            if count == -1:
+                return None
+            return [self._read_reply() for _ in range(count)]
+        raise RuntimeError(f"Unexpected reply from broker: {line!r}")
+
+class RedisBroker:
+    """Jobs in a Redis-protocol server shared by API and worker nodes.
+    
+    The queue is a sorted set scored by fair finish tag. Claims, cancels and other
+    status changes are WATCH/MULTI transactions, so a job is never in neither the
+    queue nor the running state, and a cancel is never overwritten by a claim.
+    Fair queuing state is updated without transactions, so ordering across
+    concurrently submitting API nodes is approximately, not exactly, fair."""
+    stores_images = True
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None, prefix="diffugen", result_ttl=7 * 86400,
+                 poll_interval=0.25):
+        self._client_args = {"host": host, "port": port, "db": db, "password": password}
+        self.prefix = prefix
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+
+    def _client(self):
+        # One connection per thread, since transactions are tied to their connection
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = RespClient(**self._client_args)
+            self._local.client = client
+        return client
+
+    def _key(self, *parts):
+        return ":".join((self.prefix,) + parts)
+
+    def _save(self, job):
+        self._client().execute("SET", self._key("job", job["id"]), json.dumps(job))
+
+    def submit(self, job):
+        client = self._client()
+        flow = json.dumps([job["tenant"], job["priority"]])
+        virtual_time = client.execute("GET", self._key("fair", "vtime"))
+        last_finish = client.execute("HGET", self._key("fair", "flows"), flow)
+        _, finish = fair_tags(float(virtual_time or 0), float(last_finish) if last_finish else None,
+                              job["cost"], job["weight"])
+        client.execute("HSET", self._key("fair", "flows"), flow, repr(finish))
+        self._save(job)
+        client.execute("ZADD", self._key("jobs"), job["submitted_at"], job["id"])
+        client.execute("ZADD", self._key("fairqueue"), repr(finish), job["id"])
+        return job
+
+    def _transaction(self, job_id, change, commands=None):
+        """Change a job record atomically: change(job) edits a copy of the record and returns
+        whether to save it; commands(job) lists further commands to run in the same transaction.
+        Retried when another client writes the record first. Returns (record, changed)"""
+        client = self._client()
+        key = self._key("job", job_id)
+        try:
+            while True:
+                client.execute("WATCH", key)
+                connection = client.connections
+                data = client.execute("GET", key)
+                job = json.loads(data) if data else None
+                if job is None or not change(job):
+                    client.execute("UNWATCH")
+                    return job, False
+                client.execute("MULTI")
+                client.execute("SET", key, json.dumps(job))
+                if job["status"] in FINISHED_STATES:
+                    # SET clears the expiry; finished jobs expire result_ttl after their last change
+                    client.execute("EXPIRE", key, self.result_ttl)
+                for command in (commands(job) if commands else []):
+                    client.execute(*command)
+                if client.connections != connection:
+                    raise ConnectionError("Lost the broker connection during a transaction")
+                if client.execute("EXEC") is not None:
+                    return job, True
+        except Exception:
+            # Never leave the connection inside a transaction
+            client.close()
+            raise
+
+    def claim(self, worker, timeout=1.0):
+        deadline = time.time() + timeout
+        while True:
+            job = self._claim_next(worker)
+            if job is None:
+                # Lost a race for the head of the queue; try the next job at once
+                continue
+            if job is not False:
+                return job
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def _claim_next(self, worker):
+        """Take the queued job with the lowest finish tag in one transaction. Returns the running
+        job, False if the queue is empty, or None if another client changed the queue first"""
+        client = self._client()
+        queue_key, vtime_key = self._key("fairqueue"), self._key("fair", "vtime")
+        try:
+            client.execute("WATCH", queue_key)
+            connection = client.connections
+            head = client.execute("ZRANGE", queue_key, 0, 0, "WITHSCORES")
+            if not head:
+                client.execute("UNWATCH")
+                return False
+            job_id, finish = head[0].decode(), float(head[1])
+            job_key = self._key("job", job_id)
+            client.execute("WATCH", job_key, vtime_key)
+            data = client.execute("GET", job_key)
+            virtual_time = client.execute("GET", vtime_key)
+            job = json.loads(data) if data else None
+            client.execute("MULTI")
+            client.execute("ZREM", queue_key, job_id)
+            if job is not None and job["status"] == QUEUED:
+                now = time.time()
+                job.update(status=RUNNING, worker=worker, started_at=now, heartbeat_at=now)
+                client.execute("SET", job_key, json.dumps(job))
+                if virtual_time is None or float(virtual_time) < finish:
+                    client.execute("SET", vtime_key, repr(finish))
+            if client.connections != connection:
+                raise ConnectionError("Lost the broker connection during a transaction")
+            if client.execute("EXEC") is None:
+                return None
+        except Exception:
+            client.close()
+            raise
+        # An expired job, or one cancelled while it waited, is only dropped from the queue
+        return job if job is not None and job["status"] == RUNNING else None
+
+    def finish(self, job_id, status, result=None, error=None, image=None, worker=None):
+        def change(job):
+            if job["status"] != RUNNING or (worker is not None and job.get("worker") != worker):
+                return False
+            job.update(status=status, result=result, error=error, finished_at=time.time())
+            return True
+        
+        def commands(job):
+            return [("SET", self._key("image", job_id), image, "EX", self.result_ttl)] if image is not None else []
+        _, changed = self._transaction(job_id, change, commands)
+        return changed
+
+    def progress(self, job_id, result):
+        def change(job):
+            if job["status"] != RUNNING:
+                return False
+            job["result"] = result
+            return True
+        self._transaction(job_id, change)
+
+    def heartbeat(self, job_id):
+        # A key of its own, so a heartbeat never overwrites a concurrent cancel request in the job record
+        self._client().execute("SET", self._key("heartbeat", job_id), repr(time.time()), "EX", self.result_ttl)
+
+    def stale_running(self, lease_seconds):
+        cutoff = time.time() - lease_seconds
+        stale = []
+        for job in self.list(status=RUNNING, limit=1000):
+            heartbeat = self._client().execute("GET", self._key("heartbeat", job["id"]))
+            if (float(heartbeat) if heartbeat else job.get("started_at") or 0) < cutoff:
+                stale.append(job)
+        return stale
+
+    def fail_running(self, job_id, error):
+        job = self.get(job_id)
+        if job is None:
+            return False
+        return self.finish(job_id, FAILED, result=job.get("result"), error=error)
+
+    def purge(self, finished_before):
+        # Finished jobs expire on their own after result_ttl
+        return 0
+
+    def get(self, job_id):
+        data = self._client().execute("GET", self._key("job", job_id))
+        return json.loads(data) if data else None
+
+    def get_image(self, job_id):
+        return self._client().execute("GET", self._key("image", job_id))
+
+    def cancel(self, job_id):
+        def change(job):
+            if job["status"] == QUEUED:
+                job.update(status=CANCELLED, error="Cancelled before it started", finished_at=time.time())
+                return True
+            if job["status"] == RUNNING and not job.get("cancel_requested"):
+                job["cancel_requested"] = True
+                return True
+            return False
+        
+        def commands(job):
+            if job["status"] != CANCELLED:
+                return []
+            return [("ZREM", self._key("fairqueue"), job_id)]
+        job, _ = self._transaction(job_id, change, commands)
+        return job
+
+    def set_webhook(self, job_id, status, owner, expected_owner=None):
+        def change(job):
+            if expected_owner is not None and job.get("webhook_owner") != expected_owner:
+                return False
+            job.update(webhook_status=status, webhook_owner=owner)
+            return True
+        _, changed = self._transaction(job_id, change)
+        return changed
+
+    def pending_webhooks(self, limit=1000):
+        # Finished jobs expire after result_ttl, and their pending webhooks with them
+        return [job for job in self.list(limit=10000) if job.get("webhook_status") == WEBHOOK_PENDING][:limit]
+
+    def list(self, status=None, limit=50, tenant=None):
+        client = self._client()
+        # Over-fetch when filtering so a page of the requested status and tenant is usually found
+        filtered = status is not None or tenant is not None
+        ids = client.execute("ZREVRANGE", self._key("jobs"), 0, (limit * 5 if filtered else limit) - 1)
+        jobs = []
+        for job_id in ids or []:
+            job = self.get(job_id.decode())
+            if job is None:
+                # Expired result; drop it from the index
+                client.execute("ZREM", self._key("jobs"), job_id)
+                continue
+            if (status is None or job["status"] == status) and (tenant is None or job.get("tenant") == tenant):
+                jobs.append(job)
+            if len(jobs) >= limit:
+                break
+        return jobs
+
+    def queue_length(self):
+        return self._client().execute("ZCARD", self._key("fairqueue"))
+
+    def queued(self, limit=1000):
+        ids = self._client().execute("ZRANGE", self._key("fairqueue"), 0, limit - 1) or []
+        jobs = [self.get(job_id.decode()) for job_id in ids]
+        return [job for job in jobs if job is not None and job["status"] == QUEUED]
+
+    def queue_stats(self):
+        counts = {}
+        for job_id in self._client().execute("ZRANGE", self._key("fairqueue"), 0, -1) or []:
+            job = self.get(job_id.decode())
+            if job is not None:
+                flow = (job.get("tenant", DEFAULT_TENANT), job.get("priority", "interactive"))
+                counts[flow] = counts.get(flow, 0) + 1
+        return counts
+
+def create_broker(url):
+    """Create a broker from a memory://, sqlite:///path or redis://[:password@]host:port/db URL"""
+    if not url or url == "memory" or url.startswith("memory:"):
+        return MemoryBroker()
+    parsed = urlparse(url)
+    if parsed.scheme == "sqlite":
+        # sqlite:///relative/path or sqlite:////absolute/path, like SQLAlchemy
+        path = unquote(url[len("sqlite:///"):]) if url.startswith("sqlite:///") else unquote(parsed.path)
+        return SQLiteBroker(path)
+    if parsed.scheme == "redis":
+        db = int(parsed.path.lstrip("/") or 0)
+        return RedisBroker(host=parsed.hostname or "localhost", port=parsed.port or 6379, db=db,
+                           password=unquote(parsed.password) if parsed.password else None)
+    raise ValueError(f"Unsupported broker URL: {url}")
+
+class JobManager:
+    """Submits jobs to a broker and optionally runs worker threads that execute them.
+
+    runner(job, cancel_token) runs one generation and returns the generate
+    function's result dict. Running jobs watch the broker for cancel requests, so a
+    job can be cancelled from any node. on_remote_result(job) is called once for
+    each succeeded job read here that ran on another node. on_finished(job) is called
+    once for each job that finishes on this node: run here, cancelled while queued,
+    or failed by recover. A job with a callback URL is marked webhook pending first;
+    on_finished reports the delivery's outcome with webhook_done.
+
+    Running jobs send a heartbeat at least every lease_seconds / 4. Every manager
+    fails the running jobs whose worker is gone (see recover), and deletes jobs
+    that finished more than retention_seconds ago."""
+
+    def __init__(self, broker, runner, local_workers=1, worker_name=None, cancel_poll_interval=1.0,
+                 on_remote_result=None, lease_seconds=120, retention_seconds=7 * 86400, on_finished=None):
+        self.broker = broker
+        self.runner = runner
+        self.local_workers = local_workers
+        self.worker_name = worker_name or f"{socket.gethostname()}:{os.getpid()}"
+        self.cancel_poll_interval = cancel_poll_interval
+        self.on_remote_result = on_remote_result
+        self.on_finished = on_finished
+        self.lease_seconds = lease_seconds
+        self.retention_seconds = retention_seconds
+        self._threads = []
+        self._stop = threading.Event()
+        self._tokens = {}
+        self._seen_results = OrderedDict()
+
+    def start(self):
+        """Recover jobs left behind by dead workers, then start the local worker threads (once)"""
+        if self._threads:
+            return
+        self.recover()
+        reaper = threading.Thread(target=self._reap, name="diffugen-job-reaper", daemon=True)
+        reaper.start()
+        self._threads.append(reaper)
+        for index in range(self.local_workers):
+            thread = threading.Thread(target=self.work, args=(f"{self.worker_name}:{index}",),
+                                      name=f"diffugen-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+
+    def recover(self):
+        """Fail running jobs whose worker is gone: a process on this host that no longer
+        exists, or any worker that has not sent a heartbeat within the lease.
+        Queued jobs need no recovery; they stay queued for the next worker"""
+        host = socket.gethostname()
+        orphans = {}
+        try:
+            for job in self.broker.list(status=RUNNING, limit=10000):
+                # Worker names are host:pid:thread
+                parts = (job.get("worker") or "").rsplit(":", 2)
+                if len(parts) == 3 and parts[0] == host and parts[1].isdigit() and not _process_alive(int(parts[1])):
+                    orphans[job["id"]] = f"Worker process {parts[1]} exited while the job was running"
+            for job in self.broker.stale_running(self.lease_seconds):
+                orphans.setdefault(job["id"], f"Worker {job.get('worker')} sent no heartbeat for "
+                                              f"{self.lease_seconds:.0f}s while the job was running")
+            for job_id, error in orphans.items():
+                if self.broker.fail_running(job_id, error):
+                    logging.warning(f"Job {job_id} failed: {error}")
+                    self._finished(self.broker.get(job_id))
+            self._recover_webhooks(host)
+        except Exception as e:
+            logging.warning(f"Could not recover abandoned jobs: {e}")
+
+    def _recover_webhooks(self, host):
+        """Take over pending webhooks of exited processes on this host, and deliver them again"""
+        if self.on_finished is None:
+            return
+        for job in self.broker.pending_webhooks():
+            # Owners are host:pid
+            owner = job.get("webhook_owner") or ""
+            parts = owner.rsplit(":", 1)
+            if len(parts) != 2 or parts[0] != host or not parts[1].isdigit() or _process_alive(int(parts[1])):
+                continue
+            if self.broker.set_webhook(job["id"], WEBHOOK_PENDING, self.worker_name, expected_owner=owner):
+                logging.warning(f"Delivering the webhook of job {job['id']} again: process {parts[1]} exited first")
+                self._notify(dict(job, webhook_owner=self.worker_name))
+
+    def _reap(self):
+        while not self._stop.wait(min(60.0, self.lease_seconds / 2)):
+            self.recover()
+            if self.retention_seconds:
+                try:
+                    purged = self.broker.purge(time.time() - self.retention_seconds)
+                    if purged:
+                        logging.info(f"Deleted {purged} jobs that finished over {self.retention_seconds:.0f}s ago")
+                except Exception as e:
+                    logging.warning(f"Could not delete expired jobs: {e}")
+
+    def wait(self):
+        """Block until the worker threads exit (after stop)"""
+        for thread in self._threads:
+            # Join with a timeout so KeyboardInterrupt still reaches the main thread
+            while thread.is_alive():
+                thread.join(1)
+
+    def submit(self, tool, params, tenant=DEFAULT_TENANT, priority="interactive", weight=1.0, cost=1.0,
+               callback_url=None):
+        return self.broker.submit(new_job(tool, params, tenant, priority, weight, cost, callback_url))
+
+    def get(self, job_id):
+        job = self.broker.get(job_id)
+        if job is not None and job["status"] == SUCCEEDED and self.on_remote_result is not None:
+            self._notice_result(job)
+        return job
+
+    def _notice_result(self, job):
+        if job["id"] in self._seen_results or (job.get("worker") or "").startswith(self.worker_name + ":"):
+            return
+        self._seen_results[job["id"]] = True
+        while len(self._seen_results) > 10000:
+            self._seen_results.popitem(last=False)
+        try:
+            self.on_remote_result(job)
+        except Exception as e:
+            logging.warning(f"Could not process the result of job {job['id']}: {e}")
+
+    def get_image(self, job_id):
+        return self.broker.get_image(job_id)
+
+    def report_progress(self, job_id, result):
+        """Publish a running job's partial result (e.g. the finished cells of a sweep)"""
+        try:
+            self.broker.progress(job_id, result)
+        except Exception as e:
+            logging.warning(f"Could not publish progress of job {job_id}: {e}")
+
+    def cancel(self, job_id):
+        """Cancel a queued job, or stop a running one wherever it runs"""
+        previous = self.broker.get(job_id)
+        job = self.broker.cancel(job_id)
+        token = self._tokens.get(job_id)
+        if token is not None:
+            # Running in this process: no need to wait for the broker poll
+            token.cancel("job_cancel")
+        elif previous is not None and previous["status"] == QUEUED and job is not None and job["status"] == CANCELLED:
+            # Never started, so no worker will report it
+            self._finished(job)
+        return job
+
+    def _finished(self, job):
+        if self.on_finished is None or job is None:
+            return
+        if job.get("callback_url"):
+            # Recorded before delivery starts, so a delivery lost with this process is found by recover
+            try:
+                self.broker.set_webhook(job["id"], WEBHOOK_PENDING, self.worker_name)
+                job = dict(job, webhook_status=WEBHOOK_PENDING, webhook_owner=self.worker_name)
+            except Exception as e:
+                logging.warning(f"Could not record the pending webhook of job {job['id']}: {e}")
+        self._notify(job)
+
+    def _notify(self, job):
+        try:
+            self.on_finished(job)
+        except Exception as e:
+            logging.warning(f"Could not process the completion of job {job['id']}: {e}")
+
+    def webhook_done(self, job_id, delivered):
+        """Record the outcome of a job's completion webhook, unless another process took it over"""
+        try:
+            self.broker.set_webhook(job_id, WEBHOOK_DELIVERED if delivered else WEBHOOK_FAILED, self.worker_name,
+                                    expected_owner=self.worker_name)
+        except Exception as e:
+            logging.warning(f"Could not record the webhook outcome of job {job_id}: {e}")
+
+    def _watch_for_cancel(self, job_id, token, done):
+        last_heartbeat = time.time()
+        while not done.wait(self.cancel_poll_interval):
+            try:
+                if time.time() - last_heartbeat >= self.lease_seconds / 4:
+                    self.broker.heartbeat(job_id)
+                    last_heartbeat = time.time()
+                job = self.broker.get(job_id)
+            except Exception as e:
+                logging.warning(f"Could not check job {job_id} for cancellation: {e}")
+                continue
+            if job is not None and job.get("cancel_requested"):
+                token.cancel("job_cancel")
+                return
+
+    def list(self, status=None, limit=50, tenant=None):
+        return self.broker.list(status=status, limit=limit, tenant=tenant)
+
+    def work(self, worker):
+        """Claim and run jobs until stopped"""
+        while not self._stop.is_set():
+            try:
+                job = self.broker.claim(worker, timeout=1.0)
+            except Exception as e:
+                logging.error(f"Worker {worker} could not reach the broker: {e}")
+                self._stop.wait(5)
+                continue
+            if job is not None:
+                self.run_job(job, worker)
+
+    def run_job(self, job, worker):
+        """Run one claimed job and publish its result"""
+        if not self._run_job(job, worker):
+            # Recovery failed the job while it ran (e.g. a missed lease); its completion was reported then
+            logging.warning(f"Discarded the result of job {job['id']} on {worker}: it was no longer running")
+            return
+        try:
+            finished = self.broker.get(job["id"])
+        except Exception as e:
+            logging.warning(f"Could not read finished job {job['id']}: {e}")
+            return
+        self._finished(finished)
+
+    def _run_job(self, job, worker):
+        """Returns whether the job's outcome was recorded"""
+        logging.info(f"Worker {worker} running job {job['id']} ({job['tool']}, tenant {job.get('tenant')})")
+        token = CancelToken()
+        done = threading.Event()
+        self._tokens[job["id"]] = token
+        watcher = threading.Thread(target=self._watch_for_cancel, args=(job["id"], token, done), daemon=True)
+        watcher.start()
+        try:
+            result = self.runner(job, token)
+        except Exception as e:
+            logging.error(f"Job {job['id']} failed with unexpected error: {e}")
+            return self.broker.finish(job["id"], FAILED, error=f"Unexpected error: {e}", worker=worker)
+        finally:
+            done.set()
+            self._tokens.pop(job["id"], None)
+        # The full sd.cpp log stays in the worker's debug log
+        result = {key: value for key, value in result.items() if key != "output"}
+        result["worker"] = worker
+        if result.get("error_type") == "cancelled":
+            logging.info(f"Job {job['id']} cancelled on {worker}")
+            return self.broker.finish(job["id"], CANCELLED, result=result, error=result.get("error"), worker=worker)
+        if not result.get("success"):
+            return self.broker.finish(job["id"], FAILED, result=result, error=result.get("error", "Unknown error"),
+                                      worker=worker)
+        image = None
+        if self.broker.stores_images and result.get("image_path"):
+            try:
+                with open(result["image_path"], "rb") as f:
+                    image = f.read()
+            except OSError as e:
+                return self.broker.finish(job["id"], FAILED, result=result, error=f"Could not read generated image: {e}",
+                                          worker=worker)
+        if not self.broker.finish(job["id"], SUCCEEDED, result=result, image=image, worker=worker):
+            return False
+        logging.info(f"Job {job['id']} succeeded on {worker}")
+        return True
@@ -0,0 +1,153 @@
+"""Load shedding: reject generations early with a Retry-After hint.
+
+A request that would wait too long for a generation slot is better turned away
+at once, with the time after which it is likely to get in, than left hanging
+or rejected as a bad request. The load tracker follows the predicted run time
+of every generation in this process that waits for or holds a slot. From that
+it predicts how long a new request would wait:
+
+    "load_shedding": {
+        "max_queue": 8,
+        "max_wait_seconds": 120
+    }
+
+A request is shed when max_queue requests already wait for a slot, or when its
+predicted wait is over max_wait_seconds (0 disables either check). Unset, they
+default to QUEUE_PER_SLOT waiting requests per slot and DEFAULT_MAX_WAIT seconds.
+Retry-After is the predicted time until the queue has room again: when the next
+running generation finishes, or when the predicted wait drops under the limit.
+
+BoundedExecutor runs the waiting and running requests' threads, and refuses
+work when all of them are taken rather than queueing it out of sight.
+"""
+import heapq
+import itertools
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUE_PER_SLOT = 4  # Default max_queue per generation slot
+DEFAULT_MAX_WAIT = 300  # Default max_wait_seconds
+
+DEFAULT_LOAD_SHEDDING = {
+    "max_queue": None,  # Requests allowed to wait for a slot in this process (0 for no limit, None for QUEUE_PER_SLOT per slot)
+    "max_wait_seconds": None,  # Longest predicted wait accepted (0 for no limit, None for DEFAULT_MAX_WAIT)
+    "max_retry_after": 600,  # Upper bound of the Retry-After hint in seconds
+}
+
+QUEUE_FULL = "queue_full"
+WAIT_TOO_LONG = "wait_too_long"
+
+class LoadTracker:
+    """Predicted remaining work of the generations waiting for and holding this process's slots.
+
+    Generations in other processes sharing the slots are not seen, so with several
+    server processes the predicted wait is a lower bound."""
+
+    def __init__(self, slots, settings=None):
+        self.slots = max(1, int(slots))
+        self.settings = dict(DEFAULT_LOAD_SHEDDING, **(settings or {}))
+        if self.settings["max_queue"] is None:
+            self.settings["max_queue"] = QUEUE_PER_SLOT * self.slots
+        if self.settings["max_wait_seconds"] is None:
+            self.settings["max_wait_seconds"] = DEFAULT_MAX_WAIT
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._waiting = {}  # entry -> predicted seconds, in arrival order
+        self._running = {}  # entry -> (started, predicted seconds)
+
+    def capacity(self):
+        """Requests that may wait for or hold a slot at once: the slots and max_queue
+        (QUEUE_PER_SLOT per slot when the queue is unlimited)"""
+        return self.slots + (int(self.settings["max_queue"] or 0) or QUEUE_PER_SLOT * self.slots)
+
+    def enter(self, predicted_seconds):
+        """Register a request that starts waiting for a slot. Returns its entry"""
+        with self._lock:
+            entry = next(self._ids)
+            self._waiting[entry] = max(0.0, float(predicted_seconds or 0))
+            return entry
+
+    def start(self, entry):
+        """The request got its slot and is running"""
+        with self._lock:
+            predicted = self._waiting.pop(entry, 0.0)
+            self._running[entry] = (time.time(), predicted)
+
+    def leave(self, entry):
+        """The request finished, or gave up waiting"""
+        with self._lock:
+            self._waiting.pop(entry, None)
+            self._running.pop(entry, None)
+
+    def _slot_free_times(self, now):
+        """Predicted times at which each slot frees up, with the waiting requests scheduled"""
+        free_at = [now + max(0.0, started + predicted - now) for started, predicted in self._running.values()]
+        free_at.extend([now] * max(0, self.slots - len(free_at)))
+        heapq.heapify(free_at)
+        for predicted in self._waiting.values():
+            heapq.heappush(free_at, heapq.heappop(free_at) + predicted)
+        return free_at
+
+    def predicted_wait(self):
+        """Seconds a request arriving now is predicted to wait for a slot"""
+        now = time.time()
+        with self._lock:
+            return max(0.0, min(self._slot_free_times(now)) - now)
+
+    def stats(self):
+        with self._lock:
+            waiting, running = len(self._waiting), len(self._running)
+        return {"waiting": waiting, "running": running, "predicted_wait": round(self.predicted_wait(), 1)}
+
+    def check(self):
+        """None if a new request may wait for a slot, else why it is shed:
+        {"reason", "retry_after", "waiting", "predicted_wait"}"""
+        max_queue = int(self.settings["max_queue"] or 0)
+        max_wait = float(self.settings["max_wait_seconds"] or 0)
+        now = time.time()
+        with self._lock:
+            waiting = len(self._waiting)
+            wait = max(0.0, min(self._slot_free_times(now)) - now)
+            if max_queue and waiting >= max_queue:
+                reason = QUEUE_FULL
+                # The queue moves up when the next slot frees
+                next_free = min([started + predicted for started, predicted in self._running.values()] or [now])
+                retry_after = next_free - now
+            elif max_wait and wait > max_wait:
+                reason = WAIT_TOO_LONG
+                retry_after = wait - max_wait
+            else:
+                return None
+        return {"reason": reason, "retry_after": self.retry_after(retry_after), "waiting": waiting,
+                "predicted_wait": round(wait, 1)}
+
+    def retry_after(self, seconds=None):
+        """Whole seconds to advertise in Retry-After (at least 1); by default the predicted wait"""
+        if seconds is None:
+            seconds = self.predicted_wait()
+        return int(min(max(1, math.ceil(seconds)), float(self.settings["max_retry_after"])))
+
+class BoundedExecutor:
+    """A thread pool that refuses work when all its threads are taken, instead of queueing it"""
+
+    def __init__(self, size, name="diffugen"):
+        self.size = max(1, int(size))
+        self._pool = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix=name)
+        self._free = threading.BoundedSemaphore(self.size)
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn in a free thread. Returns its future, or None when every thread is taken"""
+        if not self._free.acquire(blocking=False):
+            return None
+        try:
+            future = self._pool.submit(fn, *args, **kwargs)
+        except Exception:
+            self._free.release()
+            raise
+        future.add_done_callback(lambda _: self._free.release())
+        return future
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
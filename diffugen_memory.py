@@ -0,0 +1,125 @@
+"""Per-run memory planning for sd.cpp.
+
+Chooses sd.cpp's memory-saving options for each generation from the model, the
+image size, the batch size and the GPU memory that is free when it starts.
+Options are added cheapest first until the estimated peak fits, so small images
+run at full speed and large renders still succeed:
+
+    --diffusion-fa    memory-efficient (flash) attention in the diffusion model
+    --vae-tiling      decode the latents tile by tile
+    --clip-on-cpu     run the text encoders on the CPU
+    --vae-on-cpu      decode on the CPU
+    --offload-to-cpu  keep weights in RAM and move each component to the GPU when it runs
+
+Without nvidia-smi (and without a configured gpu_memory_mb) only the image size
+is known, and VAE tiling is used above vae_tiling_megapixels. The memory section
+of diffugen.json tunes the plan:
+
+    "memory": {"headroom_mb": 768, "gpu_memory_mb": 12288, "vae_tiling_megapixels": 2.0}
+"""
+import shutil
+import subprocess
+import threading
+import time
+
+DEFAULT_MEMORY = {
+    "headroom_mb": 768,  # Kept free for the CUDA context, fragmentation and other processes
+    "gpu_memory_mb": None,  # Total GPU memory when nvidia-smi is not available
+    "vae_tiling_megapixels": 2.0,  # Size-only fallback: tile the VAE above this many megapixels
+}
+
+# Activation memory of one image in MB: linear in megapixels, plus attention
+# (quadratic in megapixels) unless flash attention is used. Rough fp16 figures.
+MEMORY_PROFILES = {
+    "flux-schnell": {"diffusion_mb_per_mp": 900, "attention_mb_per_mp2": 800},
+    "flux-dev": {"diffusion_mb_per_mp": 900, "attention_mb_per_mp2": 800},
+    "sdxl": {"diffusion_mb_per_mp": 600, "attention_mb_per_mp2": 350},
+    "sd3": {"diffusion_mb_per_mp": 700, "attention_mb_per_mp2": 800},
+    "sd15": {"diffusion_mb_per_mp": 500, "attention_mb_per_mp2": 4000},
+}
+FALLBACK_PROFILE = {"diffusion_mb_per_mp": 800, "attention_mb_per_mp2": 1000}
+VAE_MB_PER_MP = 2600  # Decoding a whole image at once
+VAE_TILED_MB = 600  # Decoding tile by tile, independent of the image size
+
+# Memory-saving options in the order they are tried, cheapest first
+MEMORY_FLAGS = ["--diffusion-fa", "--vae-tiling", "--clip-on-cpu", "--vae-on-cpu", "--offload-to-cpu"]
+
+def estimate_peak_mb(model, width, height, batch_count, weights, flags):
+    """Estimated peak GPU memory of an sd.cpp run in MB.
+
+    weights holds the sizes in MB of the diffusion model, text encoders and VAE."""
+    profile = MEMORY_PROFILES.get(model, FALLBACK_PROFILE)
+    megapixels = width * height / 1_000_000
+    activations = batch_count * profile["diffusion_mb_per_mp"] * megapixels
+    if "--diffusion-fa" not in flags:
+        activations += batch_count * profile["attention_mb_per_mp2"] * megapixels ** 2
+    decode = 0.0 if "--vae-on-cpu" in flags else (VAE_TILED_MB if "--vae-tiling" in flags else VAE_MB_PER_MP * megapixels)
+    resident = {
+        "diffusion": weights.get("diffusion", 0.0),
+        "text_encoders": 0.0 if "--clip-on-cpu" in flags else weights.get("text_encoders", 0.0),
+        "vae": 0.0 if "--vae-on-cpu" in flags else weights.get("vae", 0.0),
+    }
+    if "--offload-to-cpu" in flags:
+        # Only the component that is running is on the GPU
+        return max(resident["diffusion"] + activations, resident["text_encoders"], resident["vae"] + decode)
+    return sum(resident.values()) + max(activations, decode)
+
+def plan_memory(model, width, height, batch_count=1, weights=None, available_mb=None, base_flags=(),
+                memory_config=None):
+    """Choose the memory-saving flags for one run.
+
+    base_flags are options the run already uses (configured or auto-tuned), and
+    available_mb the GPU memory it may use, or None when unknown. Returns a dict with
+    the added flags, the estimated peak and the memory it was planned against."""
+    settings = dict(DEFAULT_MEMORY, **(memory_config or {}))
+    flags = list(base_flags)
+    added = []
+    weights = weights or {}
+    if available_mb is None:
+        megapixels = width * height * batch_count / 1_000_000
+        if megapixels > float(settings["vae_tiling_megapixels"]) and "--vae-tiling" not in flags:
+            added.append("--vae-tiling")
+        return {"flags": added, "estimated_mb": None, "available_mb": None}
+    budget = available_mb - float(settings["headroom_mb"])
+    for flag in MEMORY_FLAGS:
+        if estimate_peak_mb(model, width, height, batch_count, weights, flags + added) <= budget:
+            break
+        if flag not in flags:
+            added.append(flag)
+    return {"flags": added,
+            "estimated_mb": round(estimate_peak_mb(model, width, height, batch_count, weights, flags + added)),
+            "available_mb": round(available_mb)}
+
+_free_memory = {"at": 0.0, "mb": None}
+_free_memory_lock = threading.Lock()
+
+def free_gpu_memory_mb(max_age=2.0):
+    """Free memory of the first GPU in MB from nvidia-smi, or None when it is unavailable.
+
+    Cached for max_age seconds, so a burst of requests queries it once."""
+    with _free_memory_lock:
+        if time.time() - _free_memory["at"] < max_age:
+            return _free_memory["mb"]
+        free_mb = None
+        if shutil.which("nvidia-smi"):
+            try:
+                output = subprocess.run(
+                    ["nvidia-smi", "--query-gpu=memory.free", "--format=csv,noheader,nounits"],
+                    capture_output=True, text=True, timeout=5, check=True
+                ).stdout
+                free_mb = float(output.splitlines()[0].strip())
+            except Exception:
+                free_mb = None
+        _free_memory.update(at=time.time(), mb=free_mb)
+        return free_mb
+
+def available_memory_mb(memory_config=None, concurrent_workers=1):
+    """GPU memory a starting run may use: free memory from nvidia-smi, else the
+    configured gpu_memory_mb shared between the concurrent workers, else None"""
+    free_mb = free_gpu_memory_mb()
+    if free_mb is not None:
+        return free_mb
+    total_mb = dict(DEFAULT_MEMORY, **(memory_config or {}))["gpu_memory_mb"]
+    if total_mb is None:
+        return None
+    return float(total_mb) / max(1, concurrent_workers)
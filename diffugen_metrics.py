@@ -0,0 +1,262 @@
+"""Prometheus-style metrics for DiffuGen.
+
+Metrics live in process memory and are rendered in the Prometheus text
+exposition format, so no extra dependency is needed. The OpenAPI server
+exposes them at /metrics and the MCP server through the get_metrics tool.
+"""
+import os
+import threading
+
+# Latency buckets in seconds, sized for image generation (sub-second stubs up to long SDXL jobs)
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+class _Metric:
+    """Base class for a metric family with optional labels"""
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        if not self.labelnames and self.metric_type in ("counter", "gauge"):
+            # Unlabelled counters and gauges are reported as zero before the first update
+            self._values[()] = 0
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.extend(extra)
+        if not pairs:
+            return ""
+        escaped = [(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs]
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(self._render_samples())
+        return lines
+
+class Counter(_Metric):
+    """A monotonically increasing counter"""
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _render_samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{self._format_labels(key)} {_format_value(value)}" for key, value in items]
+
+    def snapshot(self):
+        with self._lock:
+            return {",".join(key) or "total": value for key, value in sorted(self._values.items())}
+
+class Gauge(_Metric):
+    """A value that can go up and down, or be computed on collection"""
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        if self._function is not None:
+            return self._function()
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def set_function(self, function):
+        """Compute the gauge at collection time. For a labelled gauge, function returns
+        a dict mapping label value tuples to values"""
+        self._function = function
+
+    def _collect(self):
+        if self._function is not None:
+            try:
+                if self.labelnames:
+                    return sorted((tuple(str(v) for v in key), value) for key, value in self._function().items())
+                return [((), self._function())]
+            except Exception:
+                return []
+        with self._lock:
+            return sorted(self._values.items())
+
+    def _render_samples(self):
+        return [f"{self.name}{self._format_labels(key)} {_format_value(value)}" for key, value in self._collect()]
+
+    def snapshot(self):
+        return {",".join(key) or "value": value for key, value in self._collect()}
+
+class Histogram(_Metric):
+    """Cumulative histogram of observed values"""
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                self._values[key] = state
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def _render_samples(self):
+        with self._lock:
+            items = [(key, dict(state, buckets=list(state["buckets"]))) for key, state in sorted(self._values.items())]
+        lines = []
+        for key, state in items:
+            for bound, count in zip(self.buckets, state["buckets"]):
+                lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', _format_value(bound))])} {count}")
+            lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', '+Inf')])} {state['count']}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {_format_value(state['sum'])}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {state['count']}")
+        return lines
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                ",".join(key) or "total": {
+                    "count": state["count"],
+                    "sum": round(state["sum"], 3),
+                    "avg": round(state["sum"] / state["count"], 3) if state["count"] else 0.0
+                }
+                for key, state in sorted(self._values.items())
+            }
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(round(value, 6))
+    return str(value)
+
+class MetricsRegistry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Return all metric values as a JSON-serializable dictionary"""
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+def directory_size(path):
+    """Total size in bytes of the regular files directly inside path"""
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        pass
+    return total
+
+registry = MetricsRegistry()
+
+# Queue metrics
+QUEUE_DEPTH = registry.register(Gauge(
+    "diffugen_queue_depth", "Generation requests waiting for or holding the generation queue"))
+QUEUE_WAIT_SECONDS = registry.register(Histogram(
+    "diffugen_queue_wait_seconds", "Time spent waiting to acquire the generation queue"))
+BUSY_REJECTIONS = registry.register(Counter(
+    "diffugen_busy_rejections_total", "Generation requests rejected because the queue was busy, by reason",
+    labelnames=("reason",)))
+TENANT_QUEUE_DEPTH = registry.register(Gauge(
+    "diffugen_tenant_queue_depth", "Requests and jobs waiting to run, per tenant and priority class",
+    labelnames=("tenant", "priority")))
+TENANT_QUEUE_WAIT_SECONDS = registry.register(Histogram(
+    "diffugen_tenant_queue_wait_seconds", "Time from submission until a generation slot was granted",
+    labelnames=("tenant", "priority")))
+
+# Generation metrics
+GENERATION_SECONDS = registry.register(Histogram(
+    "diffugen_generation_duration_seconds", "End-to-end generation latency",
+    labelnames=("model", "resolution")))
+GENERATIONS = registry.register(Counter(
+    "diffugen_generations_total", "Completed generation attempts by outcome",
+    labelnames=("model", "status", "exit_code")))
+SUBPROCESS_SECONDS = registry.register(Histogram(
+    "diffugen_subprocess_duration_seconds", "Time from sd.cpp process spawn to exit",
+    labelnames=("model",)))
+TIMEOUTS = registry.register(Counter(
+    "diffugen_timeouts_total", "Generations stopped by the time limit (total) or the hung-process watchdog (idle)",
+    labelnames=("model", "kind")))
+CANCELLATIONS = registry.register(Counter(
+    "diffugen_cancellations_total", "Generations stopped before finishing, by reason",
+    labelnames=("reason",)))
+
+# HTTP metrics
+RATE_LIMITED = registry.register(Counter(
+    "diffugen_rate_limited_total", "Requests rejected with HTTP 429 by the rate limiter"))
+QUOTA_REJECTIONS = registry.register(Counter(
+    "diffugen_quota_rejections_total", "Generations rejected with HTTP 429 because the tenant's quota was used up",
+    labelnames=("limit",)))
+IMAGE_BYTES_SERVED = registry.register(Counter(
+    "diffugen_image_bytes_served_total", "Bytes of generated images served over HTTP"))
+
+# Warm-up metrics
+WARM = registry.register(Gauge(
+    "diffugen_warm", "1 once the hot models have been prefetched and warmed up (or warm-up is disabled)"))
+
+# Speculative pre-generation metrics
+SPECULATIVE_IMAGES = registry.register(Counter(
+    "diffugen_speculative_images_total",
+    "Speculatively pre-rendered images by outcome: used, or wasted (expired, cancelled, failed)",
+    labelnames=("outcome",)))
+SPECULATIVE_READY = registry.register(Gauge(
+    "diffugen_speculative_images_ready", "Pre-rendered images waiting for a follow-up request"))
+
+# Storage metrics
+OUTPUT_DIR_BYTES = registry.register(Gauge(
+    "diffugen_output_dir_bytes", "Total size of the generated images in the output directory"))
+
+def watch_output_dir(path):
+    """Report the size of path, or of the directory a function returns, as diffugen_output_dir_bytes"""
+    OUTPUT_DIR_BYTES.set_function(lambda: directory_size(path() if callable(path) else path))
@@ -1,7 +1,7 @@
 from fastapi import FastAPI, HTTPException, Request, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware import Middleware
 from pydantic import BaseModel, Field
 from typing import Optional, Dict, List, Union, Callable, Any
@@ -17,10 +17,23 @@ from collections import defaultdict
 from itertools import chain
 import gc
 import uuid
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 # Import DiffuGen functions
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from diffugen import generate_stable_diffusion_image, generate_flux_image, load_config as load_diffugen_config, sd_cpp_path as default_sd_cpp_path, _model_paths
+from diffugen import generate_stable_diffusion_image, generate_flux_image, config as diffugen_config, get_sd_cpp_path, _model_paths
+from diffugen import get_job_manager, get_job_broker, cancel_scope, tenant_scope, estimate_work, fair_policy, job_eta, estimate_job_times
+from diffugen import estimate_sweep_work, resolve_model
+from diffugen import warmer, start_job_workers, webhooks, check_load_shedding, readiness, speculator
+from diffugen import busy_result, load_tracker
+from diffugen_webhooks import validate_callback_url
+from diffugen_jobs import CANCELLED, CancelToken, FINISHED_STATES, SUCCEEDED
+from diffugen_loadshed import QUEUE_FULL, BoundedExecutor
+from diffugen_sweep import DEFAULT_SWEEP, expand_grid, normalize_axes
+from diffugen_usage import QuotaExceeded, UsageLedger, estimate_cost, window_seconds
+import diffugen_metrics as metrics
 
 # Load OpenAPI configuration
 def load_openapi_config():
@@ -39,25 +52,37 @@ def load_openapi_config():
         print(f"Error loading OpenAPI configuration: {e}")
         print("Using default configuration")
     
+    # Merge a custom config file passed with --config (exported so uvicorn workers load it too)
+    custom_config_file = os.environ.get("DIFFUGEN_OPENAPI_CONFIG")
+    if custom_config_file:
+        try:
+            with open(custom_config_file, 'r') as f:
+                config.update(json.load(f))
+                print(f"Loaded custom configuration from {custom_config_file}")
+        except Exception as e:
+            print(f"Error loading custom configuration: {e}")
+    
     # Set defaults for missing values
     if "server" not in config:
         config["server"] = {"host": "0.0.0.0", "port": 5199, "debug": False}
     if "paths" not in config:
         config["paths"] = {
-            "sd_cpp_path": default_sd_cpp_path,
+            "sd_cpp_path": get_sd_cpp_path(),
             "models_dir": None,
             "output_dir": "outputs"
         }
     if "cors" not in config:
         config["cors"] = {
             "allow_origins": ["*"],
-            "allow_methods": ["GET", "POST", "OPTIONS"],
+            "allow_methods": ["GET", "POST", "DELETE", "OPTIONS"],
             "allow_headers": ["*"]
         }
     if "rate_limiting" not in config:
         config["rate_limiting"] = {"rate": "60/minute", "enabled": True}
     if "images" not in config:
         config["images"] = {"serve_path": "/images", "cache_control": "max-age=3600"}
+    if "quotas" not in config:
+        config["quotas"] = {"window": "day", "default": {}}
     
     # Apply any environment variable overrides
     if "DIFFUGEN_OPENAPI_PORT" in os.environ:
@@ -78,6 +103,9 @@ def load_openapi_config():
     if "DIFFUGEN_RATE_LIMIT" in os.environ:
         config["rate_limiting"]["rate"] = os.environ.get("DIFFUGEN_RATE_LIMIT", config["rate_limiting"]["rate"])
     
+    if "DIFFUGEN_USAGE_LEDGER" in os.environ:
+        config["quotas"]["ledger_path"] = os.environ.get("DIFFUGEN_USAGE_LEDGER", "")
+    
     if "CUDA_VISIBLE_DEVICES" in os.environ:
         if "env" not in config:
             config["env"] = {}
@@ -133,6 +161,20 @@ except Exception as e:
 
 # Set environment variable for DiffuGen functions
 os.environ["DIFFUGEN_OUTPUT_DIR"] = str(DEFAULT_OUTPUT_DIR)
+metrics.watch_output_dir(DEFAULT_OUTPUT_DIR)
+
+# Per-tenant usage ledger, shared by every server process on this host. By default it is
+# in DiffuGen's data_dir, next to the job store, so it does not depend on the working directory
+usage_ledger = None
+QUOTA_WINDOW_SECONDS = window_seconds(config["quotas"].get("window", "day"))
+if config["quotas"].get("ledger_path") is None:
+    config["quotas"]["ledger_path"] = os.path.join(diffugen_config["data_dir"], "usage.db")
+if config["quotas"].get("ledger_path"):
+    try:
+        usage_ledger = UsageLedger(config["quotas"]["ledger_path"])
+    except Exception as e:
+        print(f"Warning: Could not open usage ledger at {config['quotas']['ledger_path']}: {e}")
+        print("Usage will not be recorded and quotas will not be enforced")
 
 # Rate limiting middleware
 class RateLimitMiddleware:
@@ -142,10 +184,13 @@ class RateLimitMiddleware:
         rate_limit: str = "60/minute",
         enabled: bool = True,
         rate_limit_by_key: Optional[Callable] = None,
+        exempt_paths: Optional[List[str]] = None,
     ):
         self.app = app
         self.enabled = enabled
         self.rate_limit_by_key = rate_limit_by_key or (lambda request: request.client.host)
+        # Path patterns not counted against the limit (generations are limited by quotas instead)
+        self.exempt_paths = [re.compile(pattern) for pattern in exempt_paths or []]
         
         # Parse rate limit (format: number/timeunit)
         match = re.match(r"(\d+)/(\w+)", rate_limit)
@@ -229,6 +274,8 @@ class RateLimitMiddleware:
     async def __call__(self, scope, receive, send):
         if not self.enabled or scope["type"] != "http":
             return await self.app(scope, receive, send)
+        if any(pattern.match(scope["path"]) for pattern in self.exempt_paths):
+            return await self.app(scope, receive, send)
             
         # Create a request object to get client information
         request = Request(scope=scope, receive=receive)
@@ -240,6 +287,7 @@ class RateLimitMiddleware:
         
         # Check if rate limit is exceeded
         if len(requests) >= self.max_requests:
+            metrics.RATE_LIMITED.inc()
             # Create a response for rate limit exceeded
             headers = [
                 (b"content-type", b"application/json"),
@@ -307,6 +355,9 @@ if config.get("rate_limiting", {}).get("enabled", True):
             RateLimitMiddleware,
             rate_limit=config.get("rate_limiting", {}).get("rate", "60/minute"),
             enabled=config.get("rate_limiting", {}).get("enabled", True),
+            # Image downloads are not requests for work
+            exempt_paths=[re.escape(config["images"]["serve_path"].rstrip("/")) + "/", r"/jobs/[^/]+/image$",
+                          r"/jobs/[^/]+/cells/\d+/image$", r"/health(/live|/ready)?$"],
         )
     )
 
@@ -365,10 +416,106 @@ async def add_cache_control(request: Request, call_next):
         response.headers["Pragma"] = "no-cache"
         response.headers["Expires"] = "0"
         print(f"Added no-cache headers for: {request.url.path}")
+        
+        if response.status_code == 200 and "content-length" in response.headers:
+            metrics.IMAGE_BYTES_SERVED.inc(int(response.headers["content-length"]))
     
     return response
 
 # API Key security
+def _api_key_entry(api_key):
+    """Find an API key in security.api_keys. Entries are plain key strings or
+    {"key": ..., "name": ..., "weight": ...} objects naming the tenant and its fair share"""
+    for entry in config.get("security", {}).get("api_keys", []):
+        if isinstance(entry, dict):
+            if entry.get("key") == api_key:
+                return entry
+        elif entry == api_key:
+            return {"key": entry}
+    return None
+
+def _request_key_entry(req: Request):
+    api_key = req.headers.get("x-api-key")
+    return _api_key_entry(api_key) if api_key else None
+
+def tenant_for(req: Request):
+    """The tenant a request is scheduled as, and its weight: the API key's name, or the client address"""
+    api_key = req.headers.get("x-api-key")
+    entry = _request_key_entry(req)
+    if entry is not None:
+        # Never expose the key itself in metrics or job records
+        name = entry.get("name") or "key-" + hashlib.sha256(api_key.encode()).hexdigest()[:8]
+        return name, float(entry.get("weight", 1.0))
+    return f"client-{req.client.host if req.client else 'unknown'}", 1.0
+
+def is_admin(req: Request):
+    """Whether the request's API key has "admin": true, which lets it see every tenant's jobs and usage"""
+    return bool((_request_key_entry(req) or {}).get("admin"))
+
+def get_tenant_job(job_id: str, req: Request, tool=None):
+    """A job the request's tenant may see, or HTTP 404: other tenants' jobs are reported as missing"""
+    try:
+        job = get_job_manager().get(job_id)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Job broker unavailable: {e}")
+    if job is None or (tool is not None and job["tool"] != tool) or (
+            not is_admin(req) and job.get("tenant") != tenant_for(req)[0]):
+        raise HTTPException(status_code=404, detail=f"{'Sweep' if tool == 'sweep' else 'Job'} not found: {job_id}")
+    return job
+
+def quota_for(req: Request):
+    """The request tenant's quota: the API key's own quota, or quotas.default"""
+    entry = _request_key_entry(req) or {}
+    return entry.get("quota", config["quotas"].get("default")) or None
+
+def _reconcile_job_usage(tenant=None):
+    """Record the outcome of finished jobs in the usage ledger"""
+    pending = usage_ledger.pending_jobs(tenant)
+    # Read the broker directly: checking usage must not start job workers on an API-only node
+    broker = get_job_broker() if pending else None
+    for entry_id, job_id in pending:
+        job = broker.get(job_id)
+        if job is None:
+            usage_ledger.finish(entry_id, "expired")
+        elif job["status"] in FINISHED_STATES:
+            timings = (job.get("result") or {}).get("timings") or {}
+            usage_ledger.finish(entry_id, job["status"], timings.get("process_total", 0.0))
+
+def charge_usage(req: Request, kind, model, steps=None, width=None, height=None, hires=None, work=None):
+    """Charge a generation's estimated cost to the request's tenant, enforcing its quota.
+    
+    model is the model that will run (see resolve_model). work overrides the estimated
+    work (e.g. a whole sweep's). Returns the ledger entry ID (None without a ledger);
+    raises HTTP 429 over quota."""
+    if usage_ledger is None:
+        return None
+    tenant, _ = tenant_for(req)
+    if work is None:
+        work = estimate_work(model, steps, width, height, hires)
+    cost = estimate_cost(model, work, config["quotas"].get("model_factors"))
+    try:
+        _reconcile_job_usage(tenant)
+        return usage_ledger.charge(tenant, cost, quota_for(req), QUOTA_WINDOW_SECONDS, kind, model, width, height, steps)
+    except QuotaExceeded as e:
+        metrics.QUOTA_REJECTIONS.inc(limit=e.limit)
+        print(f"Quota exceeded: {e}")
+        raise HTTPException(status_code=429, detail=f"{e}. This request would cost {cost}.",
+                            headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        # An unavailable ledger must not take generation down with it
+        print(f"Could not record usage for {tenant}: {e}")
+        return None
+
+def finish_usage(usage_id, result):
+    """Record a generation's outcome and measured GPU-seconds"""
+    if usage_ledger is None or usage_id is None:
+        return
+    status = "succeeded" if result.get("success") else result.get("error_type", "failed")
+    try:
+        usage_ledger.finish(usage_id, status, (result.get("timings") or {}).get("process_total", 0.0))
+    except Exception as e:
+        print(f"Could not record usage: {e}")
+
 async def verify_api_key(x_api_key: Optional[str] = Header(None)):
     """Verify the API key if API key security is enabled"""
     # Check if API key security is enabled
@@ -381,8 +528,7 @@ async def verify_api_key(x_api_key: Optional[str] = Header(None)):
             )
         
         # Check if the provided API key is valid
-        valid_keys = config.get("security", {}).get("api_keys", [])
-        if x_api_key not in valid_keys:
+        if _api_key_entry(x_api_key) is None:
             raise HTTPException(
                 status_code=403,
                 detail="Invalid API key",
@@ -396,6 +542,21 @@ class ErrorResponse(BaseModel):
     detail: Optional[str] = None
     timestamp: str = Field(default_factory=lambda: datetime.now().isoformat())
 
+@app.on_event("startup")
+async def start_warmer():
+    """Prefetch the hot models in the background (see the warmup section of diffugen.json)"""
+    warmer.start()
+
+@app.on_event("startup")
+async def start_speculator():
+    """Pre-render follow-up images in idle GPU time, if enabled (see the speculation section of diffugen.json)"""
+    speculator.start()
+
+@app.on_event("startup")
+async def resume_jobs():
+    """Run the jobs a durable broker kept queued across a restart"""
+    start_job_workers()
+
 # Health check endpoint
 @app.get("/health", tags=["System"], response_model=Dict[str, str])
 async def health_check():
@@ -403,9 +564,45 @@ async def health_check():
     return {
         "status": "healthy",
         "version": "1.0.0",
+        "warmup": warmer.status()["state"],
         "timestamp": datetime.now().isoformat()
     }
 
+# Liveness probe: the process is up and serving requests
+@app.get("/health/live", tags=["System"], response_model=Dict[str, str])
+async def liveness():
+    """Check that the API server process is alive (for restarts, not routing)"""
+    return {"status": "alive", "timestamp": datetime.now().isoformat()}
+
+# Readiness probe: this node will actually serve a generation soon. It runs on a thread
+# of its own, so generations holding the default executor's threads cannot starve it
+readiness_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="readiness")
+
+@app.get("/health/ready", tags=["System"], response_model=Dict[str, Any],
+         responses={503: {"description": "Not ready; the body says why"}})
+async def readiness_check():
+    """Check whether this node can serve generations quickly: the sd.cpp binary and models
+    are installed, warm-up has finished and the predicted wait is within the load shedding
+    limits. Returns 503 otherwise, with Retry-After when the queue is saturated"""
+    status = await asyncio.get_running_loop().run_in_executor(readiness_executor, readiness)
+    status["timestamp"] = datetime.now().isoformat()
+    if status["ready"]:
+        return status
+    headers = {"Retry-After": str(status["retry_after"])} if status["retry_after"] else None
+    return JSONResponse(status_code=503, content=status, headers=headers)
+
+# Warm-up status endpoint
+@app.get("/warmup", tags=["System"], response_model=Dict[str, Any])
+async def warmup_status():
+    """Get the cold-start warmer's progress: which hot models are prefetched and warmed up"""
+    return warmer.status()
+
+# Metrics endpoint
+@app.get("/metrics", tags=["System"], response_class=PlainTextResponse)
+async def get_metrics():
+    """Expose queue, generation, rate limiting and storage metrics in Prometheus text format"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
 # Configuration endpoint
 @app.get("/config", tags=["System"], response_model=Dict[str, object])
 async def get_config():
@@ -490,17 +687,33 @@ tags_metadata = [
     },
 ]
 
+# Native generation is capped at MAX_NATIVE_SIZE; two-pass hi-res goes up to MAX_HIRES_SIZE
+MAX_NATIVE_SIZE = 2048
+MAX_HIRES_SIZE = 4096
+
 class ImageGenerationRequest(BaseModel):
     prompt: str = Field(..., description="Text prompt for image generation")
     model: Optional[str] = Field(None, description="Model to use for generation (e.g., 'sdxl', 'flux-schnell')")
-    width: Optional[int] = Field(None, description="Image width in pixels", ge=64, le=2048)
-    height: Optional[int] = Field(None, description="Image height in pixels", ge=64, le=2048)
+    width: Optional[int] = Field(None, description="Image width in pixels (above 2048 requires hires)", ge=64, le=MAX_HIRES_SIZE)
+    height: Optional[int] = Field(None, description="Image height in pixels (above 2048 requires hires)", ge=64, le=MAX_HIRES_SIZE)
     steps: Optional[int] = Field(None, description="Number of inference steps", ge=1, le=150)
     cfg_scale: Optional[float] = Field(None, description="Classifier-free guidance scale", ge=1.0, le=20.0)
     seed: Optional[int] = Field(-1, description="Random seed for generation (-1 for random)")
     sampling_method: Optional[str] = Field(None, description="Sampling method to use")
     negative_prompt: Optional[str] = Field("", description="Negative prompt for generation")
     output_dir: Optional[str] = Field(None, description="Output directory for generated images")
+    priority: Optional[str] = Field(None, description="Priority class (e.g., 'interactive', 'batch'); "
+                                    "defaults to interactive for direct generation and batch for jobs")
+    hires: Optional[str] = Field(None, description="Two-pass hi-res mode for large images: 'upscale' (ESRGAN) "
+                                 "or 'refine' (img2img at the target size)")
+    hires_strength: Optional[float] = Field(None, description="Denoising strength of the hi-res refine pass",
+                                            ge=0.05, le=1.0)
+    fast_decode: Optional[bool] = Field(False, description="Decode with the tiny autoencoder (TAESD) "
+                                        "for a quick, lower-detail preview")
+    variant: Optional[str] = Field(None, description="Quantized weights: a quality tier ('quality', 'balanced', "
+                                   "'fast', 'fastest') or a quantization type ('q8_0', 'q5_0', 'q4_0', ...)")
+    callback_url: Optional[str] = Field(None, description="Jobs only: URL that receives a signed POST with the "
+                                        "result when the job finishes")
 
     class Config:
         json_schema_extra = {
@@ -527,6 +740,127 @@ class ImageGenerationResponse(BaseModel):
     model: Optional[str] = None
     prompt: Optional[str] = None
     parameters: Optional[Dict[str, Any]] = None
+    timings: Optional[Dict[str, Any]] = None
+    hires: Optional[Dict[str, Any]] = None
+    decoder: Optional[str] = None
+    memory: Optional[Dict[str, Any]] = None
+    variant: Optional[str] = None
+    speculative: Optional[bool] = None  # Pre-rendered before the request arrived (see diffugen_speculate)
+
+def check_image_size(request: ImageGenerationRequest):
+    """Reject sizes above the native limit unless two-pass hi-res is requested"""
+    if not request.hires and max(request.width or 0, request.height or 0) > MAX_NATIVE_SIZE:
+        raise HTTPException(status_code=400,
+                            detail=f"Width and height above {MAX_NATIVE_SIZE} require hires ('upscale' or 'refine')")
+
+# Generate failures that are not the client's fault map to their own status codes
+ERROR_STATUS_CODES = {
+    "cancelled": 499,  # Client closed the request
+    "timeout": 504,  # sd.cpp exceeded its time limit or hung
+    "busy": 503,  # Shed under load; retry after the Retry-After header
+}
+
+def _error_status(result):
+    """HTTP status code for a failed generation result"""
+    return ERROR_STATUS_CODES.get(result.get("error_type"), 400)
+
+def _error_headers(result):
+    """Response headers for a failed generation result: Retry-After when it was shed"""
+    if result.get("retry_after"):
+        return {"Retry-After": str(result["retry_after"])}
+    return None
+
+def shed_if_busy(usage_id=None):
+    """Turn the request away with 503 and Retry-After when it would wait too long for a slot,
+    recording the usage entry already charged for it as busy"""
+    busy = check_load_shedding()
+    if busy:
+        finish_usage(usage_id, busy)
+        print(f"Shedding generation request: {busy['error']}")
+        raise HTTPException(status_code=503, detail=busy["error"], headers=_error_headers(busy))
+
+async def take_speculation(key):
+    """The speculative image for key, awaiting its render without holding a thread. None if there is none"""
+    loop = asyncio.get_running_loop()
+    rendered = asyncio.Event()
+    if speculator.when_rendered(key, lambda: loop.call_soon_threadsafe(rendered.set)):
+        await rendered.wait()
+    return speculator.take(key, wait=False)
+
+# Threads for synchronous generations, waiting for or holding a slot. When all are
+# taken the request is shed, rather than queued behind every other blocking call
+generation_executor = BoundedExecutor(load_tracker.capacity(), name="generation")
+
+async def run_generation(req: Request, generate, priority=None, **kwargs):
+    """Run a blocking generate function in a worker thread, cancelling it if the client disconnects.
+    
+    The request waits for a free generation slot, as it did when generations blocked
+    the event loop, in fair order with the other tenants' requests. Cancelling stops
+    the sd.cpp process group and frees the slot at once, instead of finishing an
+    image nobody will receive. When the predicted wait for a slot is too long, the
+    request is turned away at once with 503 and a Retry-After hint (see diffugen_loadshed).
+    
+    With speculation enabled, a random-seed request is answered with an image pre-rendered
+    for the same prompt and settings when there is one, and queues the next (see diffugen_speculate)."""
+    tenant, weight = tenant_for(req)
+    tool = "flux" if generate is generate_flux_image else "stable"
+    # The model the generate function will run, which is not the server's default_model when none is given
+    model = resolve_model(kwargs.get("model"), tool)
+    speculation_key = None
+    if speculator.enabled and kwargs.get("seed", -1) == -1:
+        speculative_params = dict(kwargs, tool=tool)
+        speculation_key = speculator.key(tenant, speculative_params)
+        speculator.preempt(speculation_key)
+    # A request a speculative image may answer is not shed, unless it turns out to need the GPU
+    speculated = speculation_key is not None and speculator.has(speculation_key)
+    if not speculated:
+        shed_if_busy()
+    token = CancelToken()
+    cost = estimate_work(model, kwargs.get("steps"), kwargs.get("width"), kwargs.get("height"), kwargs.get("hires"))
+    usage_id = charge_usage(req, "generate", model, kwargs.get("steps"),
+                            kwargs.get("width"), kwargs.get("height"), kwargs.get("hires"))
+    if speculated:
+        result = await take_speculation(speculation_key)
+        if result is not None:
+            print(f"Serving a speculatively pre-rendered image: {result.get('image_path')}")
+            finish_usage(usage_id, result)
+            speculator.observe(speculation_key, speculative_params, tenant)
+            return result
+        shed_if_busy(usage_id)
+    
+    def run():
+        with cancel_scope(token, wait_for_slot=True), \
+                tenant_scope(tenant, priority or "interactive", weight=weight, cost=cost):
+            return generate(**kwargs)
+    
+    async def wait_for_disconnect():
+        # The request body has been read, so the next message is the disconnect.
+        # Awaiting receive() works through the HTTP middlewares, unlike req.is_disconnected()
+        while (await req.receive())["type"] != "http.disconnect":
+            pass
+    
+    future = generation_executor.submit(run)
+    if future is None:
+        busy = busy_result({"reason": QUEUE_FULL, "waiting": generation_executor.size,
+                            "retry_after": load_tracker.retry_after()})
+        finish_usage(usage_id, busy)
+        print(f"Shedding generation request: {busy['error']}")
+        raise HTTPException(status_code=503, detail=busy["error"], headers=_error_headers(busy))
+    task = asyncio.wrap_future(future)
+    watcher = asyncio.ensure_future(wait_for_disconnect())
+    result = {"success": False, "error": "Generation did not finish"}
+    try:
+        done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if task not in done:
+            print("Client disconnected, cancelling generation")
+            token.cancel("client_disconnect")
+        result = await task
+        if speculation_key is not None and result.get("success"):
+            speculator.observe(speculation_key, speculative_params, tenant)
+        return result
+    finally:
+        watcher.cancel()
+        finish_usage(usage_id, result)
 
 # Add resource cleanup helper function
 def cleanup_resources():
@@ -570,6 +904,8 @@ async def generate_stable_image(request: ImageGenerationRequest, req: Request, a
                 # Otherwise, follow the original behavior of redirecting to flux
                 return await generate_flux_image_endpoint(request, req)
         
+        check_image_size(request)
+        
         # Validate model name before proceeding (prevent typos)
         valid_models = ["sd15", "sdxl", "sd3"]
         if request.model.lower() not in valid_models:
@@ -595,7 +931,9 @@ async def generate_stable_image(request: ImageGenerationRequest, req: Request, a
         print(f"Using absolute output directory: {abs_output_dir}")
         print(f"Output directory exists: {os.path.exists(abs_output_dir)}")
             
-        result = generate_stable_diffusion_image(
+        result = await run_generation(
+            req,
+            generate_stable_diffusion_image,
             prompt=request.prompt,
             model=request.model,
             width=request.width,
@@ -605,16 +943,22 @@ async def generate_stable_image(request: ImageGenerationRequest, req: Request, a
             seed=request.seed,
             sampling_method=request.sampling_method,
             negative_prompt=request.negative_prompt,
-            output_dir=abs_output_dir
+            hires=request.hires,
+            hires_strength=request.hires_strength,
+            fast_decode=request.fast_decode,
+            variant=request.variant,
+            output_dir=abs_output_dir,
+            priority=request.priority
         )
         
         if not result.get("success", False):
             error_msg = result.get("error", "Unknown error")
             print(f"Image generation failed: {error_msg}")
-            # Raise an HTTPException with 400 Bad Request
+            # Raise an HTTPException with 400 Bad Request (or the status for cancellations)
             raise HTTPException(
-                status_code=400,
-                detail=error_msg
+                status_code=_error_status(result),
+                detail=error_msg,
+                headers=_error_headers(result)
             )
             
         # Create full image URL including host
@@ -658,6 +1002,7 @@ async def generate_stable_image(request: ImageGenerationRequest, req: Request, a
         image_url = f"{base_url}{config['images']['serve_path']}/{file_name}?t={timestamp}"
         
         print(f"Constructed image URL with timestamp: {image_url}")
+        print(f"Generation timings: {result.get('timings')}")
         
         # Create markdown-formatted response
         markdown_response = f"Here's the image you requested:\n\n![Image]({image_url})\n\n**Generation Details:**\n- Model: {result['model']}\n- Prompt: {result['prompt']}\n- Resolution: {result['width']}x{result['height']} pixels\n- Steps: {result['steps']}\n- CFG Scale: {result['cfg_scale']}\n- Sampling Method: {result['sampling_method']}\n- Seed: {result['seed'] if result['seed'] != -1 else 'random'}"
@@ -676,8 +1021,14 @@ async def generate_stable_image(request: ImageGenerationRequest, req: Request, a
                 "cfg_scale": result["cfg_scale"],
                 "seed": result["seed"],
                 "sampling_method": result["sampling_method"],
-                "negative_prompt": result["negative_prompt"]
-            }
+                "negative_prompt": result.get("negative_prompt", "")
+            },
+            timings=result.get("timings"),
+            hires=result.get("hires"),
+            decoder=result.get("decoder"),
+            memory=result.get("memory"),
+            variant=result.get("variant"),
+            speculative=result.get("speculative")
         )
     except HTTPException:
         # Re-raise HTTP exceptions
@@ -702,6 +1053,8 @@ async def generate_flux_image_endpoint(request: ImageGenerationRequest, req: Req
         # Set default model to flux-schnell if not specified
         if not request.model:
             request.model = "flux-schnell"
+        
+        check_image_size(request)
             
         # Validate model name before proceeding
         if request.model.lower() not in ["flux-schnell", "flux-dev"]:
@@ -728,7 +1081,9 @@ async def generate_flux_image_endpoint(request: ImageGenerationRequest, req: Req
         print(f"Using absolute output directory: {abs_output_dir}")
         print(f"Output directory exists: {os.path.exists(abs_output_dir)}")
             
-        result = generate_flux_image(
+        result = await run_generation(
+            req,
+            generate_flux_image,
             prompt=request.prompt,
             model=request.model,
             width=request.width,
@@ -737,7 +1092,12 @@ async def generate_flux_image_endpoint(request: ImageGenerationRequest, req: Req
             cfg_scale=request.cfg_scale,
             seed=request.seed,
             sampling_method=request.sampling_method,
-            output_dir=abs_output_dir
+            hires=request.hires,
+            hires_strength=request.hires_strength,
+            fast_decode=request.fast_decode,
+            variant=request.variant,
+            output_dir=abs_output_dir,
+            priority=request.priority
         )
         
         if not result.get("success", False):
@@ -745,8 +1105,9 @@ async def generate_flux_image_endpoint(request: ImageGenerationRequest, req: Req
             print(f"Image generation failed: {error_msg}")
             # Raise an HTTPException with 400 Bad Request instead of returning a 200 OK
             raise HTTPException(
-                status_code=400,
-                detail=error_msg
+                status_code=_error_status(result),
+                detail=error_msg,
+                headers=_error_headers(result)
             )
             
         # Get the image path from the result and ensure it's an absolute path
@@ -800,6 +1161,7 @@ async def generate_flux_image_endpoint(request: ImageGenerationRequest, req: Req
         image_url = f"{base_url}{config['images']['serve_path']}/{file_name}?t={timestamp}"
         
         print(f"Constructed image URL with timestamp: {image_url}")
+        print(f"Generation timings: {result.get('timings')}")
         
         # Create markdown-formatted response
         markdown_response = f"Here's the image you requested:\n\n![Image]({image_url})\n\n**Generation Details:**\n- Model: {result['model']}\n- Prompt: {result['prompt']}\n- Resolution: {result['width']}x{result['height']} pixels\n- Steps: {result['steps']}\n- CFG Scale: {result['cfg_scale']}\n- Sampling Method: {result['sampling_method']}\n- Seed: {result['seed'] if result['seed'] != -1 else 'random'}"
@@ -818,7 +1180,13 @@ async def generate_flux_image_endpoint(request: ImageGenerationRequest, req: Req
                 "cfg_scale": result["cfg_scale"],
                 "seed": result["seed"],
                 "sampling_method": result["sampling_method"]
-            }
+            },
+            timings=result.get("timings"),
+            hires=result.get("hires"),
+            decoder=result.get("decoder"),
+            memory=result.get("memory"),
+            variant=result.get("variant"),
+            speculative=result.get("speculative")
         )
     except HTTPException:
         # Re-raise HTTP exceptions
@@ -843,7 +1211,6 @@ async def list_models():
         if "models" in config and config["models"]:
             models = config["models"]
         else:
-            diffugen_config = load_diffugen_config()
             models = {
                 "flux": ["flux-schnell", "flux-dev"],
                 "stable_diffusion": ["sdxl", "sd3", "sd15"]
@@ -853,7 +1220,6 @@ async def list_models():
         if "default_params" in config:
             default_params = config["default_params"]
         else:
-            diffugen_config = load_diffugen_config()
             default_params = diffugen_config.get("default_params", {})
         
         return {
@@ -924,6 +1290,380 @@ async def generate_image(request: ImageGenerationRequest, req: Request, api_key:
         else:
             return await generate_stable_image(request, req)
 
+class JobSubmitResponse(BaseModel):
+    """Response for a queued generation job"""
+    job_id: str
+    status: str
+    status_url: str
+    estimated_start: Optional[float] = None
+    estimated_completion: Optional[float] = None
+
+class JobStatusResponse(BaseModel):
+    """Status and (once finished) result of a generation job"""
+    job_id: str
+    status: str
+    model: Optional[str] = None
+    prompt: Optional[str] = None
+    tenant: Optional[str] = None
+    priority: Optional[str] = None
+    submitted_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    estimated_start: Optional[float] = None
+    estimated_completion: Optional[float] = None
+    worker: Optional[str] = None
+    error: Optional[str] = None
+    image_url: Optional[str] = None
+    parameters: Optional[Dict[str, Any]] = None
+    timings: Optional[Dict[str, Any]] = None
+    cells: Optional[List[Dict[str, Any]]] = None  # Sweeps: the cells finished so far
+    total_cells: Optional[int] = None
+    webhook_status: Optional[str] = None  # pending, delivered or failed, for jobs with a callback_url
+
+def check_callback_url(callback_url):
+    """Reject a callback URL that completion webhooks cannot deliver to"""
+    if callback_url:
+        try:
+            validate_callback_url(callback_url, webhooks.settings)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+def _cell_views(job, req):
+    """Public view of a sweep job's finished cells, with their image URLs"""
+    base_url = str(req.base_url).rstrip('/')
+    return [{"index": cell["index"], "values": cell["values"], "label": cell["label"], "success": cell["success"],
+             "seed": cell.get("seed"), "error": cell.get("error"), "timings": cell.get("timings"),
+             "image_url": f"{base_url}/jobs/{job['id']}/cells/{cell['index']}/image" if cell["success"] else None}
+            for cell in (job.get("result") or {}).get("cells", [])]
+
+def _job_response(job, req, eta=None):
+    """Build the public view of a job record; eta holds its estimated start and completion times"""
+    eta = eta or {}
+    result = job.get("result") or {}
+    image_url = None
+    if job["status"] == SUCCEEDED and (job["tool"] != "sweep" or result.get("image_path")):
+        image_url = f"{str(req.base_url).rstrip('/')}/jobs/{job['id']}/image"
+    parameters = None
+    if result.get("success"):
+        parameters = {key: result.get(key) for key in
+                      ("width", "height", "steps", "cfg_scale", "seed", "sampling_method", "negative_prompt")
+                      if key in result}
+    return JobStatusResponse(
+        job_id=job["id"],
+        status=job["status"],
+        model=result.get("model") or job["params"].get("model"),
+        prompt=job["params"].get("prompt"),
+        tenant=job.get("tenant"),
+        priority=job.get("priority"),
+        submitted_at=job["submitted_at"],
+        started_at=job.get("started_at"),
+        finished_at=job.get("finished_at"),
+        estimated_start=eta.get("estimated_start"),
+        estimated_completion=eta.get("estimated_completion"),
+        worker=job.get("worker"),
+        error=job.get("error"),
+        image_url=image_url,
+        parameters=parameters,
+        timings=result.get("timings"),
+        cells=_cell_views(job, req) if job["tool"] == "sweep" else None,
+        total_cells=len(expand_grid(job["params"]["axes"])) if job["tool"] == "sweep" else None,
+        webhook_status=job.get("webhook_status")
+    )
+
+@app.post("/jobs",
+    response_model=JobSubmitResponse,
+    status_code=202,
+    tags=["Jobs"],
+    summary="Queue an Image Generation Job",
+    description="Queue a generation on the job broker and return immediately; poll the status URL for the result")
+async def submit_job(request: ImageGenerationRequest, req: Request, api_key: str = Depends(verify_api_key)):
+    """Queue an image generation job for any worker attached to the broker"""
+    model = (request.model or config.get("default_model", "flux-schnell")).lower()
+    flux_models = ["flux-schnell", "flux-dev"]
+    if model not in flux_models + ["sd15", "sdxl", "sd3"]:
+        raise HTTPException(status_code=400, detail=f"Model {request.model} is not supported")
+    check_image_size(request)
+    check_callback_url(request.callback_url)
+    
+    # Workers choose their own output directory; the image travels back through the broker
+    params = {
+        "prompt": request.prompt,
+        "model": model,
+        "width": request.width,
+        "height": request.height,
+        "steps": request.steps,
+        "cfg_scale": request.cfg_scale,
+        "seed": request.seed,
+        "sampling_method": request.sampling_method,
+        "hires": request.hires,
+        "hires_strength": request.hires_strength,
+        "fast_decode": request.fast_decode,
+        "variant": request.variant
+    }
+    if model in flux_models:
+        tool = "flux"
+    else:
+        tool = "stable"
+        params["negative_prompt"] = request.negative_prompt
+    
+    tenant, weight = tenant_for(req)
+    priority = fair_policy.priority(request.priority or "batch")
+    usage_id = charge_usage(req, "job", model, request.steps, request.width, request.height, request.hires)
+    try:
+        job = get_job_manager().submit(tool, params, tenant, priority, fair_policy.weight(priority, weight),
+                                       estimate_work(model, request.steps, request.width, request.height,
+                                                     request.hires), request.callback_url)
+    except Exception as e:
+        finish_usage(usage_id, {"success": False})
+        print(f"Could not submit job: {e}")
+        raise HTTPException(status_code=503, detail=f"Job broker unavailable: {e}")
+    if usage_id is not None:
+        try:
+            # The job's GPU-seconds are recorded once it finishes (see _reconcile_job_usage)
+            usage_ledger.attach_job(usage_id, job["id"])
+        except Exception as e:
+            print(f"Could not record usage for job {job['id']}: {e}")
+    
+    print(f"Queued job {job['id']} ({tool}, {model}) for {tenant} as {priority}")
+    return JobSubmitResponse(
+        job_id=job["id"],
+        status=job["status"],
+        status_url=f"{str(req.base_url).rstrip('/')}/jobs/{job['id']}",
+        **job_eta(job["id"])
+    )
+
+@app.get("/jobs",
+    response_model=Dict[str, List[JobStatusResponse]],
+    tags=["Jobs"],
+    summary="List Jobs",
+    description="List the caller's recent jobs, optionally filtered by status")
+async def list_jobs(req: Request, status: Optional[str] = None, limit: int = 50, api_key: str = Depends(verify_api_key)):
+    """List recent generation jobs of the caller's tenant (every tenant's for admin API keys)"""
+    try:
+        jobs = get_job_manager().list(status=status, limit=max(1, min(limit, 500)),
+                                      tenant=None if is_admin(req) else tenant_for(req)[0])
+        etas = estimate_job_times() if any(job["status"] not in FINISHED_STATES for job in jobs) else {}
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Job broker unavailable: {e}")
+    return {"jobs": [_job_response(job, req, job_eta(job["id"], etas)) for job in jobs]}
+
+@app.get("/jobs/{job_id}",
+    response_model=JobStatusResponse,
+    tags=["Jobs"],
+    summary="Get Job Status",
+    description="Get a job's status, and its parameters, timings and image URL once it has finished")
+async def get_job(job_id: str, req: Request, api_key: str = Depends(verify_api_key)):
+    """Get the status of a generation job"""
+    job = get_tenant_job(job_id, req)
+    return _job_response(job, req, job_eta(job_id) if job["status"] not in FINISHED_STATES else None)
+
+@app.delete("/jobs/{job_id}",
+    response_model=JobStatusResponse,
+    tags=["Jobs"],
+    summary="Cancel Job",
+    description="Cancel a queued job, or stop a running job's sd.cpp process on whichever worker runs it")
+async def cancel_job(job_id: str, req: Request, api_key: str = Depends(verify_api_key)):
+    """Cancel a generation job"""
+    get_tenant_job(job_id, req)
+    try:
+        job = get_job_manager().cancel(job_id)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Job broker unavailable: {e}")
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    if job["status"] in FINISHED_STATES and job["status"] != CANCELLED:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} already {job['status']}")
+    print(f"Cancel requested for job {job_id} ({job['status']})")
+    return _job_response(job, req)
+
+@app.get("/jobs/{job_id}/image",
+    tags=["Jobs"],
+    summary="Get Job Image",
+    description="Download the image produced by a finished job, from any API node")
+async def get_job_image(job_id: str, req: Request, api_key: str = Depends(verify_api_key)):
+    """Serve a finished job's image from local disk or, when it ran on another node, from the broker"""
+    manager = get_job_manager()
+    job = get_tenant_job(job_id, req)
+    if job["status"] != SUCCEEDED:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job['status']}")
+    
+    image_path = (job.get("result") or {}).get("image_path")
+    if image_path and os.path.exists(image_path):
+        metrics.IMAGE_BYTES_SERVED.inc(os.path.getsize(image_path))
+        return FileResponse(image_path, media_type="image/png")
+    
+    image = manager.get_image(job_id)
+    if image is None:
+        raise HTTPException(status_code=404, detail=f"Image for job {job_id} is no longer available")
+    metrics.IMAGE_BYTES_SERVED.inc(len(image))
+    return Response(content=image, media_type="image/png")
+
+class SweepRequest(BaseModel):
+    prompt: str = Field(..., description="Text prompt rendered in every cell")
+    axes: Dict[str, List[Union[float, int, str]]] = Field(..., description="Values to try per parameter: "
+                                                          "cfg_scale, steps, sampling_method and/or seed")
+    model: Optional[str] = Field(None, description="Model to use for generation (e.g., 'sdxl', 'flux-schnell')")
+    width: Optional[int] = Field(None, description="Image width in pixels", ge=64, le=MAX_NATIVE_SIZE)
+    height: Optional[int] = Field(None, description="Image height in pixels", ge=64, le=MAX_NATIVE_SIZE)
+    steps: Optional[int] = Field(None, description="Number of inference steps, unless swept", ge=1, le=150)
+    cfg_scale: Optional[float] = Field(None, description="Guidance scale, unless swept", ge=1.0, le=20.0)
+    seed: Optional[int] = Field(-1, description="Seed shared by every cell, unless swept (-1 for one random seed)")
+    sampling_method: Optional[str] = Field(None, description="Sampling method, unless swept")
+    negative_prompt: Optional[str] = Field("", description="Negative prompt for SD models")
+    contact_sheet: Optional[bool] = Field(True, description="Also build a labeled grid of all the cells")
+    priority: Optional[str] = Field(None, description="Priority class (defaults to batch)")
+    fast_decode: Optional[bool] = Field(False, description="Decode with the tiny autoencoder (TAESD)")
+    variant: Optional[str] = Field(None, description="Quantized weights: a quality tier or a quantization type")
+    callback_url: Optional[str] = Field(None, description="URL that receives a signed POST with the result "
+                                        "when the sweep finishes")
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "prompt": "a lighthouse on a cliff at sunset",
+                "model": "sdxl",
+                "axes": {"cfg_scale": [4, 6, 8], "sampling_method": ["euler_a", "dpm++2m"]},
+                "steps": 25
+            }
+        }
+
+class SweepSubmitResponse(JobSubmitResponse):
+    """Response for a queued parameter sweep"""
+    cells: int
+    stream_url: str
+
+@app.post("/sweeps",
+    response_model=SweepSubmitResponse,
+    status_code=202,
+    tags=["Jobs"],
+    summary="Queue a Parameter Sweep",
+    description="Render one prompt over every combination of the given settings as a single job. "
+                "Follow it at the status URL, or stream each cell as it finishes from the stream URL")
+async def submit_sweep(request: SweepRequest, req: Request, api_key: str = Depends(verify_api_key)):
+    """Queue a parameter sweep job"""
+    model = (request.model or config.get("default_model", "flux-schnell")).lower()
+    if model not in ["flux-schnell", "flux-dev", "sd15", "sdxl", "sd3"]:
+        raise HTTPException(status_code=400, detail=f"Model {request.model} is not supported")
+    try:
+        axes = normalize_axes(request.axes, int(dict(DEFAULT_SWEEP, **diffugen_config["sweep"])["max_cells"]))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    check_callback_url(request.callback_url)
+    params = {"prompt": request.prompt, "axes": axes, "model": model, "width": request.width,
+              "height": request.height, "steps": request.steps, "cfg_scale": request.cfg_scale,
+              "seed": request.seed, "sampling_method": request.sampling_method,
+              "negative_prompt": request.negative_prompt, "contact_sheet": request.contact_sheet,
+              "fast_decode": request.fast_decode, "variant": request.variant}
+    
+    tenant, weight = tenant_for(req)
+    priority = fair_policy.priority(request.priority or "batch")
+    work = estimate_sweep_work(model, axes, request.steps, request.width, request.height)
+    usage_id = charge_usage(req, "sweep", model, request.steps, request.width, request.height, work=work)
+    try:
+        job = get_job_manager().submit("sweep", params, tenant, priority, fair_policy.weight(priority, weight), work,
+                                       request.callback_url)
+    except Exception as e:
+        finish_usage(usage_id, {"success": False})
+        print(f"Could not submit sweep: {e}")
+        raise HTTPException(status_code=503, detail=f"Job broker unavailable: {e}")
+    if usage_id is not None:
+        try:
+            usage_ledger.attach_job(usage_id, job["id"])
+        except Exception as e:
+            print(f"Could not record usage for job {job['id']}: {e}")
+    
+    cells = len(expand_grid(axes))
+    print(f"Queued sweep {job['id']} ({model}, {cells} cells) for {tenant} as {priority}")
+    base_url = str(req.base_url).rstrip('/')
+    return SweepSubmitResponse(
+        job_id=job["id"],
+        status=job["status"],
+        status_url=f"{base_url}/jobs/{job['id']}",
+        stream_url=f"{base_url}/sweeps/{job['id']}/stream",
+        cells=cells,
+        **job_eta(job["id"])
+    )
+
+@app.get("/sweeps/{job_id}/stream",
+    tags=["Jobs"],
+    summary="Stream Sweep Cells",
+    description="Newline-delimited JSON: one line per cell as it finishes, then a final line with the job's status")
+async def stream_sweep(job_id: str, req: Request, poll_interval: float = 0.5, api_key: str = Depends(verify_api_key)):
+    """Stream a sweep's cells as they finish"""
+    manager = get_job_manager()
+    job = get_tenant_job(job_id, req, tool="sweep")
+    poll_interval = max(0.1, min(poll_interval, 10.0))
+    
+    async def events():
+        sent = 0
+        current = job
+        while True:
+            cells = _cell_views(current, req)
+            for cell in cells[sent:]:
+                yield json.dumps({"event": "cell", **cell}) + "\n"
+            sent = max(sent, len(cells))
+            if current["status"] in FINISHED_STATES:
+                final = _job_response(current, req)
+                yield json.dumps({"event": "done", "status": final.status, "error": final.error,
+                                  "contact_sheet_url": final.image_url, "timings": final.timings}) + "\n"
+                return
+            await asyncio.sleep(poll_interval)
+            try:
+                current = await asyncio.get_running_loop().run_in_executor(None, manager.get, job_id)
+            except Exception as e:
+                yield json.dumps({"event": "error", "error": f"Job broker unavailable: {e}"}) + "\n"
+                return
+            if current is None:
+                yield json.dumps({"event": "error", "error": f"Sweep {job_id} expired"}) + "\n"
+                return
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+@app.get("/jobs/{job_id}/cells/{index}/image",
+    tags=["Jobs"],
+    summary="Get Sweep Cell Image",
+    description="Download the image of one finished cell of a parameter sweep")
+async def get_sweep_cell_image(job_id: str, index: int, req: Request, api_key: str = Depends(verify_api_key)):
+    """Serve a sweep cell's image from the disk of the node that ran it (or a shared output directory)"""
+    job = get_tenant_job(job_id, req, tool="sweep")
+    cells = {cell["index"]: cell for cell in (job.get("result") or {}).get("cells", [])}
+    cell = cells.get(index)
+    if cell is None or not cell.get("success"):
+        raise HTTPException(status_code=404, detail=f"Cell {index} of sweep {job_id} has no image")
+    if not cell.get("image_path") or not os.path.exists(cell["image_path"]):
+        raise HTTPException(status_code=404, detail=f"Image of cell {index} is not available on this node")
+    metrics.IMAGE_BYTES_SERVED.inc(os.path.getsize(cell["image_path"]))
+    return FileResponse(cell["image_path"], media_type="image/png")
+
+@app.get("/usage",
+    response_model=Dict[str, Any],
+    tags=["Usage"],
+    summary="Get Usage",
+    description="Usage and quota of the calling API key, and its ledger totals per model")
+async def get_usage(req: Request, since: Optional[float] = None, until: Optional[float] = None,
+                    tenant: Optional[str] = None, api_key: str = Depends(verify_api_key)):
+    """Report the caller's usage in the current quota window and ledger totals between since and until.
+    
+    API keys with "admin": true may query another tenant, or every tenant with tenant=*"""
+    if usage_ledger is None:
+        raise HTTPException(status_code=404, detail="Usage ledger is disabled")
+    own_tenant, _ = tenant_for(req)
+    if tenant is not None and tenant != own_tenant and not is_admin(req):
+        raise HTTPException(status_code=403, detail="Only admin API keys can read other tenants' usage")
+    tenant = tenant or own_tenant
+    try:
+        _reconcile_job_usage(None if tenant == "*" else tenant)
+        if since is None:
+            since = time.time() - QUOTA_WINDOW_SECONDS
+        ledger = usage_ledger.summary(since, until, None if tenant == "*" else tenant)
+        response = {"tenant": tenant, "since": since, "until": until, "ledger": ledger}
+        if tenant == own_tenant:
+            response.update(window_seconds=QUOTA_WINDOW_SECONDS, quota=quota_for(req),
+                            used=usage_ledger.used(tenant, QUOTA_WINDOW_SECONDS))
+        return response
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Usage ledger unavailable: {e}")
+
 # Update the main function to use configuration
 if __name__ == "__main__":
     import uvicorn
@@ -932,11 +1672,14 @@ if __name__ == "__main__":
     parser.add_argument("--host", type=str, help="Host to bind the server to")
     parser.add_argument("--port", type=int, help="Port to bind the server to")
     parser.add_argument("--config", type=str, help="Path to custom config file")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of uvicorn worker processes (they share the GPU through the generation lock directory)")
     args = parser.parse_args()
     
     # Override config with command line arguments if provided
     host = args.host or config["server"]["host"]
     port = args.port or config["server"]["port"]
+    workers = args.workers or config["server"].get("workers", 1)
     
     # Load custom config file if specified
     if args.config:
@@ -945,6 +1688,8 @@ if __name__ == "__main__":
                 custom_config = json.load(f)
                 config.update(custom_config)
                 print(f"Loaded custom configuration from {args.config}")
+            # Worker processes re-import this module, so hand the file to them as well
+            os.environ["DIFFUGEN_OPENAPI_CONFIG"] = os.path.abspath(args.config)
         except Exception as e:
             print(f"Error loading custom configuration: {e}")
     
@@ -952,4 +1697,9 @@ if __name__ == "__main__":
     print(f"Documentation available at http://{host}:{port}/docs")
     print(f"Serving images from {DEFAULT_OUTPUT_DIR} at {host}:{port}{config['images']['serve_path']}")
     
-    uvicorn.run(app, host=host, port=port) 
\ No newline at end of file
+    if workers > 1:
+        # Multiple workers require an import string; each worker imports its own app
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        uvicorn.run("diffugen_openapi:app", host=host, port=port, workers=workers)
+    else:
+        uvicorn.run(app, host=host, port=port)
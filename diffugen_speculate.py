@@ -0,0 +1,210 @@
+"""Speculative pre-generation of the next variant for recent prompts.
+
+Users who ask for "another one" tend to ask again. With speculation enabled,
+each random-seed request queues one more render of the same prompt and
+settings. That render runs while the GPU is otherwise idle, and the next
+identical request is answered with it at once:
+
+    "speculation": {
+        "enabled": true,
+        "budget": 4,
+        "ttl_seconds": 600
+    }
+
+budget bounds the images pre-rendered, being rendered and waiting to render at
+any one time, so speculation never takes more than that much disk or GPU time
+ahead of demand. A pre-rendered image that no request claims within
+ttl_seconds is deleted. A real request stops a running speculative render of
+another prompt, so speculation only ever uses idle time.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from diffugen_jobs import CancelToken
+
+DEFAULT_SPECULATION = {
+    "enabled": False,  # Opt in to pre-rendering follow-up images
+    "budget": 4,  # Speculative images pre-rendered, rendering or waiting to render at once
+    "ttl_seconds": 600,  # Delete a pre-rendered image no request claimed within this long
+    "idle_seconds": 2,  # GPU idle time before a speculative render starts
+}
+# Request fields that do not change what an image of a random-seed request looks like
+IGNORED_FIELDS = ("seed", "output_dir", "priority")
+
+USED = "used"
+EXPIRED = "expired"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+class Speculator:
+    """Pre-renders the next image for recent random-seed requests in idle GPU time.
+
+    render(params, tenant, token) runs one generation and returns its result dict,
+    is_idle() tells whether no real generation is running or waiting, and
+    discard(result) deletes an unused image. count(outcome) records what became
+    of each speculative image (used, expired, cancelled or failed)."""
+
+    def __init__(self, speculation_config, render, is_idle, discard, count=None):
+        self.settings = dict(DEFAULT_SPECULATION, **(speculation_config or {}))
+        self.render = render
+        self.is_idle = is_idle
+        self.discard = discard
+        self.count = count or (lambda outcome: None)
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()  # key -> (params, tenant), oldest first
+        self._ready = {}  # key -> (rendered_at, result)
+        self._running = None  # {"key", "token", "done"}
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self):
+        return bool(self.settings["enabled"])
+
+    @staticmethod
+    def key(tenant, params):
+        """What makes two random-seed requests interchangeable: the tenant and every setting but the seed"""
+        settings = {name: value for name, value in params.items() if name not in IGNORED_FIELDS}
+        return json.dumps([tenant, settings], sort_keys=True, default=str)
+
+    def start(self):
+        """Render speculations in a background thread (once)"""
+        with self._lock:
+            if not self.enabled or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="diffugen-speculator", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def has(self, key):
+        """Whether a speculative image for key is ready or rendering"""
+        with self._lock:
+            return key in self._ready or (self._running is not None and self._running["key"] == key)
+
+    def when_rendered(self, key, callback):
+        """Call callback() from the speculator's thread once the render of key finishes.
+        False, and callback is not called, if key is not rendering"""
+        with self._lock:
+            if self._running is None or self._running["key"] != key:
+                return False
+            self._running["callbacks"].append(callback)
+            return True
+
+    def take(self, key, wait=True):
+        """Claim the pre-rendered result for key, waiting for it if it is rendering (unless wait
+        is False, see when_rendered). None if there is none"""
+        with self._lock:
+            running = self._running if self._running is not None and self._running["key"] == key else None
+        if running is not None and wait:
+            running["done"].wait()
+        with self._lock:
+            entry = self._ready.pop(key, None)
+        if entry is None:
+            return None
+        rendered_at, result = entry
+        if time.time() - rendered_at > float(self.settings["ttl_seconds"]):
+            self._expire(result)
+            return None
+        self.count(USED)
+        return dict(result, speculative=True, speculated_at=rendered_at)
+
+    def preempt(self, key):
+        """A real request for key arrived: stop a speculative render of anything else"""
+        with self._lock:
+            running = self._running
+        if running is not None and running["key"] != key:
+            running["token"].cancel("speculation_preempted")
+
+    def observe(self, key, params, tenant):
+        """A random-seed request for key was served: pre-render the next image for it"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if key in self._pending:
+                # Asked again: render it sooner
+                self._pending.move_to_end(key)
+                return
+            if key in self._ready or (self._running is not None and self._running["key"] == key):
+                return
+            in_use = len(self._pending) + len(self._ready) + (1 if self._running is not None else 0)
+            if in_use >= int(self.settings["budget"]):
+                if not self._pending:
+                    return
+                # Older prompts are less likely to be asked again
+                self._pending.popitem(last=False)
+            self._pending[key] = (params, tenant)
+
+    def status(self):
+        with self._lock:
+            return {"enabled": self.enabled, "budget": int(self.settings["budget"]), "pending": len(self._pending),
+                    "ready": len(self._ready), "rendering": self._running is not None}
+
+    def _expire(self, result):
+        self.count(EXPIRED)
+        try:
+            self.discard(result)
+        except Exception as e:
+            logging.warning(f"Could not delete an expired speculative image: {e}")
+
+    def _expire_stale(self):
+        ttl = float(self.settings["ttl_seconds"])
+        with self._lock:
+            stale = [key for key, (rendered_at, _) in self._ready.items() if time.time() - rendered_at > ttl]
+            results = [self._ready.pop(key)[1] for key in stale]
+        for result in results:
+            self._expire(result)
+
+    def _run(self):
+        idle_since = None
+        while not self._stop.wait(0.5):
+            self._expire_stale()
+            if not self.is_idle():
+                idle_since = None
+                continue
+            idle_since = idle_since or time.time()
+            if time.time() - idle_since < float(self.settings["idle_seconds"]):
+                continue
+            with self._lock:
+                if not self._pending:
+                    continue
+                # The most recent prompt is the likeliest to be asked for again
+                key, (params, tenant) = self._pending.popitem(last=True)
+                running = {"key": key, "token": CancelToken(), "done": threading.Event(), "callbacks": []}
+                self._running = running
+            try:
+                self._render(key, params, tenant, running["token"])
+            finally:
+                with self._lock:
+                    self._running = None
+                running["done"].set()
+                for callback in running["callbacks"]:
+                    try:
+                        callback()
+                    except Exception as e:
+                        logging.warning(f"Speculation callback failed: {e}")
+            idle_since = None
+
+    def _render(self, key, params, tenant, token):
+        try:
+            result = self.render(params, tenant, token)
+        except Exception as e:
+            logging.warning(f"Speculative generation failed: {e}")
+            result = {"success": False, "error": str(e)}
+        if result.get("success"):
+            with self._lock:
+                self._ready[key] = (time.time(), result)
+            logging.info(f"Pre-rendered a speculative image for {params.get('model')}: {result.get('image_path')}")
+        elif result.get("error_type") == "busy":
+            # A real request took the slot first; try again when the GPU is idle
+            with self._lock:
+                self._pending.setdefault(key, (params, tenant))
+        else:
+            self.count(CANCELLED if result.get("error_type") == "cancelled" else FAILED)
+            if result.get("image_path") and os.path.exists(result["image_path"]):
+                self.discard(result)
@@ -0,0 +1,125 @@
+"""Parameter sweeps: one prompt rendered over a grid of generation settings.
+
+A sweep names the values to try along one or more axes:
+
+    {"cfg_scale": [3, 5, 7], "steps": [20, 30], "sampling_method": ["euler", "dpm++2m"], "seed": [1, 2]}
+
+and runs every combination as a single job. Each cell is a separate sd.cpp run
+that takes a generation slot of its own through the fair gate, so a long grid
+does not hold back other tenants; on an otherwise idle node the cells run back
+to back and the weights stay in the OS page cache. Cells are ordered with the
+last axis varying fastest, and each one is reported as soon as it finishes. A labeled contact sheet
+(a PNG when Pillow is installed, otherwise an HTML page) lays the grid out with
+one row per combination of the leading axes.
+"""
+import html
+import itertools
+import os
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+# Sweepable parameters and the type of their values
+SWEEP_AXES = {"cfg_scale": float, "steps": int, "sampling_method": str, "seed": int}
+AXIS_ALIASES = {"cfg": "cfg_scale", "sampler": "sampling_method", "samplers": "sampling_method", "seeds": "seed"}
+AXIS_LABELS = {"cfg_scale": "cfg", "steps": "steps", "sampling_method": "sampler", "seed": "seed"}
+DEFAULT_SWEEP = {
+    "max_cells": 64,  # Largest grid accepted in one sweep
+    "thumbnail_size": 384,  # Longest side of a contact sheet tile in pixels
+}
+
+def normalize_axes(axes, max_cells=DEFAULT_SWEEP["max_cells"]):
+    """Validate sweep axes and convert their values. Returns an ordered {axis: [values]} dict.
+    Raises ValueError for unknown axes, empty or invalid values, or grids over max_cells"""
+    if not axes:
+        raise ValueError(f"A sweep needs at least one axis ({', '.join(SWEEP_AXES)})")
+    normalized = {}
+    for name, values in axes.items():
+        axis = AXIS_ALIASES.get(name, name)
+        if axis not in SWEEP_AXES:
+            raise ValueError(f"Unknown sweep axis: {name}. Use {', '.join(SWEEP_AXES)}")
+        if axis in normalized:
+            raise ValueError(f"Sweep axis {axis} given twice")
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        if not values:
+            raise ValueError(f"Sweep axis {axis} has no values")
+        try:
+            normalized[axis] = [SWEEP_AXES[axis](value) for value in values]
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid value for sweep axis {axis}: {values}")
+    cells = 1
+    for values in normalized.values():
+        cells *= len(values)
+    if cells > max_cells:
+        raise ValueError(f"Sweep has {cells} cells, more than the limit of {max_cells}")
+    return normalized
+
+def expand_grid(axes):
+    """Every combination of normalized axes, the last axis varying fastest"""
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+def cell_label(values):
+    """Short label of a cell's settings, e.g. "cfg 7.0 · steps 20 · sampler euler" """
+    return " · ".join(f"{AXIS_LABELS[axis]} {value}" for axis, value in values.items())
+
+def grid_columns(axes):
+    """Columns of the contact sheet: the number of values on the last axis"""
+    return len(list(axes.values())[-1])
+
+def build_contact_sheet(cells, output_dir, name, columns, title="", thumbnail_size=DEFAULT_SWEEP["thumbnail_size"]):
+    """Lay the cells out in a labeled grid. Returns the sheet's path: a PNG with Pillow,
+    otherwise an HTML page that references the cell images next to it"""
+    if Image is None:
+        path = os.path.join(output_dir, f"{name}.html")
+        _html_sheet(cells, path, columns, title)
+    else:
+        path = os.path.join(output_dir, f"{name}.png")
+        _png_sheet(cells, path, columns, title, thumbnail_size)
+    return path
+
+def _png_sheet(cells, path, columns, title, thumbnail_size):
+    tiles = []
+    for cell in cells:
+        tile = None
+        if cell.get("success") and cell.get("image_path") and os.path.exists(cell["image_path"]):
+            tile = Image.open(cell["image_path"]).convert("RGB")
+            tile.thumbnail((thumbnail_size, thumbnail_size))
+        tiles.append(tile)
+    tile_width = max([tile.width for tile in tiles if tile is not None] or [thumbnail_size])
+    tile_height = max([tile.height for tile in tiles if tile is not None] or [thumbnail_size])
+    label_height, title_height, gap = 18, 24 if title else 0, 4
+    rows = (len(cells) + columns - 1) // columns
+    sheet = Image.new("RGB", (columns * (tile_width + gap) + gap,
+                              title_height + rows * (tile_height + label_height + gap) + gap), "white")
+    draw = ImageDraw.Draw(sheet)
+    if title:
+        draw.text((gap, 6), title[:200], fill="black")
+    for index, (cell, tile) in enumerate(zip(cells, tiles)):
+        x = gap + (index % columns) * (tile_width + gap)
+        y = title_height + gap + (index // columns) * (tile_height + label_height + gap)
+        if tile is None:
+            draw.rectangle((x, y, x + tile_width - 1, y + tile_height - 1), fill=(200, 200, 200))
+            draw.text((x + 6, y + 6), "failed", fill="black")
+        else:
+            sheet.paste(tile, (x, y))
+        draw.text((x + 2, y + tile_height + 3), cell["label"], fill="black")
+    sheet.save(path)
+
+def _html_sheet(cells, path, columns, title):
+    rows = []
+    for start in range(0, len(cells), columns):
+        row = []
+        for cell in cells[start:start + columns]:
+            if cell.get("success") and cell.get("image_path"):
+                image = f'<img src="{html.escape(os.path.basename(cell["image_path"]))}" width="256">'
+            else:
+                image = f'<div>failed: {html.escape(str(cell.get("error") or "unknown error"))}</div>'
+            row.append(f"<td>{image}<br>{html.escape(cell['label'])}</td>")
+        rows.append("<tr>" + "".join(row) + "</tr>")
+    with open(path, "w") as f:
+        f.write(f"<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>{html.escape(title)}</title></head>"
+                f"<body><h3>{html.escape(title)}</h3><table>{''.join(rows)}</table></body></html>\n")
@@ -0,0 +1,208 @@
+"""Per-tenant usage ledger and cost-based quotas.
+
+Every generation is charged its estimated compute cost, steps x megapixels x
+model factor, when it is submitted. Its measured GPU-seconds (sd.cpp run time)
+are recorded when it finishes. The ledger is a SQLite database, so every server
+process on a host shares it and it survives restarts.
+
+Quotas limit the cost and/or GPU-seconds a tenant may use within a rolling
+window, and are checked before a generation is accepted:
+
+    "quotas": {
+        "ledger_path": "/var/lib/diffugen/usage.db",
+        "window": "day",
+        "default": {"cost": 2000, "gpu_seconds": 3600},
+        "model_factors": {"flux-dev": 3.0, "sd15": 0.3}
+    }
+
+Usage:
+    python diffugen_usage.py [--ledger /var/lib/diffugen/usage.db] [--since 2025-01-01] [--tenant studio]
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from diffugen_jobs import _Transaction
+
+# Relative per-step cost of each model at one megapixel; SDXL is the reference
+DEFAULT_MODEL_FACTORS = {
+    "flux-schnell": 3.0,
+    "flux-dev": 3.0,
+    "sdxl": 1.0,
+    "sd3": 1.0,
+    "sd15": 0.3,
+}
+WINDOWS = {"minute": 60, "hour": 3600, "day": 86400, "week": 604800, "month": 2592000}
+
+PENDING = "pending"
+
+def window_seconds(window):
+    """Seconds in a quota window given as a name (hour, day, ...) or a number of seconds"""
+    if isinstance(window, str) and window.lower() in WINDOWS:
+        return WINDOWS[window.lower()]
+    return float(window)
+
+def estimate_cost(model, work, model_factors=None):
+    """Cost of a generation from its work (steps x megapixels, see diffugen.estimate_work)"""
+    factors = dict(DEFAULT_MODEL_FACTORS, **(model_factors or {}))
+    return round(work * float(factors.get(model, 1.0)), 4)
+
+class QuotaExceeded(Exception):
+    """A generation would take a tenant over its quota"""
+
+    def __init__(self, tenant, limit, used, quota, retry_after):
+        self.tenant = tenant
+        self.limit = limit
+        self.used = used
+        self.quota = quota
+        self.retry_after = retry_after
+        super().__init__(f"{limit} quota exceeded for {tenant}: {round(used, 2)} of {quota} used")
+
+class UsageLedger:
+    """Usage entries in a SQLite database shared by every process on the host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection(immediate=True) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage (
+                    id TEXT PRIMARY KEY,
+                    tenant TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    job_id TEXT,
+                    model TEXT,
+                    width INTEGER,
+                    height INTEGER,
+                    steps INTEGER,
+                    cost REAL NOT NULL,
+                    gpu_seconds REAL NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS usage_tenant ON usage (tenant, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS usage_pending ON usage (status, kind)")
+
+    def _connection(self, immediate=False):
+        # One connection per thread; sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return _Transaction(conn, immediate)
+
+    @staticmethod
+    def _used(conn, tenant, since):
+        cost, gpu_seconds, oldest = conn.execute(
+            "SELECT COALESCE(SUM(cost), 0), COALESCE(SUM(gpu_seconds), 0), MIN(created_at) "
+            "FROM usage WHERE tenant = ? AND created_at >= ?", (tenant, since)).fetchone()
+        return cost, gpu_seconds, oldest
+
+    def charge(self, tenant, cost, quota=None, window=86400, kind="generate", model=None,
+               width=None, height=None, steps=None):
+        """Record a generation about to run and return its entry ID.
+
+        quota ({"cost": ..., "gpu_seconds": ...}) is checked in the same transaction,
+        so concurrent requests from one tenant cannot overshoot it. Raises QuotaExceeded."""
+        now = time.time()
+        entry_id = uuid.uuid4().hex
+        with self._connection(immediate=True) as conn:
+            if quota:
+                used_cost, used_gpu_seconds, oldest = self._used(conn, tenant, now - window)
+                # Pending generations count towards the cost quota; GPU-seconds are only known afterwards
+                retry_after = max(1, int((oldest or now) + window - now))
+                if quota.get("cost") is not None and used_cost + cost > float(quota["cost"]):
+                    raise QuotaExceeded(tenant, "cost", used_cost, quota["cost"], retry_after)
+                if quota.get("gpu_seconds") is not None and used_gpu_seconds >= float(quota["gpu_seconds"]):
+                    raise QuotaExceeded(tenant, "gpu_seconds", used_gpu_seconds, quota["gpu_seconds"], retry_after)
+            conn.execute(
+                "INSERT INTO usage (id, tenant, kind, model, width, height, steps, cost, status, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry_id, tenant, kind, model, width, height, steps, cost, PENDING, now)
+            )
+        return entry_id
+
+    def attach_job(self, entry_id, job_id):
+        with self._connection() as conn:
+            conn.execute("UPDATE usage SET job_id = ? WHERE id = ?", (job_id, entry_id))
+
+    def finish(self, entry_id, status, gpu_seconds=0.0):
+        """Record how a generation ended. One that never reached sd.cpp is not charged"""
+        with self._connection() as conn:
+            if gpu_seconds:
+                conn.execute("UPDATE usage SET status = ?, gpu_seconds = ?, finished_at = ? WHERE id = ?",
+                             (status, gpu_seconds, time.time(), entry_id))
+            else:
+                conn.execute("UPDATE usage SET status = ?, cost = 0, finished_at = ? WHERE id = ?",
+                             (status, time.time(), entry_id))
+
+    def pending_jobs(self, tenant=None):
+        """(entry ID, job ID) of jobs whose outcome has not been recorded yet"""
+        with self._connection() as conn:
+            query = "SELECT id, job_id FROM usage WHERE status = ? AND kind = 'job' AND job_id IS NOT NULL"
+            params = [PENDING]
+            if tenant is not None:
+                query += " AND tenant = ?"
+                params.append(tenant)
+            return conn.execute(query, params).fetchall()
+
+    def used(self, tenant, window=86400):
+        """Cost and GPU-seconds the tenant used in the last window seconds"""
+        with self._connection() as conn:
+            cost, gpu_seconds, _ = self._used(conn, tenant, time.time() - window)
+        return {"cost": round(cost, 4), "gpu_seconds": round(gpu_seconds, 3)}
+
+    def summary(self, since=None, until=None, tenant=None):
+        """Totals per tenant and model between since and until (Unix times)"""
+        query = ("SELECT tenant, model, COUNT(*), SUM(status = 'succeeded'), SUM(cost), SUM(gpu_seconds) "
+                 "FROM usage WHERE created_at >= ? AND created_at < ?")
+        params = [since or 0, until or time.time() + 1]
+        if tenant is not None:
+            query += " AND tenant = ?"
+            params.append(tenant)
+        query += " GROUP BY tenant, model ORDER BY tenant, model"
+        with self._connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return [{"tenant": row[0], "model": row[1], "requests": row[2], "succeeded": row[3],
+                 "cost": round(row[4], 4), "gpu_seconds": round(row[5], 3)} for row in rows]
+
+def _parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show per-tenant usage from the DiffuGen usage ledger")
+    parser.add_argument("--ledger", type=str, default=os.environ.get("DIFFUGEN_USAGE_LEDGER"),
+                        help="Usage ledger database (default: DIFFUGEN_USAGE_LEDGER or usage.db in DiffuGen's data_dir)")
+    parser.add_argument("--since", type=str, default=None, help="Start time (ISO date or Unix time)")
+    parser.add_argument("--until", type=str, default=None, help="End time (ISO date or Unix time)")
+    parser.add_argument("--tenant", type=str, default=None, help="Only this tenant")
+    args = parser.parse_args(argv)
+
+    if not args.ledger:
+        from diffugen import config
+        args.ledger = os.path.join(config["data_dir"], "usage.db")
+    if not os.path.exists(args.ledger):
+        print(f"Usage ledger not found at {args.ledger}", file=sys.stderr)
+        return 1
+    ledger = UsageLedger(args.ledger)
+    rows = ledger.summary(_parse_time(args.since) if args.since else None,
+                          _parse_time(args.until) if args.until else None, args.tenant)
+    print(json.dumps(rows, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
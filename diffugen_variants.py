@@ -0,0 +1,214 @@
+"""Quantized model variants, converted once with sd.cpp and cached.
+
+A variant is a model's weights converted to a GGUF quantization (q8_0, q5_0,
+q4_0, ...) with sd.cpp's convert mode. Smaller weights load faster and need less
+memory, at some cost in quality. Conversions are cached under the identity of
+their source file (path, size and modification time): an unchanged model is
+converted only once, and replacing it triggers a fresh conversion.
+
+Requests pick a quantization type or a quality tier:
+
+    quality   the model as installed
+    balanced  q8_0
+    fast      q5_0
+    fastest   q4_0
+
+Variants are converted on first use, before the generation waits for a GPU slot,
+or ahead of time:
+
+    python diffugen_variants.py --models sdxl,sd15 --types q8_0,q4_0
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+QUANT_TYPES = ("f16", "q8_0", "q5_1", "q5_0", "q4_1", "q4_0")
+QUALITY_TIERS = {"quality": None, "balanced": "q8_0", "fast": "q5_0", "fastest": "q4_0"}
+ALL_MODELS = ["flux-schnell", "flux-dev", "sdxl", "sd3", "sd15"]
+
+class VariantError(Exception):
+    """A model variant could not be converted or is not available"""
+
+class ConversionCancelled(VariantError):
+    """A conversion, or the wait for another one to finish, was cancelled"""
+
+def resolve_variant(variant):
+    """Quantization type of a requested variant or quality tier; None means the
+    weights as installed. Raises ValueError for unknown names"""
+    if not variant:
+        return None
+    variant = variant.lower()
+    if variant in QUALITY_TIERS:
+        return QUALITY_TIERS[variant]
+    if variant in QUANT_TYPES:
+        return variant
+    raise ValueError(f"Invalid variant: {variant}. Use a quality tier ({', '.join(QUALITY_TIERS)}) "
+                     f"or a quantization type ({', '.join(QUANT_TYPES)})")
+
+def source_identity(path):
+    """Short key identifying a model file's current contents by path, size and modification time"""
+    stat = os.stat(path)
+    key = f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+class VariantCache:
+    """Converted model variants in a cache directory, named <model>.<source identity>.<type>.gguf"""
+
+    def __init__(self, cache_dir, sd_binary, convert_timeout=3600, poll_interval=0.5):
+        self.cache_dir = cache_dir
+        self.sd_binary = sd_binary
+        self.convert_timeout = convert_timeout
+        self.poll_interval = poll_interval
+
+    def path_for(self, source, quant):
+        stem = os.path.splitext(os.path.basename(source))[0]
+        return os.path.join(self.cache_dir, f"{stem}.{source_identity(source)}.{quant}.gguf")
+
+    def get(self, source, quant, convert=True, cancel_token=None):
+        """Path of source converted to quant, converting it first unless it is cached.
+        Raises VariantError if it is not cached and convert is False, or conversion fails,
+        and ConversionCancelled when cancel_token (a diffugen_jobs.CancelToken) fires first"""
+        if not os.path.exists(source):
+            raise VariantError(f"Model not found at {source}")
+        # Installed weights that already have this quantization are used as they are
+        if os.path.basename(source).lower().endswith(f"{quant}.gguf"):
+            return source
+        target = self.path_for(source, quant)
+        if os.path.exists(target):
+            return target
+        if not convert:
+            raise VariantError(f"The {quant} variant of {os.path.basename(source)} has not been converted yet")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._conversion_lock(cancel_token):
+            # Another process may have converted it while we waited
+            if not os.path.exists(target):
+                self._convert(source, target, quant, cancel_token)
+                self._remove_stale(source, target)
+        return target
+
+    @staticmethod
+    def _check_cancelled(cancel_token, source, quant):
+        if cancel_token is not None and cancel_token.cancelled:
+            raise ConversionCancelled(f"Converting {os.path.basename(source)} to {quant} was cancelled")
+
+    @contextmanager
+    def _conversion_lock(self, cancel_token=None):
+        """One conversion at a time across processes; each needs the whole model in memory.
+        The wait for the lock polls, so a cancelled request stops waiting"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.cache_dir, ".convert.lock"), "w") as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if cancel_token is not None and cancel_token.cancelled:
+                        raise ConversionCancelled("Cancelled while waiting for another model conversion")
+                    time.sleep(self.poll_interval)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _convert(self, source, target, quant, cancel_token=None):
+        partial = target + ".partial"
+        command = [self.sd_binary, "-M", "convert", "-m", source, "-o", partial, "--type", quant]
+        logging.info(f"Converting {os.path.basename(source)} to {quant}: {' '.join(command)}")
+        try:
+            # A session of its own, so a cancel or timeout stops sd.cpp and anything it started
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                                       start_new_session=True)
+        except OSError as e:
+            raise VariantError(f"Converting {os.path.basename(source)} to {quant} failed: {e}")
+        try:
+            deadline = time.time() + self.convert_timeout
+            while True:
+                try:
+                    _, stderr = process.communicate(timeout=self.poll_interval)
+                    break
+                except subprocess.TimeoutExpired:
+                    self._check_cancelled(cancel_token, source, quant)
+                    if time.time() >= deadline:
+                        raise VariantError(f"Converting {os.path.basename(source)} to {quant} failed: "
+                                           f"timed out after {self.convert_timeout}s")
+            if process.returncode != 0:
+                raise VariantError(f"Converting {os.path.basename(source)} to {quant} failed with exit code "
+                                   f"{process.returncode}: {(stderr or '').strip()[-500:]}".strip())
+        except BaseException:
+            if process.poll() is None:
+                if hasattr(os, "killpg"):
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                else:
+                    process.kill()
+                process.wait()
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        # Publish atomically so readers never load a half-written file
+        os.replace(partial, target)
+        logging.info(f"Cached {quant} variant at {target}")
+
+    def _remove_stale(self, source, target):
+        """Remove conversions of earlier versions of source"""
+        stem = os.path.splitext(os.path.basename(source))[0]
+        identity = source_identity(source)
+        for name in os.listdir(self.cache_dir):
+            parts = name[len(stem) + 1:].split(".") if name.startswith(stem + ".") else []
+            if len(parts) == 3 and parts[2] == "gguf" and parts[0] != identity:
+                os.remove(os.path.join(self.cache_dir, name))
+                logging.info(f"Removed stale variant {name}")
+
+    def entries(self):
+        """Cached variant files with their sizes in MB"""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return [{"file": name, "size_mb": round(os.path.getsize(os.path.join(self.cache_dir, name)) / 1048576, 1)}
+                for name in sorted(os.listdir(self.cache_dir)) if name.endswith(".gguf")]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert DiffuGen models to quantized GGUF variants ahead of time")
+    parser.add_argument("--models", type=str, default=None,
+                        help="Comma-separated models to convert (default: every installed model)")
+    parser.add_argument("--types", type=str, default="q8_0,q4_0",
+                        help=f"Comma-separated quantization types or tiers ({', '.join(QUANT_TYPES)})")
+    parser.add_argument("--list", action="store_true", help="Only list the cached variants")
+    args = parser.parse_args(argv)
+
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import diffugen
+
+    if args.list:
+        print(json.dumps(diffugen.variant_cache.entries(), indent=2))
+        return 0
+    models = args.models.split(",") if args.models else \
+        [model for model in ALL_MODELS if os.path.exists(diffugen.get_model_path(model) or "")]
+    failed = False
+    for model in models:
+        for variant in args.types.split(","):
+            try:
+                path, quant = diffugen.get_variant_path(model, variant)
+                diffugen.log_to_stderr(f"{model} {quant or 'as installed'}: {path}")
+            except (ValueError, VariantError) as e:
+                diffugen.log_to_stderr(f"{model} {variant}: {e}")
+                failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""Cold-start warming: page-cache prefetch of model weights and warm-up runs.
+
+sd.cpp loads a model's weights from disk on every run. After a restart, or once
+another model has pushed them out of the OS page cache, that means reading
+several GB from disk. The warmer prefetches the weights of the configured hot
+models into the page cache (posix_fadvise WILLNEED, then a sequential read)
+within a memory budget, optionally runs a tiny generation per model, and
+refreshes the cache whenever the GPU has been idle for a while:
+
+    "warmup": {
+        "models": ["flux-schnell", "sdxl"],
+        "memory_budget_mb": 16384,
+        "warmup_generation": true,
+        "refresh_seconds": 600
+    }
+
+Its status tells the server when it is warm enough to report ready.
+"""
+import logging
+import os
+import threading
+import time
+
+DEFAULT_WARMUP = {
+    "models": [],  # Hot models, most important first
+    "memory_budget_mb": None,  # Page cache to use; defaults to half of the available memory
+    "warmup_generation": False,  # Run a tiny generation per model after prefetching
+    "refresh_seconds": 600,  # Re-prefetch after this long without a generation (0 disables)
+}
+CHUNK_BYTES = 16 * 1024 * 1024
+
+DISABLED = "disabled"
+PENDING = "pending"
+WARMING = "warming"
+WARM = "warm"
+
+def available_memory_mb():
+    """MemAvailable from /proc/meminfo in MB, or None where it is not available"""
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def prefetch_file(path):
+    """Pull a file into the OS page cache. Returns the number of bytes read"""
+    total = 0
+    buffer = bytearray(CHUNK_BYTES)
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            # Start kernel readahead of the whole file, then read it to make sure it is resident
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            total += count
+    return total
+
+class Warmer:
+    """Keeps the hot models' weights in the page cache.
+
+    model_files(model) lists the weight files sd.cpp loads for a model, its own
+    weights first; warmup_run(model) runs a tiny generation and is_idle() tells
+    whether no generation is running."""
+
+    def __init__(self, warmup_config, model_files, warmup_run=None, is_idle=None):
+        self.settings = dict(DEFAULT_WARMUP, **(warmup_config or {}))
+        self.model_files = model_files
+        self.warmup_run = warmup_run
+        self.is_idle = is_idle or (lambda: True)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._status = {"state": DISABLED if not self.settings["models"] else PENDING, "models": {},
+                        "started_at": None, "finished_at": None}
+
+    @property
+    def enabled(self):
+        return bool(self.settings["models"])
+
+    def start(self):
+        """Warm up in a background thread (once), then keep refreshing while idle"""
+        with self._lock:
+            if not self.enabled or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="diffugen-warmer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self):
+        with self._lock:
+            return {**self._status, "ready": self._status["state"] in (WARM, DISABLED),
+                    "models": {model: dict(entry) for model, entry in self._status["models"].items()}}
+
+    def _set(self, **values):
+        with self._lock:
+            self._status.update(values)
+
+    def _set_model(self, model, **values):
+        with self._lock:
+            self._status["models"].setdefault(model, {}).update(values)
+
+    def _run(self):
+        self._set(state=WARMING, started_at=time.time())
+        try:
+            self.warm(generate=bool(self.settings["warmup_generation"] and self.warmup_run))
+        except Exception as e:
+            logging.warning(f"Warm-up failed: {e}")
+        # Failures leave the models cold but must not keep the server unready
+        self._set(state=WARM, finished_at=time.time())
+        refresh = float(self.settings["refresh_seconds"] or 0)
+        idle_since = time.time()
+        while refresh > 0 and not self._stop.wait(min(refresh, 30)):
+            if not self.is_idle():
+                idle_since = time.time()
+            elif time.time() - idle_since >= refresh:
+                try:
+                    self.warm(generate=False)
+                except Exception as e:
+                    logging.warning(f"Page cache refresh failed: {e}")
+                idle_since = time.time()
+
+    def _budget_bytes(self):
+        budget_mb = self.settings["memory_budget_mb"]
+        if budget_mb is None:
+            budget_mb = (available_memory_mb() or 8192) / 2
+        return float(budget_mb) * 1048576
+
+    def warm(self, generate=False):
+        """Prefetch the hot models' files in order until the budget is used up, then
+        optionally run a warm-up generation for each model that was prefetched"""
+        budget = self._budget_bytes()
+        seen = set()
+        warmed = []
+        for model in self.settings["models"]:
+            paths = self.model_files(model)
+            installed = bool(paths) and bool(paths[0]) and os.path.exists(paths[0])
+            new_files = [path for path in paths if path and os.path.exists(path) and os.path.realpath(path) not in seen]
+            size = sum(os.path.getsize(path) for path in new_files)
+            if not installed or size > budget:
+                reason = "model not installed" if not installed else "over the memory budget"
+                logging.info(f"Not prefetching {model}: {reason}")
+                self._set_model(model, prefetched=False, reason=reason)
+                continue
+            start = time.time()
+            read = sum(prefetch_file(path) for path in new_files)
+            budget -= size
+            seen.update(os.path.realpath(path) for path in new_files)
+            warmed.append(model)
+            self._set_model(model, prefetched=True, prefetched_mb=round(read / 1048576, 1),
+                            prefetch_seconds=round(time.time() - start, 3), prefetched_at=time.time())
+            logging.info(f"Prefetched {model} ({read / 1048576:.0f} MB) in {time.time() - start:.1f}s")
+        if generate:
+            for model in warmed:
+                if self._stop.is_set():
+                    break
+                start = time.time()
+                result = self.warmup_run(model)
+                self._set_model(model, warmup_success=bool(result.get("success")),
+                                warmup_seconds=round(time.time() - start, 3))
+                if not result.get("success"):
+                    logging.warning(f"Warm-up generation for {model} failed: {result.get('error')}")
+        return warmed
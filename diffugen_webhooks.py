@@ -0,0 +1,336 @@
+"""Completion webhooks: POST a signed payload when a job finishes.
+
+A job submitted with a callback_url gets a POST when it succeeds, fails or is
+cancelled, from whichever node finished it. Deliveries wait in a background
+queue and are retried with exponential backoff while the receiver is
+unreachable or answers 408, 429 or 5xx. The job records whether its webhook is
+pending, delivered or failed; one still pending when its process exits is sent
+again after a restart, so receivers may see a delivery more than once:
+
+    "webhooks": {
+        "secret": "shared-signing-secret",
+        "public_url": "https://diffugen.example.com",
+        "max_attempts": 6,
+        "allowed_hosts": ["hooks.example.com"]
+    }
+
+Every delivery carries these headers:
+
+    X-DiffuGen-Event      job.succeeded, job.failed or job.cancelled
+    X-DiffuGen-Delivery   delivery ID (the job ID), the same on every retry and redelivery
+    X-DiffuGen-Timestamp  Unix time the attempt was signed
+    X-DiffuGen-Signature  sha256=HMAC-SHA256(secret, "<timestamp>.<body>") in hex
+
+Receivers recompute the signature over the raw body and reject old timestamps
+(see verify_signature). Callbacks never go to loopback, link-local or private
+addresses, checked when the job is submitted and again on every connection,
+unless the host is listed in allowed_hosts or allow_private is set. Redirects
+are not followed. To try it out, run a local receiver that prints every
+delivery and checks its signature:
+
+    python diffugen_webhooks.py --port 8765 --secret shared-signing-secret
+"""
+import argparse
+import functools
+import hashlib
+import heapq
+import hmac
+import http.client
+import ipaddress
+import itertools
+import json
+import logging
+import random
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+DEFAULT_WEBHOOKS = {
+    "secret": None,  # Signing secret; callback URLs are refused without one
+    "public_url": None,  # Base URL of the API, to link status and images in payloads
+    "max_attempts": 6,  # Attempts per delivery, the first included
+    "backoff_seconds": 2,  # Wait before the first retry, doubled on every retry
+    "max_backoff_seconds": 300,  # Longest wait between retries
+    "timeout": 10,  # Seconds to wait for the receiver to answer
+    "allowed_hosts": [],  # Hosts callbacks may go to (empty allows any public host); these may be private
+    "allow_private": False,  # Allow callbacks to loopback, link-local and private addresses
+}
+RETRY_STATUSES = (408, 429)
+# Result fields that are bulky or only mean something on the worker
+OMITTED_RESULT_KEYS = ("output", "cells", "command", "markdown_response")
+
+class CallbackRefused(OSError):
+    """A callback connection went to an address callbacks may not reach"""
+
+def is_private_address(address):
+    """Whether an IP address is loopback, link-local, private or otherwise not a public address"""
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved or ip.is_multicast \
+        or ip.is_unspecified
+
+def _private_allowed(hostname, settings):
+    """Hosts listed in allowed_hosts, or every host with allow_private, may be private addresses"""
+    return bool(settings.get("allow_private")) or \
+        hostname.lower() in [host.lower() for host in settings.get("allowed_hosts") or []]
+
+def validate_callback_url(url, settings):
+    """Check that url is a callback DiffuGen may deliver to. Raises ValueError"""
+    if not settings.get("secret"):
+        raise ValueError("Completion webhooks are not enabled: set a webhooks secret (DIFFUGEN_WEBHOOK_SECRET)")
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError(f"Invalid callback URL: {url}. Use an http:// or https:// URL")
+    allowed = settings.get("allowed_hosts") or []
+    if allowed and parsed.hostname.lower() not in [host.lower() for host in allowed]:
+        raise ValueError(f"Callback host {parsed.hostname} is not allowed")
+    if not _private_allowed(parsed.hostname, settings):
+        try:
+            addresses = {info[4][0] for info in socket.getaddrinfo(parsed.hostname, parsed.port or 80,
+                                                                   proto=socket.IPPROTO_TCP)}
+        except (socket.gaierror, UnicodeError) as e:
+            raise ValueError(f"Could not resolve callback host {parsed.hostname}: {e}")
+        private = sorted(address for address in addresses if is_private_address(address))
+        if private:
+            raise ValueError(f"Callback host {parsed.hostname} resolves to a private address ({private[0]}); "
+                             "list it in webhooks.allowed_hosts or set webhooks.allow_private to allow it")
+    return url
+
+def _check_peer(connection, allow_private):
+    """Refuse a connection whose peer is a private address: DNS may have changed since the URL was checked"""
+    address = connection.sock.getpeername()[0]
+    if not allow_private and is_private_address(address):
+        connection.close()
+        raise CallbackRefused(f"Callback host {connection.host} resolves to a private address ({address})")
+
+class _CheckedHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, allow_private=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.allow_private = allow_private
+
+    def connect(self):
+        super().connect()
+        _check_peer(self, self.allow_private)
+
+class _CheckedHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, allow_private=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.allow_private = allow_private
+
+    def connect(self):
+        super().connect()
+        _check_peer(self, self.allow_private)
+
+class _CheckedHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, allow_private):
+        super().__init__()
+        self.allow_private = allow_private
+
+    def http_open(self, req):
+        return self.do_open(functools.partial(_CheckedHTTPConnection, allow_private=self.allow_private), req)
+
+class _CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, allow_private):
+        super().__init__()
+        self.allow_private = allow_private
+
+    def https_open(self, req):
+        return self.do_open(functools.partial(_CheckedHTTPSConnection, allow_private=self.allow_private), req,
+                            context=self._context)
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Report redirects as errors: a redirect could point a callback anywhere"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+def sign(secret, timestamp, body):
+    """Hex HMAC-SHA256 of "<timestamp>.<body>" under secret"""
+    return hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+
+def verify_signature(secret, timestamp, body, signature, tolerance=300):
+    """Check a delivery's X-DiffuGen-Signature, rejecting timestamps more than tolerance seconds off"""
+    try:
+        if abs(time.time() - int(timestamp)) > tolerance:
+            return False
+    except (TypeError, ValueError):
+        return False
+    expected = "sha256=" + sign(secret, timestamp, body)
+    return hmac.compare_digest(expected, signature or "")
+
+def job_payload(job, public_url=None):
+    """Webhook body for a finished job: its status, parameters, timings and result"""
+    result = {key: value for key, value in (job.get("result") or {}).items() if key not in OMITTED_RESULT_KEYS}
+    payload = {
+        "event": f"job.{job['status']}",
+        "job_id": job["id"],
+        "status": job["status"],
+        "tool": job["tool"],
+        "tenant": job.get("tenant"),
+        "priority": job.get("priority"),
+        "parameters": job["params"],
+        "submitted_at": job["submitted_at"],
+        "started_at": job.get("started_at"),
+        "finished_at": job.get("finished_at"),
+        "worker": job.get("worker"),
+        "error": job.get("error"),
+        "result": result or None,
+    }
+    if public_url:
+        base_url = public_url.rstrip("/")
+        payload["status_url"] = f"{base_url}/jobs/{job['id']}"
+        if job["status"] == "succeeded" and (job["tool"] != "sweep" or result.get("image_path")):
+            payload["image_url"] = f"{base_url}/jobs/{job['id']}/image"
+    return payload
+
+class WebhookDispatcher:
+    """Delivers webhooks from a background thread, retrying failed attempts with backoff"""
+
+    def __init__(self, webhooks_config=None):
+        self.settings = dict(DEFAULT_WEBHOOKS, **(webhooks_config or {}))
+        self._queue = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stop = threading.Event()
+        self._stats = {"delivered": 0, "retried": 0, "failed": 0}
+
+    def deliver(self, url, payload, delivery_id=None, on_done=None):
+        """Queue a payload for delivery to url. Returns the delivery ID.
+        
+        on_done(delivered) is called once the delivery succeeds (True) or is given up (False)"""
+        delivery = {"id": delivery_id or uuid.uuid4().hex, "url": url, "event": payload.get("event", "job.finished"),
+                    "body": json.dumps(payload).encode(), "attempt": 0, "on_done": on_done}
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="diffugen-webhooks", daemon=True)
+                self._thread.start()
+            heapq.heappush(self._queue, (time.time(), next(self._order), delivery))
+            self._condition.notify()
+        return delivery["id"]
+
+    def pending(self):
+        with self._condition:
+            return len(self._queue)
+
+    def stats(self):
+        with self._condition:
+            return {**self._stats, "pending": len(self._queue)}
+
+    def stop(self):
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._condition:
+                while not self._stop.is_set() and (not self._queue or self._queue[0][0] > time.time()):
+                    self._condition.wait(self._queue[0][0] - time.time() if self._queue else None)
+                if self._stop.is_set():
+                    return
+                _, _, delivery = heapq.heappop(self._queue)
+            self._attempt(delivery)
+
+    def _attempt(self, delivery):
+        delivery["attempt"] += 1
+        retry, detail = self._post(delivery)
+        if detail is not None and retry and delivery["attempt"] < int(self.settings["max_attempts"]):
+            # Jitter keeps many failed deliveries from retrying in lockstep
+            delay = min(float(self.settings["backoff_seconds"]) * 2 ** (delivery["attempt"] - 1),
+                        float(self.settings["max_backoff_seconds"])) * random.uniform(0.8, 1.2)
+            with self._condition:
+                self._stats["retried"] += 1
+                heapq.heappush(self._queue, (time.time() + delay, next(self._order), delivery))
+                self._condition.notify()
+            logging.info(f"Webhook {delivery['id']} to {delivery['url']} failed ({detail}); "
+                         f"retrying in {delay:.0f}s")
+            return
+        with self._condition:
+            self._stats["delivered" if detail is None else "failed"] += 1
+        if detail is None:
+            logging.info(f"Delivered {delivery['event']} webhook {delivery['id']} to {delivery['url']}")
+        else:
+            logging.warning(f"Giving up on webhook {delivery['id']} to {delivery['url']} after "
+                            f"{delivery['attempt']} attempts: {detail}")
+        if delivery["on_done"] is not None:
+            try:
+                delivery["on_done"](detail is None)
+            except Exception as e:
+                logging.warning(f"Could not record the outcome of webhook {delivery['id']}: {e}")
+
+    def _post(self, delivery):
+        """One delivery attempt. Returns (retry, error detail or None on success)"""
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            "User-Agent": "DiffuGen-Webhooks/1.0",
+            "X-DiffuGen-Event": delivery["event"],
+            "X-DiffuGen-Delivery": delivery["id"],
+            "X-DiffuGen-Timestamp": timestamp,
+            "X-DiffuGen-Signature": "sha256=" + sign(self.settings["secret"] or "", timestamp, delivery["body"]),
+        }
+        request = urllib.request.Request(delivery["url"], data=delivery["body"], headers=headers, method="POST")
+        allow_private = _private_allowed(urlparse(delivery["url"]).hostname or "", self.settings)
+        opener = urllib.request.build_opener(_NoRedirect, _CheckedHTTPHandler(allow_private),
+                                             _CheckedHTTPSHandler(allow_private))
+        try:
+            with opener.open(request, timeout=float(self.settings["timeout"])) as response:
+                response.read()
+            return False, None
+        except urllib.error.HTTPError as e:
+            if 300 <= e.code < 400:
+                return False, f"HTTP {e.code} redirect (redirects are not followed)"
+            return e.code in RETRY_STATUSES or e.code >= 500, f"HTTP {e.code}"
+        except (urllib.error.URLError, OSError) as e:
+            reason = getattr(e, "reason", e)
+            return not isinstance(reason, CallbackRefused), str(reason)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local receiver that prints DiffuGen webhook deliveries")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--secret", default=None, help="Signing secret to verify deliveries with")
+    parser.add_argument("--fail", type=int, default=0, help="Answer 503 to this many deliveries first, to test retries")
+    args = parser.parse_args(argv)
+    failures = {"left": args.fail}
+
+    class Receiver(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if failures["left"] > 0:
+                failures["left"] -= 1
+                self.send_response(503)
+                self.end_headers()
+                print(f"{self.headers.get('X-DiffuGen-Delivery')}: answered 503", flush=True)
+                return
+            verified = None
+            if args.secret:
+                verified = verify_signature(args.secret, self.headers.get("X-DiffuGen-Timestamp"), body,
+                                            self.headers.get("X-DiffuGen-Signature"))
+            self.send_response(401 if verified is False else 204)
+            self.end_headers()
+            print(json.dumps({"event": self.headers.get("X-DiffuGen-Event"),
+                              "delivery": self.headers.get("X-DiffuGen-Delivery"), "signature_valid": verified,
+                              "payload": json.loads(body or b"null")}), flush=True)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((args.host, args.port), Receiver)
+    print(f"Receiving webhooks at http://{args.host}:{args.port}/", file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
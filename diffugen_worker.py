@@ -0,0 +1,45 @@
+"""Standalone DiffuGen job worker for GPU nodes.
+
+Pulls generation jobs from a shared broker, runs them with the local
+stable-diffusion.cpp install and publishes the results and images back to the
+broker, where every API node can serve them.
+
+Usage:
+    python diffugen_worker.py --broker redis://broker-host:6379/0 [--concurrency 1]
+"""
+import argparse
+import os
+import signal
+import sys
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run DiffuGen generation jobs from a shared broker")
+    parser.add_argument("--broker", type=str, default=None,
+                        help="Broker URL (sqlite:///path/jobs.db or redis://host:6379/0); defaults to DIFFUGEN_BROKER or diffugen.json")
+    parser.add_argument("--concurrency", type=int, default=1, help="Jobs to run at once on this node")
+    args = parser.parse_args(argv)
+
+    # diffugen reads its configuration at import time, and this process is the worker itself
+    if args.broker:
+        os.environ["DIFFUGEN_BROKER"] = args.broker
+    os.environ["DIFFUGEN_LOCAL_WORKERS"] = "0"
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import diffugen
+
+    if diffugen.config["broker"].startswith("memory"):
+        diffugen.log_to_stderr("A worker needs a shared broker; pass --broker sqlite:///... or redis://...")
+        return 1
+
+    manager = diffugen.get_job_manager()
+    manager.local_workers = args.concurrency
+    signal.signal(signal.SIGTERM, lambda *_: manager.stop())
+    diffugen.log_to_stderr(f"Worker {manager.worker_name} pulling jobs from {diffugen.config['broker']}")
+    manager.start()
+    try:
+        manager.wait()
+    except KeyboardInterrupt:
+        manager.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""Shared test setup: DiffuGen runs against the stub sd binary from benchmarks/stub_sd.py.
+
+The environment is set before diffugen builds its configuration, so every test
+process generates into a temporary directory with the in-memory job broker.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.stub_sd import install_stub
+
+WORKDIR = tempfile.mkdtemp(prefix="diffugen-tests-")
+SD_CPP_PATH = os.path.join(WORKDIR, "stable-diffusion.cpp")
+install_stub(SD_CPP_PATH)
+
+os.environ.update({
+    "SD_CPP_PATH": SD_CPP_PATH,
+    "DIFFUGEN_OUTPUT_DIR": os.path.join(WORKDIR, "outputs"),
+    "DIFFUGEN_LOCK_DIR": os.path.join(WORKDIR, "locks"),
+    "DIFFUGEN_LOG_FILE": os.path.join(WORKDIR, "diffugen_debug.log"),
+    "DIFFUGEN_USAGE_LEDGER": os.path.join(WORKDIR, "usage.db"),
+    "DIFFUGEN_BROKER": "memory",
+    "DIFFUGEN_LOCAL_WORKERS": "1",
+    "DIFFUGEN_RATE_LIMIT": "1000000/minute",
+    "DIFFUGEN_STUB_DELAY": "0.05",
+})
+# The OpenAPI server keeps its rate limit cache in the working directory
+os.chdir(WORKDIR)
+
+@pytest.fixture(scope="session")
+def sd_binary():
+    return os.path.join(SD_CPP_PATH, "build", "bin", "sd")
+
+@pytest.fixture(scope="session")
+def diffugen():
+    import diffugen
+    return diffugen
+
+@pytest.fixture(scope="session")
+def openapi(diffugen):
+    import diffugen_openapi
+    return diffugen_openapi
+
+@pytest.fixture
+def client(openapi):
+    from fastapi.testclient import TestClient
+    with TestClient(openapi.app) as client:
+        yield client
+
+@pytest.fixture
+def saturated(diffugen):
+    """Fill this process's generation queue with predicted work, so new requests are shed"""
+    tracker = diffugen.load_tracker
+    entries = [tracker.enter(120) for _ in range(tracker.slots)]
+    for entry in entries:
+        tracker.start(entry)
+    entries += [tracker.enter(120) for _ in range(tracker.capacity())]
+    yield tracker
+    for entry in entries:
+        tracker.leave(entry)
@@ -0,0 +1,32 @@
+import json
+
+import diffugen_autotune as autotune
+
+def test_candidate_settings_swap_one_option():
+    base = {"flags": ["--vae-tiling", "--offload-to-cpu"], "threads": 4}
+    candidate = autotune._candidate_settings(base, memory_mode="clip-on-cpu")
+    assert candidate["flags"] == ["--offload-to-cpu", "--clip-on-cpu"]
+    assert autotune._candidate_settings(base, offload=False)["flags"] == ["--vae-tiling"]
+    assert autotune._candidate_settings(base, threads=8)["threads"] == 8
+    # The base settings are not changed
+    assert base["flags"] == ["--vae-tiling", "--offload-to-cpu"]
+
+def test_calibrate_times_the_stub(tmp_path):
+    result = autotune.calibrate("sd15", {}, 2, 64, str(tmp_path), timeout=60)
+    assert result["success"], result
+    assert result["latency"] > 0
+    assert not list(tmp_path.iterdir())
+
+def test_tune_model_keeps_the_base_without_a_clear_gain(tmp_path):
+    # The stub takes the same time for every setting, so nothing beats the first candidate by 90%
+    settings, result, runs = autotune.tune_model("sd15", [2], 2, 64, str(tmp_path), timeout=60, min_gain=0.9)
+    assert result["success"]
+    assert len(runs) == len(autotune.MEMORY_MODES) + 1 + 2 + 2
+    assert settings == runs[0]["settings"]
+
+def test_write_model_settings_merges(tmp_path):
+    config_path = tmp_path / "diffugen.json"
+    config_path.write_text(json.dumps({"mcpServers": {"diffugen": {"model_settings": {"sdxl": {"threads": 2}}}}}))
+    autotune.write_model_settings(str(config_path), {"sd15": {"threads": 8}})
+    model_settings = json.loads(config_path.read_text())["mcpServers"]["diffugen"]["model_settings"]
+    assert model_settings == {"sdxl": {"threads": 2}, "sd15": {"threads": 8}}
@@ -0,0 +1,56 @@
+import json
+
+import diffugen_bulk as bulk
+
+def _write_manifest(path, entries):
+    path.write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+
+def test_manifest_entries_are_validated(tmp_path):
+    manifest = tmp_path / "prompts.jsonl"
+    manifest.write_text('{"id": "a", "prompt": "a fox", "steps": "3"}\n'
+                        '# a comment\n'
+                        '{"prompt": "a fox", "colour": "red"}\n'
+                        'not json\n'
+                        '{"prompt": "a fox"}\n'
+                        '{"prompt": "a fox"}\n')
+    entries = bulk.read_manifest(str(manifest))
+    assert entries[0] == (1, "a", {"prompt": "a fox", "steps": 3}, None)
+    assert entries[1][3] == "Unknown fields: colour"
+    assert entries[2][1] == "line-4" and entries[2][3].startswith("Invalid JSON")
+    # Identical entries without an id are told apart by their position
+    assert entries[4][1] == entries[3][1] + "-2"
+
+def test_csv_manifest(tmp_path):
+    manifest = tmp_path / "prompts.csv"
+    manifest.write_text("id,prompt,steps,fast_decode\nfox,a fox,4,true\n")
+    assert bulk.read_manifest(str(manifest)) == [(2, "fox", {"prompt": "a fox", "steps": 4, "fast_decode": True}, None)]
+
+def test_resume_skips_succeeded_entries(diffugen, tmp_path):
+    manifest = tmp_path / "prompts.jsonl"
+    results = tmp_path / "results.jsonl"
+    params = {"model": "sd15", "steps": 1, "width": 64, "height": 64}
+    _write_manifest(manifest, [dict(params, id=name, prompt=f"a {name}") for name in ("fox", "owl", "cat")])
+    # A previous run: fox succeeded, owl failed, and the crash cut cat's record short
+    results.write_text(json.dumps({"id": "fox", "status": "succeeded"}) + "\n"
+                       + json.dumps({"id": "owl", "status": "failed"}) + "\n"
+                       + '{"id": "cat", "sta')
+    assert bulk.completed_keys(str(results)) == {"fox"}
+    assert bulk.main([str(manifest), "--results", str(results), "--output-dir", str(tmp_path / "images"),
+                      "--concurrency", "2"]) == 0
+    new_records = [record for record in _records(results) if record.get("line")]
+    assert sorted(record["id"] for record in new_records) == ["cat", "owl"]
+    assert all(record["status"] == "succeeded" for record in new_records)
+    assert bulk.completed_keys(str(results)) == {"fox", "owl", "cat"}
+    # Nothing is left to run
+    assert bulk.main([str(manifest), "--results", str(results)]) == 0
+    assert bulk.completed_keys(str(results)) == {"fox", "owl", "cat"}
+    assert len([record for record in _records(results) if record.get("line")]) == 2
+
+def _records(path):
+    records = []
+    for line in path.read_text().splitlines():
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
@@ -0,0 +1,96 @@
+import asyncio
+import glob
+import os
+import threading
+import time
+
+import pytest
+from starlette.requests import Request
+
+import diffugen_metrics as metrics
+from diffugen_jobs import CANCELLED, CancelToken
+
+PARAMS = {"prompt": "a fox", "model": "sd15", "steps": 2, "width": 64, "height": 64}
+
+@pytest.fixture
+def slow_stub(monkeypatch):
+    # Long enough that only a cancel ends the run within the test
+    monkeypatch.setenv("DIFFUGEN_STUB_DELAY", "60")
+
+def _running_process(diffugen, timeout=10):
+    """The sd.cpp process of the generation in progress, once it has been spawned"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if diffugen._active_processes:
+            return next(iter(diffugen._active_processes))
+        time.sleep(0.02)
+    raise AssertionError("sd.cpp was never started")
+
+def _pngs(directory):
+    return set(glob.glob(os.path.join(directory, "*.png")))
+
+def test_cancel_scope_stops_sd_and_frees_the_slot(diffugen, slow_stub, tmp_path):
+    token = CancelToken()
+    results = []
+
+    def generate():
+        with diffugen.cancel_scope(token, wait_for_slot=True):
+            results.append(diffugen.generate_stable_diffusion_image(output_dir=str(tmp_path), **PARAMS))
+
+    cancelled_before = metrics.CANCELLATIONS.value(reason="test_cancel")
+    thread = threading.Thread(target=generate)
+    thread.start()
+    process = _running_process(diffugen)
+    started = time.time()
+    token.cancel("test_cancel")
+    thread.join(10)
+    assert not thread.is_alive()
+    assert time.time() - started < 5
+    assert process.poll() is not None
+    [result] = results
+    assert result["error_type"] == "cancelled"
+    assert _pngs(str(tmp_path)) == set()
+    assert diffugen.generation_queue.holders() == []
+    assert diffugen.load_tracker.stats()["running"] == 0
+    assert metrics.CANCELLATIONS.value(reason="test_cancel") == cancelled_before + 1
+
+def test_cancelling_a_running_job(client, diffugen, slow_stub):
+    output_dir = diffugen.get_default_output_dir()
+    images_before = _pngs(output_dir)
+    cancelled_before = metrics.CANCELLATIONS.value(reason="job_cancel")
+    job_id = client.post("/jobs", json=PARAMS).json()["job_id"]
+    process = _running_process(diffugen)
+    assert client.get(f"/jobs/{job_id}").json()["status"] == "running"
+    assert client.delete(f"/jobs/{job_id}").status_code == 200
+    deadline = time.time() + 10
+    while client.get(f"/jobs/{job_id}").json()["status"] != CANCELLED:
+        assert time.time() < deadline, "the job was not cancelled"
+        time.sleep(0.05)
+    process.wait(5)
+    assert _pngs(output_dir) == images_before
+    assert diffugen.generation_queue.holders() == []
+    assert metrics.CANCELLATIONS.value(reason="job_cancel") == cancelled_before + 1
+
+def test_client_disconnect_cancels_the_generation(openapi, diffugen, slow_stub):
+    disconnected = threading.Event()
+
+    async def receive():
+        # The body was read already; the next message is the disconnect, once sd.cpp runs
+        await asyncio.get_running_loop().run_in_executor(None, disconnected.wait)
+        return {"type": "http.disconnect"}
+
+    req = Request({"type": "http", "method": "POST", "path": "/generate/stable", "headers": [],
+                   "query_string": b"", "client": ("127.0.0.1", 1234)}, receive)
+    cancelled_before = metrics.CANCELLATIONS.value(reason="client_disconnect")
+
+    async def generate():
+        task = asyncio.ensure_future(openapi.run_generation(req, diffugen.generate_stable_diffusion_image, **PARAMS))
+        process = await asyncio.get_running_loop().run_in_executor(None, _running_process, diffugen)
+        disconnected.set()
+        return await asyncio.wait_for(task, 10), process
+
+    result, process = asyncio.run(generate())
+    assert result["error_type"] == "cancelled"
+    assert process.poll() is not None
+    assert diffugen.generation_queue.holders() == []
+    assert metrics.CANCELLATIONS.value(reason="client_disconnect") == cancelled_before + 1
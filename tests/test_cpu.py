@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+from diffugen_cpu import CpuPlan, parse_cpu_list, plan_cpu
+
+def test_parse_cpu_list():
+    assert parse_cpu_list("0-3,8,10-11") == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpu_list([3, 1, 1]) == [1, 3]
+    assert parse_cpu_list("") is None
+
+def test_reserved_cores_are_left_to_the_server():
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else [0]
+    if len(available) < 2:
+        pytest.skip("needs at least two cores")
+    plan = plan_cpu({"reserved_cores": [available[0]]}, concurrent_workers=1)
+    assert available[0] not in plan.cores
+    assert plan.threads == len(available) - 1
+
+def test_threads_are_split_between_workers():
+    plan = plan_cpu({"affinity": "0-7"}, concurrent_workers=2)
+    assert plan.cores == list(range(8))
+    assert plan.threads == 4
+    assert plan_cpu({"affinity": "0-7", "threads": 3}, concurrent_workers=2).threads == 3
+
+def test_numactl_wraps_the_command():
+    command = ["sd", "-p", "x"]
+    assert CpuPlan().wrap_command(command) == command
+    wrapped = CpuPlan(numa_node=1, use_numactl=True).wrap_command(command)
+    assert wrapped[:3] == ["numactl", "--cpunodebind=1", "--membind=1"]
+    assert wrapped[3:] == command
+
+@pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="needs sched_setaffinity")
+def test_pinned_restores_the_affinity():
+    before = os.sched_getaffinity(0)
+    with CpuPlan(cores=[min(before)]).pinned():
+        assert os.sched_getaffinity(0) == {min(before)}
+    assert os.sched_getaffinity(0) == before
@@ -0,0 +1,25 @@
+from diffugen_eta import DEFAULT_PRIORS, LatencyModel, schedule_etas
+
+def test_first_observation_replaces_the_prior():
+    model = LatencyModel()
+    assert model.predict("sd15", 20, 512, 512) == DEFAULT_PRIORS["sd15"]["overhead_seconds"] + 0.3 * 20 * 0.262144
+    model.observe("sd15", 10, 1000, 1000, {"process_total": 12.0, "sampling": 10.0})
+    assert model.predict("sd15", 10, 1000, 1000) == 12.0
+    assert model.predict("sd15", 20, 1000, 1000) == 22.0
+
+def test_later_observations_are_averaged():
+    model = LatencyModel(alpha=0.5)
+    model.observe("sdxl", 10, 1000, 1000, {"process_total": 12.0, "sampling": 10.0})
+    model.observe("sdxl", 10, 1000, 1000, {"process_total": 22.0, "sampling": 20.0})
+    assert model.snapshot()["sdxl"] == {"seconds_per_step_mp": 1.5, "overhead_seconds": 2.0, "samples": 2}
+
+def test_queue_is_replayed_over_the_workers():
+    running = [{"id": "r", "started_at": 100.0}]
+    queued = [{"id": "a"}, {"id": "b"}, {"id": "c"}]
+    etas = schedule_etas(running, queued, workers=2, predict=lambda job: 10.0, now=105.0)
+    assert etas == {"r": (100.0, 110.0), "a": (105.0, 115.0), "b": (110.0, 120.0), "c": (115.0, 125.0)}
+
+def test_stable_jobs_are_predicted_as_sd15(diffugen):
+    assert diffugen.resolve_model(None, "stable") == "sd15"
+    assert diffugen.resolve_model(None, "flux") == "flux-schnell"
+    assert diffugen.resolve_model("SD15") == "sd15"
@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+from diffugen_fairqueue import FairPolicy, FairQueue
+from diffugen_jobs import FINISHED_STATES
+
+def _drain(queue):
+    order = []
+    while len(queue):
+        order.append(queue.pop()[0])
+    return order
+
+def test_a_backlog_does_not_starve_another_tenant():
+    queue = FairQueue()
+    for index in range(10):
+        queue.push(f"a{index}", ("alice", "batch"), 1.0, 1.0)
+    queue.push("b0", ("bob", "batch"), 1.0, 1.0)
+    assert _drain(queue).index("b0") <= 1
+
+def test_weights_share_the_queue():
+    queue = FairQueue()
+    for index in range(8):
+        queue.push(f"i{index}", ("alice", "interactive"), 1.0, 4.0)
+        queue.push(f"b{index}", ("alice", "batch"), 1.0, 1.0)
+    first = _drain(queue)[:5]
+    assert sorted(first) == ["b0", "i0", "i1", "i2", "i3"]
+
+def test_idle_flows_bank_no_credit():
+    queue = FairQueue()
+    for index in range(5):
+        queue.push(f"a{index}", ("alice", "batch"), 1.0, 1.0)
+    _drain(queue)
+    # Bob was idle while Alice ran; he starts at the current virtual time, not ahead of it
+    queue.push("a5", ("alice", "batch"), 1.0, 1.0)
+    queue.push("b0", ("bob", "batch"), 1.0, 1.0)
+    queue.push("b1", ("bob", "batch"), 1.0, 1.0)
+    assert _drain(queue) == ["a5", "b0", "b1"]
+
+def test_removed_items_are_skipped():
+    queue = FairQueue()
+    queue.push("a", ("alice", "batch"), 1.0, 1.0)
+    queue.push("b", ("bob", "batch"), 1.0, 1.0)
+    assert queue.remove("a")
+    assert not queue.remove("a")
+    assert queue.depths() == {("bob", "batch"): 1}
+    assert _drain(queue) == ["b"]
+
+def test_policy_weights():
+    policy = FairPolicy({"classes": {"interactive": 4, "batch": 1}})
+    assert policy.priority("unknown") == "interactive"
+    assert policy.weight("batch", tenant_weight=2) == 2.0
+    assert policy.weight(None) == 4.0
+
+@pytest.fixture
+def tenants(openapi, monkeypatch):
+    monkeypatch.setitem(openapi.config, "security", {"api_keys": [
+        {"key": "alice-key", "name": "alice"},
+        {"key": "bob-key", "name": "bob"},
+        {"key": "ops-key", "name": "ops", "admin": True},
+    ]})
+
+def test_jobs_are_scoped_to_their_tenant(client, tenants):
+    response = client.post("/jobs", json={"prompt": "a fox", "model": "sd15", "steps": 2, "width": 64, "height": 64},
+                           headers={"X-API-Key": "alice-key"})
+    assert response.status_code == 202, response.text
+    job_id = response.json()["job_id"]
+    assert client.get(f"/jobs/{job_id}", headers={"X-API-Key": "alice-key"}).status_code == 200
+    assert client.get(f"/jobs/{job_id}", headers={"X-API-Key": "bob-key"}).status_code == 404
+    assert client.delete(f"/jobs/{job_id}", headers={"X-API-Key": "bob-key"}).status_code == 404
+    assert client.get(f"/jobs/{job_id}", headers={"X-API-Key": "ops-key"}).status_code == 200
+    listed = client.get("/jobs", headers={"X-API-Key": "bob-key"}).json()
+    assert job_id not in [job["job_id"] for jobs in listed.values() for job in jobs]
+    # Let the job finish, so it does not hold the generation slot in later tests
+    deadline = time.time() + 30
+    while client.get(f"/jobs/{job_id}", headers={"X-API-Key": "alice-key"}).json()["status"] not in FINISHED_STATES:
+        assert time.time() < deadline, "the job did not finish"
+        time.sleep(0.05)
@@ -0,0 +1,46 @@
+import pytest
+
+PARAMS = {"prompt": "a lighthouse", "steps": 2, "width": 64, "height": 64}
+
+@pytest.fixture
+def taesd_files(diffugen, monkeypatch, tmp_path):
+    """Install every tiny autoencoder in a temporary directory. Returns {file name: path}"""
+    diffugen.get_supporting_file("taesd")
+    paths = {}
+    for name in set(diffugen.TAESD_FILES.values()):
+        path = tmp_path / f"{name}.safetensors"
+        path.write_bytes(b"taesd")
+        paths[name] = str(path)
+        monkeypatch.setitem(diffugen._supporting_files, name, str(path))
+    return paths
+
+def test_decoder_matches_the_latent_family(diffugen, taesd_files):
+    assert diffugen.get_fast_decoder("flux-schnell", True) == taesd_files["taef1"]
+    assert diffugen.get_fast_decoder("flux-dev", True) == taesd_files["taef1"]
+    assert diffugen.get_fast_decoder("sdxl", True) == taesd_files["taesdxl"]
+    assert diffugen.get_fast_decoder("sd3", True) == taesd_files["taesd3"]
+    assert diffugen.get_fast_decoder("sd15", True) == taesd_files["taesd"]
+    assert diffugen.get_fast_decoder("sd15", False) is None
+
+def test_missing_decoder_falls_back_to_the_vae(diffugen, monkeypatch, tmp_path):
+    diffugen.get_supporting_file("taesd")
+    monkeypatch.setitem(diffugen._supporting_files, "taesdxl", str(tmp_path / "missing.safetensors"))
+    assert diffugen.get_fast_decoder("sdxl", True) is None
+    result = diffugen.generate_stable_diffusion_image(model="sdxl", fast_decode=True, output_dir=str(tmp_path), **PARAMS)
+    assert result["success"], result
+    assert result["decoder"] == "vae"
+    assert "--taesd" not in result["command"]
+
+def test_fast_decode_passes_the_decoder_to_sd(diffugen, taesd_files, tmp_path):
+    result = diffugen.generate_stable_diffusion_image(model="sdxl", fast_decode=True, output_dir=str(tmp_path), **PARAMS)
+    assert result["success"], result
+    assert result["decoder"] == "taesd"
+    assert f"--taesd {taesd_files['taesdxl']}" in result["command"]
+    result = diffugen.generate_stable_diffusion_image(model="sdxl", output_dir=str(tmp_path), **PARAMS)
+    assert result["decoder"] == "vae"
+    assert "--taesd" not in result["command"]
+
+def test_decoder_is_reported_over_http(client, taesd_files):
+    response = client.post("/generate/stable", json=dict(PARAMS, model="sd15", fast_decode=True))
+    assert response.status_code == 200, response.text
+    assert response.json()["decoder"] == "taesd"
@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from diffugen import GenerationQueue, fcntl
+
+pytestmark = pytest.mark.skipif(fcntl is None, reason="slots are only shared between processes with fcntl")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Takes the slot, checks that a second queue in the same process cannot take it too, then holds it until stdin closes
+HOLDER = textwrap.dedent("""
+    import sys
+    import diffugen
+    assert diffugen.generation_queue.acquire(timeout=0)
+    second = diffugen.GenerationQueue(diffugen.config["lock_dir"])
+    print("second", second.acquire(timeout=0), flush=True)
+    print("held", flush=True)
+    sys.stdin.read()
+""")
+
+@pytest.fixture
+def holder(tmp_path):
+    lock_dir = str(tmp_path / "locks")
+    child = subprocess.Popen([sys.executable, "-c", HOLDER], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                             env=dict(os.environ, DIFFUGEN_LOCK_DIR=lock_dir, PYTHONPATH=REPO_ROOT))
+    lines = [child.stdout.readline().strip(), child.stdout.readline().strip()]
+    yield child, lock_dir, lines
+    if child.poll() is None:
+        child.kill()
+    child.wait()
+
+def test_slot_is_shared_between_processes(holder):
+    child, lock_dir, lines = holder
+    assert lines == ["second False", "held"]
+    queue = GenerationQueue(lock_dir)
+    assert not queue.acquire(timeout=0.2)
+    assert [h["pid"] for h in queue.holders()] == [child.pid]
+    # Building another queue on the same directory leaves the child's lock alone
+    assert [h["pid"] for h in GenerationQueue(lock_dir).holders()] == [child.pid]
+    assert not GenerationQueue(lock_dir).acquire(timeout=0)
+
+    # The kernel releases the lock when the holder exits, however it exits
+    child.stdin.close()
+    child.wait(10)
+    assert queue.holders() == []
+    assert queue.acquire(timeout=0)
+    assert [h["pid"] for h in queue.holders()] == [os.getpid()]
+    queue.release()
+
+def test_killed_holder_frees_its_slot(holder):
+    child, lock_dir, _ = holder
+    child.kill()
+    child.wait(10)
+    queue = GenerationQueue(lock_dir)
+    assert queue.acquire(timeout=1)
+    queue.release()
+
+def test_slots_are_counted_across_processes(holder):
+    child, lock_dir, _ = holder
+    queue = GenerationQueue(lock_dir, max_concurrent=2)
+    assert queue.acquire(timeout=0)
+    assert sorted(h["pid"] for h in queue.holders()) == sorted([child.pid, os.getpid()])
+    queue.release()
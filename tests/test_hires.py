@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+PARAMS = {"prompt": "a lighthouse", "model": "sd15", "steps": 2}
+
+@pytest.fixture
+def upscaler(diffugen, monkeypatch, tmp_path):
+    """An ESRGAN model file for the upscale pass (the stub only needs it to exist)"""
+    path = tmp_path / "RealESRGAN_x4plus.pth"
+    path.write_bytes(b"esrgan")
+    diffugen.get_supporting_file("upscaler")
+    monkeypatch.setitem(diffugen._supporting_files, "upscaler", str(path))
+    return str(path)
+
+def test_no_plan_up_to_the_native_size(diffugen):
+    assert diffugen.plan_hires("sd15", 512, 512, "upscale") is None
+    assert diffugen.plan_hires("sdxl", 1024, 1024, "refine") is None
+
+def test_first_pass_has_the_native_area_and_the_target_aspect(diffugen):
+    plan = diffugen.plan_hires("sd15", 1024, 512, "refine")
+    assert (plan["base_width"], plan["base_height"]) == (704, 384)
+    assert plan["base_width"] * plan["base_height"] == pytest.approx(512 * 512, rel=0.05)
+    assert plan["base_width"] / plan["base_height"] == pytest.approx(2, rel=0.1)
+    assert plan["strength"] == 0.35
+    assert diffugen.plan_hires("sd15", 1024, 512, "refine", strength=0.5)["strength"] == 0.5
+    plan = diffugen.plan_hires("sdxl", 2048, 1152, "refine")
+    assert (plan["base_width"], plan["base_height"]) == (1344, 768)
+
+def test_upscale_repeats_until_the_target_is_covered(diffugen, monkeypatch):
+    plan = diffugen.plan_hires("sd15", 2048, 2048, "upscale")
+    assert (plan["base_width"], plan["base_height"], plan["upscale_repeats"]) == (512, 512, 1)
+    assert (plan["upscaled_width"], plan["upscaled_height"]) == (2048, 2048)
+    # An x4 upscale of the first pass overshoots 1536x1536 and is resized down to it
+    plan = diffugen.plan_hires("sd15", 1536, 1536, "upscale")
+    assert (plan["upscaled_width"], plan["upscale_repeats"]) == (2048, 1)
+    monkeypatch.setitem(diffugen.config, "hires", {"upscale_scale": 2})
+    plan = diffugen.plan_hires("sd15", 2048, 2048, "upscale")
+    assert (plan["upscaled_width"], plan["upscale_repeats"]) == (2048, 2)
+
+def test_missing_upscaler_is_an_error(diffugen, monkeypatch, tmp_path):
+    diffugen.get_supporting_file("upscaler")
+    monkeypatch.setitem(diffugen._supporting_files, "upscaler", str(tmp_path / "missing.pth"))
+    result = diffugen.generate_stable_diffusion_image(width=1024, height=1024, hires="upscale",
+                                                      output_dir=str(tmp_path), **PARAMS)
+    assert not result["success"]
+    assert "Upscale model not found" in result["error"]
+
+def test_resizing_an_upscale_needs_pillow(diffugen, monkeypatch, upscaler, tmp_path):
+    monkeypatch.setattr(diffugen, "Image", None)
+    result = diffugen.generate_stable_diffusion_image(width=1536, height=1536, hires="upscale",
+                                                      output_dir=str(tmp_path), **PARAMS)
+    assert not result["success"]
+    assert "needs Pillow" in result["error"]
+    # Without a resize the upscale needs no Pillow
+    commands = diffugen._prepare_hires("sd15", "a lighthouse", str(tmp_path / "out.png"), 2048, 2048, 2, 7.0,
+                                       "euler", 1, "upscale")
+    assert commands[2]["upscale_repeats"] == 1
+
+def test_upscale_is_resized_to_the_requested_size(diffugen, upscaler, tmp_path):
+    from PIL import Image
+    result = diffugen.generate_stable_diffusion_image(width=1536, height=1024, hires="upscale",
+                                                      output_dir=str(tmp_path), **PARAMS)
+    assert result["success"], result
+    assert "--upscale-model" in result["command"]
+    with Image.open(result["image_path"]) as image:
+        assert image.size == (1536, 1024)
+    assert "resize" in result["timings"]
+
+def test_refine_runs_two_passes_and_removes_the_first(diffugen, tmp_path):
+    result = diffugen.generate_stable_diffusion_image(width=768, height=768, hires="refine",
+                                                      output_dir=str(tmp_path), **PARAMS)
+    assert result["success"], result
+    assert "-i " in result["refine_command"] and "_base.png" in result["refine_command"]
+    assert os.listdir(tmp_path) == [os.path.basename(result["image_path"])]
+    passes = result["timings"]["passes"]
+    assert set(passes) == {"base", "refine"}
+    assert result["timings"]["process_total"] == pytest.approx(
+        passes["base"]["process_total"] + passes["refine"]["process_total"], abs=0.01)
+    assert "base_path" not in result["hires"]
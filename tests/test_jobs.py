@@ -0,0 +1,196 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import uuid
+from urllib.parse import urlparse
+
+import pytest
+
+from benchmarks.stub_redis import start_stub_redis
+from diffugen_jobs import (CANCELLED, FAILED, QUEUED, RUNNING, SUCCEEDED, JobManager, MemoryBroker, RedisBroker,
+                           SQLiteBroker, new_job)
+
+# A real Redis server to test against instead of the in-process stand-in
+REDIS_URL = os.environ.get("DIFFUGEN_TEST_REDIS_URL")
+
+@pytest.fixture(scope="module")
+def redis_url():
+    if REDIS_URL:
+        yield REDIS_URL
+        return
+    server = start_stub_redis()
+    yield server.url
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def broker(request, tmp_path):
+    if request.param == "memory":
+        return MemoryBroker()
+    if request.param == "sqlite":
+        return SQLiteBroker(str(tmp_path / "jobs.db"))
+    parsed = urlparse(request.getfixturevalue("redis_url"))
+    # A prefix of its own keeps each test's keys apart
+    return RedisBroker(host=parsed.hostname, port=parsed.port or 6379, db=int(parsed.path.lstrip("/") or 0),
+                       prefix=f"diffugen-test-{uuid.uuid4().hex}", poll_interval=0.01)
+
+def _run_threads(count, target):
+    threads = [threading.Thread(target=target, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+
+def test_concurrent_claims_take_each_job_once(broker):
+    job_ids = {broker.submit(new_job("flux", {"prompt": str(i)}))["id"] for i in range(20)}
+    claimed = []
+    lock = threading.Lock()
+
+    def worker(index):
+        while True:
+            job = broker.claim(f"worker-{index}", timeout=0.2)
+            if job is None:
+                return
+            with lock:
+                claimed.append(job["id"])
+
+    _run_threads(6, worker)
+    assert sorted(claimed) == sorted(job_ids)
+    assert all(broker.get(job_id)["status"] == RUNNING for job_id in job_ids)
+
+def test_cancel_racing_claims_never_runs_a_cancelled_job(broker):
+    job_ids = [broker.submit(new_job("flux", {"prompt": str(i)}))["id"] for i in range(20)]
+    claimed, cancelled = set(), set()
+    lock = threading.Lock()
+
+    def worker(index):
+        if index == 0:
+            for job_id in job_ids:
+                job = broker.cancel(job_id)
+                if job["status"] == CANCELLED:
+                    with lock:
+                        cancelled.add(job_id)
+            return
+        while True:
+            job = broker.claim(f"worker-{index}", timeout=0.2)
+            if job is None:
+                return
+            with lock:
+                claimed.add(job["id"])
+
+    _run_threads(4, worker)
+    assert not claimed & cancelled
+    assert claimed | cancelled == set(job_ids)
+    for job_id in claimed:
+        job = broker.get(job_id)
+        assert job["status"] == RUNNING and job["cancel_requested"]
+
+def test_finish_only_records_a_running_job_once(broker):
+    job = broker.submit(new_job("flux", {}))
+    assert not broker.finish(job["id"], SUCCEEDED, result={"success": True})
+    broker.claim("worker-1", timeout=1)
+    assert not broker.finish(job["id"], SUCCEEDED, result={"success": True}, worker="worker-2")
+    results = {}
+
+    def finish(index):
+        results[index] = broker.finish(job["id"], SUCCEEDED, result={"success": True, "index": index}, worker="worker-1")
+
+    _run_threads(4, finish)
+    winners = [index for index, changed in results.items() if changed]
+    assert len(winners) == 1
+    finished = broker.get(job["id"])
+    assert finished["status"] == SUCCEEDED
+    assert finished["result"]["index"] == winners[0]
+
+def test_result_after_recovery_is_dropped(broker):
+    job = broker.submit(new_job("flux", {}))
+    broker.claim("worker-1", timeout=1)
+    assert broker.fail_running(job["id"], "Worker sent no heartbeat")
+    assert not broker.fail_running(job["id"], "again")
+    assert not broker.finish(job["id"], SUCCEEDED, result={"success": True}, worker="worker-1")
+    job = broker.get(job["id"])
+    assert job["status"] == FAILED and job["error"] == "Worker sent no heartbeat"
+
+def test_cancel_while_queued(broker):
+    job = broker.submit(new_job("flux", {}))
+    assert broker.get(job["id"])["status"] == QUEUED
+    assert broker.cancel(job["id"])["status"] == CANCELLED
+    assert broker.claim("worker-1", timeout=0.1) is None
+    assert broker.queue_length() == 0
+
+def test_tenant_filter(broker):
+    broker.submit(new_job("flux", {}, tenant="alice"))
+    broker.submit(new_job("flux", {}, tenant="bob"))
+    assert [job["tenant"] for job in broker.list(tenant="alice")] == ["alice"]
+    assert len(broker.list()) == 2
+
+def test_manager_reports_each_finished_job_once():
+    finished = []
+    manager = JobManager(MemoryBroker(), lambda job, token: {"success": True, "prompt": job["params"]["prompt"]},
+                         local_workers=2, on_finished=finished.append)
+    jobs = [manager.submit("flux", {"prompt": str(i)}) for i in range(5)]
+    manager.start()
+    try:
+        for job in jobs:
+            for _ in range(200):
+                if manager.get(job["id"])["status"] == SUCCEEDED:
+                    break
+                threading.Event().wait(0.01)
+            assert manager.get(job["id"])["status"] == SUCCEEDED
+    finally:
+        manager.stop()
+    assert sorted(job["id"] for job in finished) == sorted(job["id"] for job in jobs)
+
+def test_manager_drops_a_result_that_lost_to_recovery():
+    broker = MemoryBroker()
+    finished = []
+
+    def runner(job, token):
+        # The job's lease ran out while it rendered
+        broker.fail_running(job["id"], "Worker sent no heartbeat")
+        return {"success": True}
+
+    manager = JobManager(broker, runner, local_workers=0, on_finished=finished.append)
+    job = manager.submit("flux", {})
+    manager.run_job(broker.claim("worker-1"), "worker-1")
+    assert broker.get(job["id"])["status"] == FAILED
+    assert finished == []
+
+def test_sqlite_store_survives_a_restart(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    broker = SQLiteBroker(path)
+    running = broker.submit(new_job("flux", {"prompt": "running"}))
+    broker.claim("other-host:1:0", timeout=1)
+    queued = broker.submit(new_job("flux", {"prompt": "queued"}, callback_url="https://example.com/hook"))
+    # A fresh process opens the same store
+    restarted = SQLiteBroker(path)
+    assert restarted.get(running["id"])["status"] == RUNNING
+    assert restarted.get(queued["id"])["callback_url"] == "https://example.com/hook"
+    claimed = restarted.claim("worker-2", timeout=1)
+    assert claimed["id"] == queued["id"] and claimed["params"] == {"prompt": "queued"}
+
+def test_recover_fails_jobs_of_exited_workers(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "jobs.db"))
+    job = broker.submit(new_job("flux", {}))
+    # A worker process on this host that has since exited
+    exited = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    broker.claim(f"{socket.gethostname()}:{exited.stdout.strip()}:0", timeout=1)
+    finished = []
+    manager = JobManager(broker, lambda job, token: {"success": True}, local_workers=0, on_finished=finished.append)
+    manager.recover()
+    job = broker.get(job["id"])
+    assert job["status"] == FAILED and "exited" in job["error"]
+    assert [job["id"] for job in finished] == [job["id"]]
+
+def test_default_store_does_not_depend_on_the_working_directory(tmp_path):
+    env = {name: value for name, value in os.environ.items() if name != "DIFFUGEN_BROKER"}
+    env.update(DIFFUGEN_DATA_DIR=str(tmp_path / "data"), PYTHONPATH=os.path.dirname(os.path.dirname(__file__)))
+    brokers = set()
+    for cwd in (tmp_path, tmp_path.parent):
+        completed = subprocess.run([sys.executable, "-c", "import diffugen; print(diffugen.config['broker'])"],
+                                   cwd=str(cwd), env=env, capture_output=True, text=True, timeout=60)
+        assert completed.returncode == 0, completed.stderr
+        brokers.add(completed.stdout.strip().splitlines()[-1])
+    assert brokers == {"sqlite:///" + str(tmp_path / "data" / "jobs.db")}
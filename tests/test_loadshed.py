@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+from diffugen_loadshed import DEFAULT_MAX_WAIT, QUEUE_FULL, QUEUE_PER_SLOT, WAIT_TOO_LONG, BoundedExecutor, LoadTracker
+
+REQUEST = {"prompt": "a fox", "model": "sd15", "steps": 2, "width": 64, "height": 64}
+
+def test_limits_default_to_the_slots():
+    tracker = LoadTracker(2)
+    assert tracker.settings["max_queue"] == QUEUE_PER_SLOT * 2
+    assert tracker.settings["max_wait_seconds"] == DEFAULT_MAX_WAIT
+    assert tracker.capacity() == 2 + QUEUE_PER_SLOT * 2
+    # An unlimited queue still bounds the threads waiting for a slot
+    assert LoadTracker(2, {"max_queue": 0}).capacity() == 2 + QUEUE_PER_SLOT * 2
+
+def test_full_queue_is_shed_until_a_slot_frees():
+    tracker = LoadTracker(1, {"max_queue": 2, "max_wait_seconds": 0})
+    running = tracker.enter(30)
+    tracker.start(running)
+    waiting = [tracker.enter(30), tracker.enter(30)]
+    shed = tracker.check()
+    assert shed["reason"] == QUEUE_FULL
+    assert shed["waiting"] == 2
+    assert 29 <= shed["retry_after"] <= 30
+    tracker.leave(waiting[0])
+    assert tracker.check() is None
+
+def test_long_predicted_wait_is_shed():
+    tracker = LoadTracker(1, {"max_queue": 0, "max_wait_seconds": 60})
+    tracker.start(tracker.enter(50))
+    assert tracker.check() is None
+    tracker.enter(50)
+    shed = tracker.check()
+    assert shed["reason"] == WAIT_TOO_LONG
+    assert shed["predicted_wait"] == pytest.approx(100, abs=1)
+    assert 40 <= shed["retry_after"] <= 41
+    # Retry-After is capped
+    tracker.settings["max_retry_after"] = 5
+    assert tracker.check()["retry_after"] == 5
+
+def test_bounded_executor_refuses_work_when_full():
+    executor = BoundedExecutor(2, name="test")
+    release = threading.Event()
+    futures = [executor.submit(release.wait) for _ in range(2)]
+    assert all(futures)
+    assert executor.submit(release.wait) is None
+    release.set()
+    for future in futures:
+        future.result(timeout=5)
+    assert executor.submit(lambda: 42).result(timeout=5) == 42
+    executor.shutdown()
+
+def test_generation_is_shed_when_saturated(client, saturated):
+    response = client.post("/generate/stable", json=REQUEST)
+    assert response.status_code == 503
+    assert 1 <= int(response.headers["Retry-After"]) <= 120
+
+def test_generation_is_shed_when_no_thread_is_free(client, openapi, monkeypatch):
+    executor = BoundedExecutor(1, name="test-generation")
+    release = threading.Event()
+    executor.submit(release.wait)
+    monkeypatch.setattr(openapi, "generation_executor", executor)
+    try:
+        response = client.post("/generate/stable", json=REQUEST)
+    finally:
+        release.set()
+        executor.shutdown()
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    monkeypatch.undo()
+    assert client.post("/generate/stable", json=REQUEST).status_code == 200
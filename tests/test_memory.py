@@ -0,0 +1,27 @@
+from diffugen_memory import MEMORY_FLAGS, available_memory_mb, estimate_peak_mb, plan_memory
+
+WEIGHTS = {"diffusion": 6500, "text_encoders": 5000, "vae": 160}
+
+def test_small_images_run_without_memory_flags():
+    plan = plan_memory("sdxl", 512, 512, weights={"diffusion": 2500, "vae": 160}, available_mb=24000)
+    assert plan["flags"] == []
+    assert plan["estimated_mb"] <= 24000 - 768
+
+def test_flags_are_added_cheapest_first_until_the_run_fits():
+    plan = plan_memory("flux-dev", 1024, 1024, weights=WEIGHTS, available_mb=9000)
+    assert plan["flags"] == MEMORY_FLAGS[:len(plan["flags"])]
+    assert plan["estimated_mb"] <= 9000 - 768
+    assert estimate_peak_mb("flux-dev", 1024, 1024, 1, WEIGHTS, plan["flags"][:-1]) > 9000 - 768
+
+def test_configured_flags_are_not_added_again():
+    plan = plan_memory("flux-dev", 1024, 1024, weights=WEIGHTS, available_mb=9000, base_flags=["--diffusion-fa"])
+    assert "--diffusion-fa" not in plan["flags"]
+
+def test_size_only_fallback_tiles_large_images():
+    assert plan_memory("sdxl", 2048, 2048)["flags"] == ["--vae-tiling"]
+    assert plan_memory("sdxl", 1024, 1024)["flags"] == []
+
+def test_configured_gpu_memory_is_shared_between_workers(monkeypatch):
+    monkeypatch.setattr("diffugen_memory.free_gpu_memory_mb", lambda: None)
+    assert available_memory_mb({"gpu_memory_mb": 12000}, concurrent_workers=2) == 6000
+    assert available_memory_mb({}) is None
@@ -0,0 +1,38 @@
+import pytest
+
+import diffugen_metrics as metrics
+
+def test_counter_renders_labelled_samples():
+    counter = metrics.Counter("test_requests_total", "Requests", ("endpoint",))
+    counter.inc(endpoint="/generate")
+    counter.inc(2, endpoint="/generate")
+    assert counter.value(endpoint="/generate") == 3
+    assert 'test_requests_total{endpoint="/generate"} 3' in counter.render()
+
+def test_labels_must_match():
+    counter = metrics.Counter("test_labels_total", "Labels", ("model",))
+    with pytest.raises(ValueError):
+        counter.inc(tenant="a")
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("test_seconds", "Latency", buckets=(1, 5))
+    for value in (0.5, 2, 10):
+        histogram.observe(value)
+    lines = histogram.render()
+    assert 'test_seconds_bucket{le="1"} 1' in lines
+    assert 'test_seconds_bucket{le="5"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+    assert "test_seconds_count 3" in lines
+
+def test_gauge_function_is_computed_on_collection(tmp_path):
+    (tmp_path / "image.png").write_bytes(b"x" * 10)
+    gauge = metrics.Gauge("test_bytes", "Bytes")
+    gauge.set_function(lambda: metrics.directory_size(str(tmp_path)))
+    assert gauge.value() == 10
+    (tmp_path / "other.png").write_bytes(b"x" * 5)
+    assert "test_bytes 15" in gauge.render()
+
+def test_metrics_endpoint(client):
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "# TYPE diffugen_output_dir_bytes gauge" in response.text
@@ -0,0 +1,33 @@
+import asyncio
+import threading
+import time
+
+def test_readiness_reports_saturation(client, saturated):
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    body = response.json()
+    assert not body["ready"]
+    assert body["retry_after"] == int(response.headers["Retry-After"])
+    assert body["queue"]["waiting"] == saturated.capacity()
+
+def test_readiness_answers_while_generations_hold_the_default_executor(client):
+    release = threading.Event()
+
+    async def hold_default_executor():
+        loop = asyncio.get_running_loop()
+        for _ in range(64):
+            loop.run_in_executor(None, release.wait)
+
+    client.portal.call(hold_default_executor)
+    responses = []
+    probe = threading.Thread(target=lambda: responses.append(client.get("/health/ready")))
+    try:
+        started = time.time()
+        probe.start()
+        probe.join(5)
+        assert responses, "readiness probe waited for the default executor"
+        assert time.time() - started < 5
+        assert "ready" in responses[0].json()
+    finally:
+        release.set()
+        probe.join()
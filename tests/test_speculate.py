@@ -0,0 +1,106 @@
+import asyncio
+import threading
+
+import pytest
+
+from diffugen_speculate import CANCELLED, EXPIRED, USED, Speculator
+
+PARAMS = {"prompt": "a fox", "model": "sd15", "steps": 2, "seed": -1, "tool": "stable"}
+
+class Renders:
+    """A render function for the speculator that holds each render until released"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.params = []
+        self.discarded = []
+        self.outcomes = []
+
+    def __call__(self, params, tenant, token):
+        self.params.append(params)
+        self.started.set()
+        while not self.release.wait(0.01):
+            if token.cancelled:
+                return {"success": False, "error": "Cancelled", "error_type": "cancelled"}
+        return {"success": True, "image_path": f"/tmp/speculative-{len(self.params)}.png"}
+
+@pytest.fixture
+def renders():
+    return Renders()
+
+@pytest.fixture
+def speculator(renders):
+    speculator = Speculator({"enabled": True, "budget": 2, "idle_seconds": 0}, renders, lambda: True,
+                            renders.discarded.append, renders.outcomes.append)
+    yield speculator
+    renders.release.set()
+    speculator.stop()
+
+def test_key_ignores_the_seed():
+    assert Speculator.key("alice", PARAMS) == Speculator.key("alice", dict(PARAMS, seed=7, output_dir="/x"))
+    assert Speculator.key("alice", PARAMS) != Speculator.key("bob", PARAMS)
+    assert Speculator.key("alice", PARAMS) != Speculator.key("alice", dict(PARAMS, steps=3))
+
+def test_observe_keeps_within_the_budget(speculator):
+    for prompt in ("a fox", "a cat", "a dog"):
+        params = dict(PARAMS, prompt=prompt)
+        speculator.observe(Speculator.key("alice", params), params, "alice")
+    assert speculator.status()["pending"] == 2
+    # The oldest prompt made way for the newest
+    assert list(speculator._pending) == [Speculator.key("alice", dict(PARAMS, prompt=p)) for p in ("a cat", "a dog")]
+
+def test_take_waits_for_a_running_render(speculator, renders):
+    key = Speculator.key("alice", PARAMS)
+    speculator.observe(key, PARAMS, "alice")
+    speculator.start()
+    assert renders.started.wait(5)
+    assert speculator.has(key)
+    assert speculator.take(key, wait=False) is None
+    rendered = threading.Event()
+    assert speculator.when_rendered(key, rendered.set)
+    renders.release.set()
+    assert rendered.wait(5)
+    result = speculator.take(key)
+    assert result["speculative"] and result["image_path"] == "/tmp/speculative-1.png"
+    assert renders.outcomes == [USED]
+    assert speculator.take(key) is None
+    assert not speculator.when_rendered(key, rendered.set)
+
+def test_a_real_request_preempts_another_render(speculator, renders):
+    key = Speculator.key("alice", PARAMS)
+    speculator.observe(key, PARAMS, "alice")
+    speculator.start()
+    assert renders.started.wait(5)
+    rendered = threading.Event()
+    assert speculator.when_rendered(key, rendered.set)
+    speculator.preempt(Speculator.key("alice", dict(PARAMS, prompt="a cat")))
+    assert rendered.wait(5)
+    assert speculator.take(key) is None
+    assert renders.outcomes == [CANCELLED]
+
+def test_unclaimed_images_expire(speculator, renders):
+    key = Speculator.key("alice", PARAMS)
+    speculator.settings["ttl_seconds"] = 0
+    speculator._ready[key] = (0, {"success": True, "image_path": "/tmp/old.png"})
+    assert speculator.take(key) is None
+    assert renders.outcomes == [EXPIRED]
+    assert renders.discarded == [{"success": True, "image_path": "/tmp/old.png"}]
+
+def test_take_speculation_awaits_the_render(openapi, monkeypatch, speculator, renders):
+    monkeypatch.setattr(openapi, "speculator", speculator)
+    key = Speculator.key("alice", PARAMS)
+    speculator.observe(key, PARAMS, "alice")
+    speculator.start()
+    assert renders.started.wait(5)
+
+    async def take():
+        task = asyncio.ensure_future(openapi.take_speculation(key))
+        await asyncio.sleep(0.1)
+        assert not task.done()
+        renders.release.set()
+        return await asyncio.wait_for(task, 5)
+
+    assert asyncio.run(take())["speculative"]
+    # Nothing is rendering for another key, so there is nothing to await
+    assert asyncio.run(openapi.take_speculation(Speculator.key("bob", PARAMS))) is None
@@ -0,0 +1,28 @@
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _fresh_import(code, cwd):
+    completed = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True,
+                               env=dict(os.environ, PYTHONPATH=REPO_ROOT), timeout=60)
+    assert completed.returncode == 0, completed.stderr
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def test_import_does_no_work(tmp_path):
+    state = _fresh_import(
+        "import json, sys, diffugen\n"
+        "print(json.dumps({'config': diffugen.config._built, 'queue': diffugen.generation_queue._built,\n"
+        "                  'warmer': diffugen.warmer._built, 'mcp': 'mcp' in sys.modules}))", str(tmp_path))
+    assert state == {"config": False, "queue": False, "warmer": False, "mcp": False}
+    assert os.listdir(tmp_path) == []
+
+def test_globals_are_built_on_first_use(diffugen):
+    assert diffugen.config["output_dir"] == os.environ["DIFFUGEN_OUTPUT_DIR"]
+    assert diffugen.load_tracker.slots == diffugen.config["max_concurrent"]
+    assert "broker" in diffugen.config
+    # The old module globals still resolve for scripts that use them
+    assert diffugen.sd_cpp_path == diffugen.get_sd_cpp_path() == os.environ["SD_CPP_PATH"]
+    assert diffugen.default_output_dir == diffugen.get_default_output_dir()
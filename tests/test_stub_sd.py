@@ -0,0 +1,26 @@
+import os
+import subprocess
+
+from benchmarks.stub_sd import install_stub
+
+def test_stub_writes_a_png(tmp_path):
+    binary = install_stub(str(tmp_path / "stable-diffusion.cpp"))
+    output = tmp_path / "out.png"
+    completed = subprocess.run([binary, "-p", "a cat", "--steps", "2", "-W", "32", "-H", "32", "-o", str(output)],
+                               env=dict(os.environ, DIFFUGEN_STUB_DELAY="0"), capture_output=True, text=True)
+    assert completed.returncode == 0
+    assert "sampling completed" in completed.stdout
+    assert output.read_bytes().startswith(b"\x89PNG")
+
+def test_stub_failure_rate(tmp_path):
+    binary = install_stub(str(tmp_path / "stable-diffusion.cpp"))
+    completed = subprocess.run([binary, "-o", str(tmp_path / "out.png")],
+                               env=dict(os.environ, DIFFUGEN_STUB_FAIL_RATE="1"), capture_output=True)
+    assert completed.returncode == 1
+    assert not (tmp_path / "out.png").exists()
+
+def test_generation_runs_the_stub(diffugen):
+    result = diffugen.generate_stable_diffusion_image("a lighthouse", model="sd15", steps=2, width=64, height=64)
+    assert result["success"], result
+    assert os.path.exists(result["image_path"])
+    assert result["image_path"].startswith(diffugen.get_default_output_dir())
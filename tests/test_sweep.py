@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from diffugen_sweep import build_contact_sheet, cell_label, expand_grid, grid_columns, normalize_axes
+
+def test_axes_are_validated_and_converted():
+    assert normalize_axes({"cfg": [3, "5"], "seeds": 1}) == {"cfg_scale": [3.0, 5.0], "seed": [1]}
+    with pytest.raises(ValueError, match="Unknown sweep axis"):
+        normalize_axes({"width": [512]})
+    with pytest.raises(ValueError, match="given twice"):
+        normalize_axes({"cfg": [1], "cfg_scale": [2]})
+    with pytest.raises(ValueError, match="more than the limit"):
+        normalize_axes({"seed": list(range(10)), "steps": list(range(10))}, max_cells=64)
+
+def test_grid_varies_the_last_axis_fastest():
+    axes = normalize_axes({"steps": [10, 20], "sampler": ["euler", "heun"]})
+    assert expand_grid(axes) == [
+        {"steps": 10, "sampling_method": "euler"}, {"steps": 10, "sampling_method": "heun"},
+        {"steps": 20, "sampling_method": "euler"}, {"steps": 20, "sampling_method": "heun"}]
+    assert grid_columns(axes) == 2
+    assert cell_label({"cfg_scale": 7.0, "seed": 3}) == "cfg 7.0 · seed 3"
+
+def test_sweep_renders_every_cell_and_a_contact_sheet(diffugen, tmp_path):
+    progress = []
+    result = diffugen.generate_sweep("a castle", {"steps": [1, 2], "seed": [5, 6]}, model="sd15", width=64, height=64,
+                                     output_dir=str(tmp_path), on_progress=lambda partial: progress.append(partial["completed"]))
+    assert result["success"], result
+    assert [cell["values"] for cell in result["cells"]] == [{"steps": 1, "seed": 5}, {"steps": 1, "seed": 6},
+                                                            {"steps": 2, "seed": 5}, {"steps": 2, "seed": 6}]
+    assert all(os.path.exists(cell["image_path"]) for cell in result["cells"])
+    assert progress == [1, 2, 3, 4]
+    assert os.path.exists(result["contact_sheet"])
+
+def test_sweep_frees_the_slot_between_cells(diffugen, tmp_path):
+    # Another tenant's request can take the slot while the next cell waits its turn
+    holders = []
+    result = diffugen.generate_sweep("a castle", {"seed": [1, 2, 3]}, model="sd15", width=64, height=64, steps=1,
+                                     output_dir=str(tmp_path),
+                                     on_progress=lambda partial: holders.append(diffugen.generation_queue.holders()))
+    assert result["success"], result
+    assert holders == [[], [], []]
+
+def test_busy_sweep_is_shed_before_its_first_cell(diffugen, tmp_path, saturated):
+    result = diffugen.generate_sweep("a castle", {"seed": [1, 2]}, model="sd15", width=64, height=64, steps=1,
+                                     output_dir=str(tmp_path))
+    assert result["error_type"] == "busy"
+    assert result["retry_after"] >= 1
+    assert not os.listdir(tmp_path)
+
+def test_contact_sheet_without_images(tmp_path):
+    path = build_contact_sheet([], str(tmp_path), "empty", columns=1, title="nothing")
+    assert os.path.exists(path)
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import diffugen_metrics as metrics
+
+PARAMS = {"prompt": "a fox", "model": "sd15", "steps": 2, "width": 64, "height": 64}
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def timeouts(diffugen, monkeypatch):
+    """Set the timeouts section for one test"""
+    def set_timeouts(**settings):
+        monkeypatch.setitem(diffugen.config, "timeouts", settings)
+    return set_timeouts
+
+def test_limits_scale_with_the_work_and_per_model_overrides(diffugen, timeouts):
+    timeouts(base_seconds=10, seconds_per_step_megapixel=2, idle_seconds=0,
+             models={"flux-dev": {"seconds_per_step_megapixel": 4, "idle_seconds": 30}})
+    total, idle = diffugen.get_generation_timeouts("sd15", 20, 1000, 1000)
+    assert total == pytest.approx(10 + 2 * 20 * 1.0)
+    assert idle is None
+    total, idle = diffugen.get_generation_timeouts("flux-dev", 20, 1000, 500)
+    assert total == pytest.approx(10 + 4 * 20 * 0.5)
+    assert idle == 30
+    timeouts(base_seconds=0, seconds_per_step_megapixel=0)
+    assert diffugen.get_generation_timeouts("sd15", 20, 512, 512) == (None, 300)
+
+def test_timeouts_from_the_environment(tmp_path):
+    env = dict(os.environ, DIFFUGEN_IDLE_TIMEOUT="5", DIFFUGEN_TIMEOUT_BASE="20", PYTHONPATH=REPO_ROOT)
+    completed = subprocess.run([sys.executable, "-c", "import diffugen; print(diffugen.get_generation_timeouts('sd15', 10, 1000, 1000))"],
+                               cwd=str(tmp_path), env=env, capture_output=True, text=True, timeout=60)
+    assert completed.stdout.strip().splitlines()[-1] == "(620.0, 5.0)"
+
+def test_silent_sd_is_stopped_by_the_watchdog(diffugen, timeouts, monkeypatch, tmp_path):
+    # The stub prints nothing while it "loads the model"
+    monkeypatch.setenv("DIFFUGEN_STUB_LOAD_DELAY", "30")
+    timeouts(idle_seconds=1)
+    before = metrics.TIMEOUTS.value(model="sd15", kind="idle")
+    result = diffugen.generate_stable_diffusion_image(output_dir=str(tmp_path), **PARAMS)
+    assert result["error_type"] == "timeout"
+    assert "no output" in result["error"]
+    assert result["timings"]["process_total"] < 10
+    assert metrics.TIMEOUTS.value(model="sd15", kind="idle") == before + 1
+    assert os.listdir(tmp_path) == []
+    assert diffugen.generation_queue.holders() == []
+
+def test_slow_sd_is_stopped_at_its_time_limit(diffugen, timeouts, monkeypatch, tmp_path):
+    # Progress keeps coming, so only the total limit applies
+    monkeypatch.setenv("DIFFUGEN_STUB_DELAY", "30")
+    timeouts(base_seconds=1, seconds_per_step_megapixel=0, idle_seconds=300)
+    before = metrics.TIMEOUTS.value(model="sd15", kind="total")
+    result = diffugen.generate_stable_diffusion_image(output_dir=str(tmp_path), **dict(PARAMS, steps=30))
+    assert result["error_type"] == "timeout"
+    assert "time limit" in result["error"]
+    assert result["timings"]["process_total"] < 10
+    assert metrics.TIMEOUTS.value(model="sd15", kind="total") == before + 1
+
+def test_timeout_is_a_504(client, timeouts, monkeypatch):
+    monkeypatch.setenv("DIFFUGEN_STUB_LOAD_DELAY", "30")
+    timeouts(idle_seconds=1)
+    response = client.post("/generate/stable", json=PARAMS)
+    assert response.status_code == 504
+    assert "no output" in response.json()["detail"]
@@ -0,0 +1,57 @@
+import pytest
+
+def _lines(*lines, start=100.0):
+    """sd.cpp output lines, one second apart"""
+    return [(start + index, line) for index, line in enumerate(lines)]
+
+def test_phases_and_progress_are_parsed(diffugen):
+    timings, decode_done_at = diffugen._parse_sd_timings(_lines(
+        "[INFO ] stable-diffusion.cpp:200 - loading model from 'sd15.safetensors' completed, taking 2.50s",
+        "[INFO ] stable-diffusion.cpp:400 - get_learned_condition completed, taking 120 ms",
+        "  |==========>| 20/20 - 1.50s/it",
+        "[INFO ] stable-diffusion.cpp:500 - sampling completed, taking 30.00s",
+        "[INFO ] stable-diffusion.cpp:600 - decode_first_stage completed, taking 0.80s",
+        "[INFO ] stable-diffusion.cpp:700 - txt2img completed in 33.50s",
+        "save result image to 'out.png'"))
+    assert timings == {"model_load": 2.5, "text_encode": pytest.approx(0.12), "sampling_steps": 20,
+                       "seconds_per_step": 1.5, "sampling": 30.0, "decode": 0.8, "sd_total": 33.5}
+    assert decode_done_at == 104.0
+
+def test_iterations_per_second_are_converted(diffugen):
+    timings, _ = diffugen._parse_sd_timings(_lines("  |=====>| 4/8 - 2.50it/s", "  |==========>| 8/8 - 4.00it/s"))
+    assert timings == {"sampling_steps": 8, "seconds_per_step": 0.25}
+
+def test_batch_phases_are_summed(diffugen):
+    timings, decode_done_at = diffugen._parse_sd_timings(_lines(
+        "sampling completed, taking 10.00s", "decode_first_stage completed, taking 1.00s",
+        "sampling completed, taking 12.00s", "decode_first_stage completed, taking 1.50s"))
+    assert timings == {"sampling": 22.0, "decode": 2.5}
+    assert decode_done_at == 103.0
+
+def test_a_phase_reported_whole_and_in_parts_is_counted_once(diffugen):
+    timings, decode_done_at = diffugen._parse_sd_timings(_lines(
+        "[INFO ] model.cpp:1900 - loading tensors completed, taking 1.80s (process: 0.00s, read: 1.50s)",
+        "[INFO ] stable-diffusion.cpp:550 - loading model from 'flux1-schnell-q8_0.gguf' completed, taking 2.20s",
+        "[INFO ] stable-diffusion.cpp:1500 - decode_first_stage completed, taking 0.40s",
+        "[INFO ] stable-diffusion.cpp:1500 - decode_first_stage completed, taking 0.50s",
+        "[INFO ] stable-diffusion.cpp:1510 - decoding 2 latents completed, taking 1.00s"))
+    assert timings == {"model_load": 2.2, "decode": 1.0}
+    assert decode_done_at == 104.0
+    # Older sd.cpp only reports the tensor loading
+    timings, _ = diffugen._parse_sd_timings(_lines("loading tensors completed, taking 1.80s"))
+    assert timings == {"model_load": 1.8}
+
+def test_save_is_measured_from_the_decode_to_the_exit(diffugen):
+    trace = {"events": {"spawn_start": 99.0, "spawned": 99.5, "exited": 105.5},
+             "lines": _lines("sampling completed, taking 3.00s", "decode_first_stage completed, taking 0.50s",
+                             "[INFO ] esrgan - upscaled, taking 1.00s", "save result image to 'out.png'")}
+    timings = diffugen._build_timings(queue_start=97.0, start_time=98.0, prepared_at=98.5, trace=trace,
+                                      finished_at=106.0)
+    # The upscale, not the VAE decode, is the last stage that produces the image
+    assert timings["save"] == 3.5
+    assert timings["queue_wait"] == 1.0
+    assert timings["preflight"] == 0.5
+    assert timings["spawn"] == 0.5
+    assert timings["process_total"] == 6.5
+    assert timings["total"] == 9.0
+    assert (timings["sampling"], timings["decode"], timings["upscale"]) == (3.0, 0.5, 1.0)
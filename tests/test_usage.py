@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+from diffugen_usage import QuotaExceeded, UsageLedger, estimate_cost, window_seconds
+
+def test_cost_and_windows():
+    assert estimate_cost("sd15", 10) == 3.0
+    assert estimate_cost("sdxl", 10, {"sdxl": 2}) == 20.0
+    assert window_seconds("day") == 86400
+    assert window_seconds(90) == 90.0
+
+def test_concurrent_charges_do_not_overshoot_the_quota(tmp_path):
+    path = str(tmp_path / "usage.db")
+    UsageLedger(path)
+    accepted, rejected = [], []
+    lock = threading.Lock()
+
+    def charge(index):
+        # A ledger per thread stands in for a server process each
+        ledger = UsageLedger(path)
+        for _ in range(4):
+            try:
+                ledger.charge("alice", 1.0, quota={"cost": 10})
+                outcome = accepted
+            except QuotaExceeded:
+                outcome = rejected
+            with lock:
+                outcome.append(index)
+
+    threads = [threading.Thread(target=charge, args=(index,)) for index in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    assert len(accepted) == 10
+    assert len(rejected) == 30
+    assert UsageLedger(path).used("alice")["cost"] == 10.0
+
+def test_failed_generations_are_not_charged(tmp_path):
+    ledger = UsageLedger(str(tmp_path / "usage.db"))
+    entry = ledger.charge("alice", 6.0, quota={"cost": 10})
+    with pytest.raises(QuotaExceeded) as excinfo:
+        ledger.charge("alice", 6.0, quota={"cost": 10})
+    assert excinfo.value.limit == "cost" and excinfo.value.retry_after >= 1
+    ledger.finish(entry, "failed")
+    ledger.charge("alice", 6.0, quota={"cost": 10})
+
+def test_gpu_seconds_quota(tmp_path):
+    ledger = UsageLedger(str(tmp_path / "usage.db"))
+    ledger.finish(ledger.charge("alice", 1.0), "succeeded", gpu_seconds=5.0)
+    with pytest.raises(QuotaExceeded) as excinfo:
+        ledger.charge("alice", 1.0, quota={"gpu_seconds": 5})
+    assert excinfo.value.limit == "gpu_seconds"
+    assert ledger.summary(tenant="alice") == [
+        {"tenant": "alice", "model": None, "requests": 1, "succeeded": 1, "cost": 1.0, "gpu_seconds": 5.0}]
+
+def test_generation_is_charged_to_the_model_that_ran(client, openapi, monkeypatch):
+    monkeypatch.setitem(openapi.config, "security", {"api_keys": [{"key": "carol-key", "name": "carol"}]})
+    response = client.post("/generate/stable", headers={"X-API-Key": "carol-key"},
+                           json={"prompt": "a boat", "model": "sd15", "steps": 2, "width": 64, "height": 64})
+    assert response.status_code == 200, response.text
+    [row] = openapi.usage_ledger.summary(tenant="carol")
+    assert row["model"] == "sd15" and row["succeeded"] == 1 and row["gpu_seconds"] > 0
@@ -0,0 +1,62 @@
+import os
+import threading
+import time
+
+import pytest
+
+from diffugen_jobs import CancelToken
+from diffugen_variants import ConversionCancelled, VariantCache, VariantError, resolve_variant
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "models" / "sd15.safetensors"
+    path.parent.mkdir()
+    path.write_bytes(b"weights")
+    return str(path)
+
+@pytest.fixture
+def cache(tmp_path, sd_binary):
+    return VariantCache(str(tmp_path / "variants"), sd_binary, poll_interval=0.05)
+
+def test_resolve_variant():
+    assert resolve_variant("balanced") == "q8_0"
+    assert resolve_variant("Q4_0") == "q4_0"
+    assert resolve_variant("quality") is None
+    assert resolve_variant(None) is None
+    with pytest.raises(ValueError):
+        resolve_variant("q3_k")
+
+def test_conversions_are_cached_per_source_version(cache, source):
+    with pytest.raises(VariantError):
+        cache.get(source, "q8_0", convert=False)
+    converted = cache.get(source, "q8_0")
+    assert os.path.exists(converted)
+    assert cache.get(source, "q8_0", convert=False) == converted
+    # A replaced model is converted again, and the old conversion removed
+    with open(source, "ab") as f:
+        f.write(b" v2")
+    reconverted = cache.get(source, "q8_0")
+    assert reconverted != converted
+    assert [entry["file"] for entry in cache.entries()] == [os.path.basename(reconverted)]
+
+def test_installed_quantizations_are_used_as_they_are(cache, tmp_path):
+    path = tmp_path / "sd15.q4_0.gguf"
+    path.write_bytes(b"weights")
+    assert cache.get(str(path), "q4_0") == str(path)
+
+def test_failed_conversion_leaves_nothing_behind(cache, source, monkeypatch):
+    monkeypatch.setenv("DIFFUGEN_STUB_FAIL_RATE", "1")
+    with pytest.raises(VariantError, match="exit code 1"):
+        cache.get(source, "q5_0")
+    assert cache.entries() == []
+    assert not [name for name in os.listdir(cache.cache_dir) if name.endswith(".partial")]
+
+def test_cancelled_conversion_stops_at_once(cache, source, monkeypatch):
+    monkeypatch.setenv("DIFFUGEN_STUB_DELAY", "30")
+    token = CancelToken()
+    threading.Timer(0.3, token.cancel).start()
+    started = time.time()
+    with pytest.raises(ConversionCancelled):
+        cache.get(source, "q4_0", cancel_token=token)
+    assert time.time() - started < 5
+    assert os.listdir(cache.cache_dir) == [".convert.lock"]
@@ -0,0 +1,47 @@
+import time
+
+from diffugen_warmup import DISABLED, WARM, Warmer, prefetch_file
+
+def _weights(tmp_path, name, size_mb):
+    path = tmp_path / name
+    path.write_bytes(b"\0" * int(size_mb * 1048576))
+    return str(path)
+
+def test_prefetch_reads_the_whole_file(tmp_path):
+    assert prefetch_file(_weights(tmp_path, "model.gguf", 1)) == 1048576
+
+def test_models_are_prefetched_in_order_within_the_budget(tmp_path):
+    files = {"sd15": [_weights(tmp_path, "sd15.gguf", 1), _weights(tmp_path, "vae.gguf", 0.5)],
+             "sdxl": [_weights(tmp_path, "sdxl.gguf", 2), _weights(tmp_path, "vae.gguf", 0.5)],
+             "sd3": [str(tmp_path / "missing.gguf")]}
+    warmer = Warmer({"models": ["sd15", "sdxl", "sd3"], "memory_budget_mb": 3}, files.get)
+    assert warmer.warm() == ["sd15"]
+    models = warmer.status()["models"]
+    assert models["sd15"]["prefetched"] and models["sd15"]["prefetched_mb"] == 1.5
+    assert models["sdxl"] == {"prefetched": False, "reason": "over the memory budget"}
+    assert models["sd3"] == {"prefetched": False, "reason": "model not installed"}
+
+def test_shared_files_count_once(tmp_path):
+    files = {"sd15": [_weights(tmp_path, "sd15.gguf", 1), _weights(tmp_path, "vae.gguf", 1)],
+             "sdxl": [_weights(tmp_path, "sdxl.gguf", 1), str(tmp_path / "vae.gguf")]}
+    warmer = Warmer({"models": ["sd15", "sdxl"], "memory_budget_mb": 3}, files.get)
+    assert warmer.warm() == ["sd15", "sdxl"]
+
+def test_warmer_reports_ready_after_warm_up(tmp_path):
+    runs = []
+    warmer = Warmer({"models": ["sd15"], "memory_budget_mb": 10, "warmup_generation": True, "refresh_seconds": 0},
+                    lambda model: [_weights(tmp_path, "sd15.gguf", 1)],
+                    lambda model: runs.append(model) or {"success": True})
+    assert not warmer.status()["ready"]
+    warmer.start()
+    for _ in range(100):
+        if warmer.status()["ready"]:
+            break
+        time.sleep(0.02)
+    status = warmer.status()
+    assert status["state"] == WARM and status["ready"]
+    assert runs == ["sd15"] and status["models"]["sd15"]["warmup_success"]
+
+def test_no_hot_models_is_ready():
+    status = Warmer({}, lambda model: []).status()
+    assert status["state"] == DISABLED and status["ready"]
@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from diffugen_webhooks import WebhookDispatcher, is_private_address, job_payload, sign, validate_callback_url, verify_signature
+
+SECRET = "test-secret"
+
+class Receiver:
+    """A local webhook receiver answering with the given status codes in turn (then 200)"""
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.deliveries = []
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                receiver.deliveries.append((self.headers, body))
+                status = receiver.statuses.pop(0) if receiver.statuses else 200
+                self.send_response(status)
+                if status == 302:
+                    self.send_header("Location", "http://127.0.0.1:1/elsewhere")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/hook"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def receiver():
+    receivers = []
+
+    def start(statuses=()):
+        receivers.append(Receiver(statuses))
+        return receivers[-1]
+
+    yield start
+    for receiver in receivers:
+        receiver.close()
+
+def _deliver(dispatcher, url, payload):
+    outcome = []
+    done = threading.Event()
+    dispatcher.deliver(url, payload, delivery_id="job-1", on_done=lambda delivered: (outcome.append(delivered), done.set()))
+    assert done.wait(10)
+    dispatcher.stop()
+    return outcome[0]
+
+def test_signatures_verify():
+    body = b'{"job_id": "1"}'
+    timestamp = str(int(time.time()))
+    signature = "sha256=" + sign(SECRET, timestamp, body)
+    assert verify_signature(SECRET, timestamp, body, signature)
+    assert not verify_signature(SECRET, timestamp, body + b" ", signature)
+    assert not verify_signature("other-secret", timestamp, body, signature)
+    assert not verify_signature(SECRET, timestamp, body, None)
+    old = str(int(time.time()) - 3600)
+    assert not verify_signature(SECRET, old, body, "sha256=" + sign(SECRET, old, body))
+
+def test_callback_urls_are_checked():
+    settings = {"secret": SECRET}
+    with pytest.raises(ValueError, match="not enabled"):
+        validate_callback_url("https://example.com/hook", {})
+    with pytest.raises(ValueError, match="Invalid callback URL"):
+        validate_callback_url("ftp://example.com/hook", settings)
+    for url in ("http://127.0.0.1/hook", "http://localhost:8080/hook", "http://10.1.2.3/hook",
+                "http://169.254.169.254/latest/meta-data", "http://[::1]/hook"):
+        with pytest.raises(ValueError, match="private address"):
+            validate_callback_url(url, settings)
+    assert validate_callback_url("http://127.0.0.1/hook", dict(settings, allowed_hosts=["127.0.0.1"]))
+    assert validate_callback_url("http://10.1.2.3/hook", dict(settings, allow_private=True))
+    with pytest.raises(ValueError, match="not allowed"):
+        validate_callback_url("http://127.0.0.2/hook", dict(settings, allowed_hosts=["127.0.0.1"]))
+    assert is_private_address("::ffff:192.168.0.1")
+    assert not is_private_address("93.184.216.34")
+
+def test_delivery_is_signed(receiver):
+    server = receiver()
+    job = {"id": "job-1", "status": "succeeded", "tool": "flux", "params": {"prompt": "a fox"}, "submitted_at": 1.0,
+           "result": {"image_path": "/tmp/x.png", "output": "log"}}
+    payload = job_payload(job, "https://diffugen.example.com/")
+    assert payload["image_url"] == "https://diffugen.example.com/jobs/job-1/image"
+    assert "output" not in payload["result"]
+    dispatcher = WebhookDispatcher({"secret": SECRET, "allowed_hosts": ["127.0.0.1"]})
+    assert _deliver(dispatcher, server.url, payload)
+    [(headers, body)] = server.deliveries
+    assert headers["X-DiffuGen-Event"] == "job.succeeded"
+    assert headers["X-DiffuGen-Delivery"] == "job-1"
+    assert verify_signature(SECRET, headers["X-DiffuGen-Timestamp"], body, headers["X-DiffuGen-Signature"])
+    assert json.loads(body)["parameters"] == {"prompt": "a fox"}
+
+def test_failed_deliveries_are_retried(receiver):
+    server = receiver([503, 429])
+    dispatcher = WebhookDispatcher({"secret": SECRET, "allowed_hosts": ["127.0.0.1"], "backoff_seconds": 0.01})
+    assert _deliver(dispatcher, server.url, {"event": "job.failed"})
+    assert len(server.deliveries) == 3
+    assert dispatcher.stats()["retried"] == 2
+
+def test_client_errors_and_redirects_are_not_retried(receiver):
+    for status in (400, 302):
+        server = receiver([status])
+        dispatcher = WebhookDispatcher({"secret": SECRET, "allowed_hosts": ["127.0.0.1"], "backoff_seconds": 0.01})
+        assert not _deliver(dispatcher, server.url, {"event": "job.failed"})
+        assert len(server.deliveries) == 1
+
+def test_private_receivers_are_refused_on_connect(receiver):
+    server = receiver()
+    # The URL was checked against allowed_hosts when submitted; the address is checked again when connecting
+    dispatcher = WebhookDispatcher({"secret": SECRET, "backoff_seconds": 0.01})
+    assert not _deliver(dispatcher, server.url, {"event": "job.succeeded"})
+    assert server.deliveries == []
+    assert dispatcher.stats()["retried"] == 0